@@ -3,16 +3,27 @@
 import asyncio
 import json
 import logging
+import threading
 from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse
 
 # Importamos la instancia de la aplicación y la clase Update desde nuestra lógica principal
 # Es crucial que 'application' se cree en handlers.py para que se inicialice una sola vez
 # cuando Vercel cargue la función.
 from bot_logic.handlers import application, Update
+from bot_logic.dispatcher import RecentUpdates
+from bot_logic import state_manager
+from bot_logic import metrics
 
 # Configuramos un logger para este archivo también
 logger = logging.getLogger(__name__)
 
+# Se marca tras el primer 'application.initialize()' de esta instancia
+_application_ready = threading.Event()
+# Mientras esta petición espera a Gemini, Telegram puede dar el webhook por caído y reenviar el mismo
+# update; los update_id ya vistos por esta instancia se confirman con 200 sin procesarlos otra vez.
+_recent_updates = RecentUpdates()
+
 class handler(BaseHTTPRequestHandler):
     """
     Esta clase es el manejador de la función serverless de Vercel.
@@ -25,19 +36,27 @@ class handler(BaseHTTPRequestHandler):
         Este método se ejecuta automáticamente cada vez que Vercel recibe una petición POST
         en esta ruta. Telegram SIEMPRE envía las actualizaciones de los mensajes vía POST.
         """
+        update = None
         try:
             # 1. Leer el cuerpo de la petición enviada por Telegram
             # Obtenemos la longitud del contenido para saber cuánto leer
             content_len = int(self.headers.get('Content-Length', 0))
-            # Leemos el cuerpo de la petición, que está en formato de bytes
-            post_body_bytes = self.rfile.read(content_len)
-            # Convertimos los bytes a un diccionario de Python (JSON)
-            update_json = json.loads(post_body_bytes)
+            with metrics.span("parse_update"):
+                # Leemos el cuerpo de la petición, que está en formato de bytes
+                post_body_bytes = self.rfile.read(content_len)
+                # Convertimos los bytes a un diccionario de Python (JSON)
+                update_json = json.loads(post_body_bytes)
+
+                # 2. Convertir el diccionario JSON a un objeto 'Update' de la librería
+                # La librería python-telegram-bot tiene una función para esto.
+                # Necesita el diccionario y la instancia del bot (que está dentro de 'application')
+                update = Update.de_json(update_json, application.bot)
 
-            # 2. Convertir el diccionario JSON a un objeto 'Update' de la librería
-            # La librería python-telegram-bot tiene una función para esto.
-            # Necesita el diccionario y la instancia del bot (que está dentro de 'application')
-            update = Update.de_json(update_json, application.bot)
+            if _recent_updates.seen(update.update_id):
+                logger.info(f"Update {update.update_id} repetido: se confirma sin procesarlo.")
+                self.send_response(200)
+                self.end_headers()
+                return
 
             # 3. Procesar la actualización de forma asíncrona
             # Las funciones de nuestro bot son asíncronas (async def), pero do_POST es síncrona.
@@ -46,7 +65,14 @@ class handler(BaseHTTPRequestHandler):
             # application.process_update() es la función mágica que recibe el update
             # y lo envía al handler correcto (CommandHandler, MessageHandler, etc.)
             loop = asyncio.get_event_loop_policy().get_event_loop()
-            loop.run_until_complete(application.process_update(update))
+            # process_update exige una aplicación inicializada; se hace una sola vez por instancia
+            if not _application_ready.is_set():
+                loop.run_until_complete(application.initialize())
+                _application_ready.set()
+            with metrics.bind(update_id=update.update_id), metrics.span("process_update"):
+                loop.run_until_complete(application.process_update(update))
+            # Con STATE_WRITE_BEHIND=1 las varias escrituras de estado del update se vuelcan aquí en una sola
+            state_manager.flush_states()
 
             # 4. Enviar una respuesta de éxito (200 OK) a Telegram
             # Esto es CRUCIAL. Si no respondemos, Telegram pensará que nuestro webhook
@@ -63,5 +89,24 @@ class handler(BaseHTTPRequestHandler):
             # Si algo sale mal en nuestro código, lo registramos en los logs de Vercel
             # y enviamos una respuesta de error al servidor.
             logger.error(f"Error crítico al procesar la petición del webhook: {e}", exc_info=True)
+            # Se devuelve 500 para que Telegram reintente: la reentrega no debe tomarse por repetida
+            if update is not None: _recent_updates.forget(update.update_id)
             self.send_response(500) # Internal Server Error
-            self.end_headers()
\ No newline at end of file
+            self.end_headers()
+
+    def do_GET(self):
+        """Expone las métricas de esta instancia en formato Prometheus en METRICS_PATH."""
+        if urlparse(self.path).path != metrics.METRICS_PATH:
+            self.send_response(404)
+            self.end_headers()
+            return
+        if not metrics.authorized(self.headers.get('Authorization')):
+            self.send_response(403)
+            self.end_headers()
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', metrics.CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
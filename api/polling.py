@@ -0,0 +1,219 @@
+# api/polling.py
+
+import asyncio
+import logging
+import os
+import signal
+
+from aiohttp import web
+from telegram.error import Conflict, InvalidToken, NetworkError, RetryAfter, TimedOut
+
+# Igual que en api/index.py y api/server.py: 'application' se crea una sola vez al importar handlers.py,
+# con los mismos handlers y el mismo backend de estado.
+from bot_logic.handlers import application
+from bot_logic.dispatcher import UpdateDispatcher
+from bot_logic.sharding import WORKERS
+from bot_logic import state_manager
+from bot_logic import metrics
+
+logger = logging.getLogger(__name__)
+
+# Segundos que Telegram mantiene abierta cada petición getUpdates si no hay updates nuevos.
+POLL_TIMEOUT = int(os.getenv("POLLING_TIMEOUT", 30))
+# Updates por lote (Telegram admite hasta 100). También limita los updates sin confirmar a la vez.
+BATCH_SIZE = min(100, int(os.getenv("POLLING_BATCH_SIZE", 100)))
+# Con updates en curso, cada cuánto se vuelve a preguntar por nuevos (Telegram responde al momento).
+BUSY_INTERVAL = float(os.getenv("POLLING_BUSY_INTERVAL", 0.5))
+# Espera máxima tras errores de red seguidos al pedir updates.
+MAX_BACKOFF = 30.0
+# Si se define, se sirven las métricas de Prometheus en este puerto (ruta METRICS_PATH).
+METRICS_PORT = os.getenv("POLLING_METRICS_PORT")
+
+class OffsetTracker:
+    """
+    Lleva los update_id recibidos que aún no han terminado. 'offset' es el primero que Telegram debe
+    volver a entregar: pedir getUpdates con él confirma solo los anteriores, así que un update
+    no se da por recibido hasta que él y todos los anteriores se han procesado.
+    """
+
+    def __init__(self):
+        self._pending = set()
+        self._highest = None
+        self._progress = asyncio.Event()
+
+    @property
+    def offset(self):
+        if self._pending: return min(self._pending)
+        return self._highest + 1 if self._highest is not None else None
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    @property
+    def window(self) -> int:
+        """Updates que Telegram devolvería otra vez en cada lote (los que están entre 'offset' y el último)."""
+        return self._highest - self.offset + 1 if self._pending else 0
+
+    def known(self, update_id: int) -> bool:
+        # Telegram entrega los update_id en orden creciente: uno anterior al último ya está en curso o terminado
+        return self._highest is not None and update_id <= self._highest
+
+    def add(self, update_id: int):
+        self._pending.add(update_id)
+        self._highest = update_id if self._highest is None else max(self._highest, update_id)
+
+    def retract(self, update_id: int):
+        """Deshace el 'add' del último update (no se pudo encolar): Telegram lo volverá a entregar."""
+        self._pending.discard(update_id)
+        self._highest = update_id - 1
+
+    def done(self, update_id: int):
+        self._pending.discard(update_id)
+        self._progress.set()
+
+    async def wait_progress(self, timeout: float):
+        """Espera a que termine algún update (o a 'timeout')."""
+        self._progress.clear()
+        try:
+            await asyncio.wait_for(self._progress.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+class PollingRunner:
+    """
+    Alternativa al webhook para servidores propios: pide los updates a Telegram con getUpdates en
+    lotes de hasta 'batch_size' y los reparte en un UpdateDispatcher (un único event loop, como mucho
+    MAX_CONCURRENT_UPDATES a la vez, en orden dentro de cada chat) o, con WORKERS > 1, en un
+    ShardedDispatcher ya arrancado.
+
+    El offset solo avanza cuando un update y todos los anteriores han terminado: si el proceso cae,
+    Telegram vuelve a entregar los que estaban a medias. Mientras haya updates en curso, cada
+    getUpdates los devuelve otra vez junto con los nuevos; los ya conocidos se ignoran.
+    """
+
+    def __init__(self, application, dispatcher: UpdateDispatcher = None, batch_size: int = BATCH_SIZE,
+                 poll_timeout: int = POLL_TIMEOUT, busy_interval: float = BUSY_INTERVAL):
+        self.application = application
+        self.dispatcher = dispatcher
+        self.batch_size = batch_size
+        self.poll_timeout = poll_timeout
+        self.busy_interval = busy_interval
+        self.tracker = None
+        self._stopping = False
+        self._fetch = None
+        self.batches = 0
+        self.received = 0
+
+    def stop(self):
+        """Deja de pedir updates; 'run' termina tras esperar a los que están en curso."""
+        self._stopping = True
+        if self._fetch is not None: self._fetch.cancel()
+
+    async def run(self):
+        await self.application.initialize()
+        if self.dispatcher is None: self.dispatcher = UpdateDispatcher(self.application)
+        self.tracker = OffsetTracker()
+        # getUpdates no funciona con un webhook configurado; los updates pendientes se conservan
+        await self.application.bot.delete_webhook(drop_pending_updates=False)
+        logger.info("✅ Long polling iniciado.")
+        try:
+            backoff = 1.0
+            while not self._stopping:
+                try:
+                    await self._poll_once()
+                    backoff = 1.0
+                except asyncio.CancelledError:
+                    if not self._stopping: raise
+                except TimedOut:
+                    continue
+                except RetryAfter as e:
+                    retry_after = e.retry_after
+                    await self._sleep(retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after))
+                except InvalidToken:
+                    raise
+                except Conflict as e:
+                    # Otra instancia está haciendo polling o hay un webhook activo
+                    logger.error(f"Conflicto al pedir updates: {e}")
+                    await self._sleep(5.0)
+                except NetworkError as e:
+                    logger.warning(f"Error de red al pedir updates: {e}. Reintento en {backoff:.0f} s.")
+                    await self._sleep(backoff)
+                    backoff = min(MAX_BACKOFF, backoff * 2)
+        finally:
+            await self.dispatcher.drain()
+            await self._commit()
+            state_manager.flush_states()
+            await self.application.shutdown()
+            logger.info("Long polling detenido.")
+
+    async def _poll_once(self):
+        tracker = self.tracker
+        if tracker.window >= self.batch_size:
+            # El lote entero serían updates ya en curso: hay que esperar a que termine alguno
+            await tracker.wait_progress(self.busy_interval)
+            return
+        # Con updates en curso Telegram responde al momento (tiene los no confirmados), no hace falta esperar
+        timeout = 0 if tracker.pending else self.poll_timeout
+        self._fetch = asyncio.ensure_future(self.application.bot.get_updates(offset=tracker.offset, limit=self.batch_size, timeout=timeout))
+        try:
+            updates = await self._fetch
+        finally:
+            self._fetch = None
+        self.batches += 1
+
+        submitted = 0
+        for update in updates:
+            if tracker.known(update.update_id): continue
+            tracker.add(update.update_id)
+            if not self.dispatcher.submit(update, on_done=self._on_done):
+                # Demasiados pendientes: este y los siguientes llegarán en el próximo lote
+                tracker.retract(update.update_id)
+                break
+            submitted += 1
+        self.received += submitted
+        if tracker.pending and not submitted: await tracker.wait_progress(self.busy_interval)
+
+    def _on_done(self, update):
+        self.tracker.done(update.update_id)
+
+    async def _commit(self):
+        """Confirma a Telegram los updates ya procesados (getUpdates con el offset, sin esperar)."""
+        offset = self.tracker.offset if self.tracker else None
+        if offset is None: return
+        try:
+            await self.application.bot.get_updates(offset=offset, limit=1, timeout=0)
+        except Exception as e:
+            logger.warning(f"No se pudo confirmar el offset {offset}: {e}")
+
+    async def _sleep(self, seconds: float):
+        if not self._stopping: await asyncio.sleep(seconds)
+
+    def stats(self) -> dict:
+        return {"batches": self.batches, "received": self.received, "offset": self.tracker.offset if self.tracker else None,
+                "pending": self.tracker.pending if self.tracker else 0}
+
+async def main():
+    dispatcher = None
+    if WORKERS > 1:
+        from api.server import start_sharded_dispatcher
+        dispatcher = await start_sharded_dispatcher(WORKERS)
+    runner = PollingRunner(application, dispatcher)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, runner.stop)
+    metrics_runner = None
+    if METRICS_PORT:
+        from api.server import handle_metrics
+        app = web.Application()
+        app.router.add_get(metrics.METRICS_PATH, handle_metrics)
+        metrics_runner = web.AppRunner(app, access_log=None)
+        await metrics_runner.setup()
+        await web.TCPSite(metrics_runner, os.getenv("HOST", "0.0.0.0"), int(METRICS_PORT)).start()
+    try:
+        await runner.run()
+    finally:
+        if metrics_runner: await metrics_runner.cleanup()
+
+if __name__ == "__main__":
+    asyncio.run(main())
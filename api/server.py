@@ -0,0 +1,97 @@
+# api/server.py
+
+import asyncio
+import json
+import logging
+import os
+import signal
+
+from aiohttp import web
+
+# Igual que en api/index.py: 'application' se crea una sola vez al importar handlers.py.
+from bot_logic.handlers import application, Update
+from bot_logic.dispatcher import UpdateDispatcher
+from bot_logic.sharding import ShardedDispatcher, WORKERS
+from bot_logic import state_manager
+from bot_logic import metrics
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/")
+# Si se configura, debe coincidir con el 'secret_token' usado en setWebhook.
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", 8080))
+
+# UpdateDispatcher o, con WORKERS > 1, ShardedDispatcher (misma interfaz)
+DISPATCHER_KEY = web.AppKey("dispatcher", object)
+WORKERS_KEY = web.AppKey("workers", int)
+WORKER_INITIALIZER_KEY = web.AppKey("worker_initializer", object)
+
+async def handle_webhook(request: web.Request) -> web.Response:
+    """
+    Recibe el update, lo encola y responde 200 de inmediato. La respuesta de la IA
+    se envía después desde una tarea de fondo, así Telegram nunca espera a Gemini.
+    """
+    if WEBHOOK_SECRET_TOKEN and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET_TOKEN:
+        return web.Response(status=403)
+    try:
+        with metrics.span("parse_update"):
+            update_json = await request.json()
+            update = Update.de_json(update_json, application.bot)
+    except json.JSONDecodeError as e:
+        logger.error(f"Error al decodificar el JSON de Telegram: {e}")
+        return web.Response(status=400)
+
+    if not request.app[DISPATCHER_KEY].submit(update):
+        # 503 hace que Telegram vuelva a entregar el update más tarde.
+        logger.warning("Servidor saturado o apagándose. Se rechaza el update.")
+        return web.Response(status=503)
+    return web.Response(status=200)
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    """Métricas en formato Prometheus (ver bot_logic/metrics.py)."""
+    if not metrics.authorized(request.headers.get("Authorization")):
+        return web.Response(status=403)
+    return web.Response(body=metrics.render().encode("utf-8"), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+async def on_startup(app: web.Application):
+    # A diferencia del modo Vercel, aquí la aplicación se inicializa una sola vez.
+    await application.initialize()
+    if app[WORKERS_KEY] > 1:
+        app[DISPATCHER_KEY] = await start_sharded_dispatcher(app[WORKERS_KEY], app[WORKER_INITIALIZER_KEY])
+    else:
+        app[DISPATCHER_KEY] = UpdateDispatcher(application)
+    logger.info("✅ Servidor webhook listo.")
+
+async def start_sharded_dispatcher(workers: int, initializer=None) -> ShardedDispatcher:
+    """
+    Arranca los workers. Como en gunicorn, SIGTTIN añade un worker y SIGTTOU quita uno
+    (los chats afectados pasan a otro worker en cuanto terminan lo que tenían en curso).
+    """
+    dispatcher = ShardedDispatcher(workers, initializer=initializer)
+    await dispatcher.start()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTTIN, lambda: dispatcher.resize(dispatcher.stats()["workers"] + 1))
+    loop.add_signal_handler(signal.SIGTTOU, lambda: dispatcher.resize(max(1, dispatcher.stats()["workers"] - 1)))
+    return dispatcher
+
+async def on_shutdown(app: web.Application):
+    await app[DISPATCHER_KEY].drain()
+    state_manager.flush_states()
+    await application.shutdown()
+    logger.info("Servidor webhook detenido.")
+
+def create_app(workers: int = WORKERS, worker_initializer=None) -> web.Application:
+    """'worker_initializer' se ejecuta en cada worker al arrancar (p. ej. el Gemini falso de bench/)."""
+    app = web.Application()
+    app[WORKERS_KEY] = workers
+    app[WORKER_INITIALIZER_KEY] = worker_initializer
+    app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    app.router.add_get(metrics.METRICS_PATH, handle_metrics)
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    return app
+
+if __name__ == "__main__":
+    web.run_app(create_app(), host=HOST, port=PORT)
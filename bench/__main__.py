@@ -0,0 +1,104 @@
+# bench/__main__.py
+
+import argparse
+import logging
+import os
+import sys
+
+from bench import common, workload
+
+def _corpus_uploads():
+    """Los DOCX del corpus como archivos 'subidos' que sirve el Bot API falso: [(file_id, ruta)]."""
+    from bench.micro import corpus_files
+    return [(f"bench-upload-{i}", os.path.join(common.REPO_ROOT, p)) for i, p in enumerate(corpus_files())]
+
+def cmd_micro(args):
+    from bench import micro
+    results = micro.run(args.suites, repeat=args.repeat, state_users=args.state_users)
+    config = {"suites": args.suites, "repeat": args.repeat, "state_users": args.state_users}
+    print(common.write_results("micro", config, results, args.out))
+
+def cmd_e2e(args):
+    from bench import e2e
+    os.chdir(common.REPO_ROOT)
+    uploads = _corpus_uploads()
+    if args.updates:
+        updates = workload.load_updates(args.updates)
+    else:
+        from bench.micro import corpus_files
+        books = [("Criminología", i) for i in range(len(corpus_files()))]
+        upload_meta = [(file_id, os.path.basename(path), os.path.getsize(path)) for file_id, path in uploads]
+        updates = workload.synthetic_updates(args.users, args.questions, books, upload_meta, args.upload_ratio, seed=args.seed,
+                                               category_ratio=args.category_ratio)
+    if args.save_updates:
+        workload.save_updates(args.save_updates, updates)
+
+    llm_options = {"first_token_latency": args.llm_latency, "chunks": args.llm_chunks, "chunk_interval": args.llm_chunk_interval, "jitter": args.llm_jitter, "seed": args.seed}
+    results = e2e.run(args.mode, updates, uploads, llm_options, args.api_latency, args.concurrency, args.think_time, args.context_cache, args.workers)
+    config = {key: value for key, value in vars(args).items() if key not in ("func", "out", "save_updates")}
+    config["num_updates"] = len(updates)
+    print(common.write_results(f"e2e_{args.mode}", config, results, args.out))
+
+def cmd_coldstart(args):
+    from bench import coldstart
+    results = coldstart.run(args.kinds, repeat=args.repeat, top=args.top)
+    config = {"kinds": args.kinds, "repeat": args.repeat}
+    for kind, result in results.items():
+        print(f"{kind}: import {result['import']['p50_ms']:.0f} ms, primer update {result['first_update']['p50_ms']:.0f} ms, "
+              f"librerías pesadas cargadas: {', '.join(result['heavy_modules']) or 'ninguna'}")
+    print(common.write_results("coldstart", config, results, args.out))
+
+def cmd_compare(args):
+    common.compare(args.base, args.new)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Benchmarks del bot con Telegram y Gemini falsos.")
+    parser.add_argument("--log-level", default="WARNING")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    micro = sub.add_parser("micro", help="Microbenchmarks: extractores, state_manager y construcción del prompt.")
+    micro.add_argument("--suites", nargs="+", default=["extractors", "state", "prompt"], choices=["extractors", "state", "prompt"])
+    micro.add_argument("--repeat", type=int, default=5)
+    micro.add_argument("--state-users", type=int, default=200)
+    micro.add_argument("--out", help="Archivo de resultados (por defecto, bench/results/).")
+    micro.set_defaults(func=cmd_micro)
+
+    e2e = sub.add_parser("e2e", help="Carga de updates contra api/index.py (Vercel), api/server.py o api/polling.py.")
+    e2e.add_argument("--mode", choices=["index", "server", "polling"], default="server")
+    e2e.add_argument("--updates", help="JSONL con un update de Telegram por línea (si no, se genera una carga sintética).")
+    e2e.add_argument("--save-updates", help="Guarda la carga usada en este JSONL para repetirla exactamente.")
+    e2e.add_argument("--users", type=int, default=20)
+    e2e.add_argument("--questions", type=int, default=3, help="Preguntas por usuario.")
+    e2e.add_argument("--upload-ratio", type=float, default=0.2, help="Fracción de usuarios que sube un archivo en vez de elegir uno.")
+    e2e.add_argument("--category-ratio", type=float, default=0.0, help="Fracción de usuarios que pregunta a toda la categoría.")
+    e2e.add_argument("--concurrency", type=int, default=8, help="Usuarios activos a la vez.")
+    e2e.add_argument("--think-time", type=float, default=0.0, help="Pausa de cada usuario entre acciones (s).")
+    e2e.add_argument("--api-latency", type=float, default=0.0, help="Latencia de cada llamada al Bot API falso (s).")
+    e2e.add_argument("--llm-latency", type=float, default=0.8, help="Latencia hasta la respuesta o el primer trozo de Gemini (s).")
+    e2e.add_argument("--llm-chunks", type=int, default=8)
+    e2e.add_argument("--llm-chunk-interval", type=float, default=0.15)
+    e2e.add_argument("--llm-jitter", type=float, default=0.0)
+    e2e.add_argument("--seed", type=int, default=0)
+    e2e.add_argument("--workers", type=int, default=1, help="Procesos worker en el modo server (ShardedDispatcher).")
+    e2e.add_argument("--context-cache", action="store_true", help="Usa la caché de contexto (con una API de caché falsa) para los libros de la biblioteca.")
+    e2e.add_argument("--out", help="Archivo de resultados (por defecto, bench/results/).")
+    e2e.set_defaults(func=cmd_e2e)
+
+    coldstart = sub.add_parser("coldstart", help="Arranque en frío de api/index.py en procesos nuevos, con perfil de '-X importtime'.")
+    coldstart.add_argument("--kinds", nargs="+", default=["start", "categories", "page", "select"], choices=["start", "categories", "page", "select"])
+    coldstart.add_argument("--repeat", type=int, default=5)
+    coldstart.add_argument("--top", type=int, default=25, help="Importaciones más caras que se listan.")
+    coldstart.add_argument("--out", help="Archivo de resultados (por defecto, bench/results/).")
+    coldstart.set_defaults(func=cmd_coldstart)
+
+    compare = sub.add_parser("compare", help="Compara dos archivos de resultados (p. ej. de dos commits).")
+    compare.add_argument("base")
+    compare.add_argument("new")
+    compare.set_defaults(func=cmd_compare)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=args.log_level.upper())
+    args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+# bench/coldstart.py
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+from bench.common import REPO_ROOT, prepare_environment, summarize
+from bench.fake_telegram import FakeBotApi
+
+# Librerías que solo deberían importarse al extraer texto, indexar o llamar a Gemini.
+HEAVY_MODULES = ("PyPDF2", "ebooklib", "bs4", "docx", "pymupdf", "numpy", "grpc", "google.api_core", "google.generativeai")
+
+def _update(kind: str) -> dict:
+    from bench.workload import UpdateFactory
+    factory = UpdateFactory()
+    user_id = 900000000
+    if kind == "start": return factory.message(user_id, "/start")
+    if kind == "categories": return factory.callback(user_id, "back_to_categories")
+    if kind == "page": return factory.callback(user_id, "cat_Criminología")
+    if kind == "select": return factory.callback(user_id, "select_Criminología_0")
+    raise ValueError(f"Tipo de update desconocido: {kind}")
+
+def child(kind: str):
+    """
+    Se ejecuta en un proceso nuevo: importa api/index.py como una instancia serverless recién
+    arrancada, procesa un update de tipo 'kind' y escribe los tiempos en stdout como JSON.
+    """
+    prepare_environment(os.environ["BENCH_API_BASE_URL"])
+    import asyncio
+    started = time.perf_counter()
+    from api import index
+    imported = time.perf_counter()
+    from bot_logic.handlers import application, Update
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(application.initialize())
+    loop.run_until_complete(application.process_update(Update.de_json(_update(kind), application.bot)))
+    processed = time.perf_counter()
+    loop.run_until_complete(application.shutdown())
+    loop.close()
+    print(json.dumps({
+        "import_s": imported - started,
+        "first_update_s": processed - imported,
+        "total_s": processed - started,
+        "heavy_modules": sorted(name for name in HEAVY_MODULES if name in sys.modules),
+    }))
+
+def _parse_importtime(stderr: str, top: int) -> list:
+    """Las 'top' importaciones con más tiempo acumulado según '-X importtime' (en ms)."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line: continue
+        self_us, cumulative_us, name = line.split(":", 1)[1].split("|", 2)
+        rows.append((int(cumulative_us) / 1000, int(self_us) / 1000, name.strip()))
+    rows.sort(reverse=True)
+    return [{"module": name, "cumulative_ms": cumulative, "self_ms": own} for cumulative, own, name in rows[:top]]
+
+def run(kinds, repeat: int = 5, top: int = 25) -> dict:
+    """
+    Mide el arranque en frío: para cada tipo de update lanza 'repeat' procesos nuevos (tras uno de
+    calentamiento que deja compilado el bytecode) y resume los tiempos. La primera ejecución de cada tipo
+    se repite con '-X importtime' para listar las importaciones más caras.
+    """
+    api = FakeBotApi()
+    api.start_in_thread()
+    env = {**os.environ, "BENCH_API_BASE_URL": api.base_url, "PYTHONPATH": os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH")]))}
+    results = {}
+    try:
+        for kind in kinds:
+            command = [sys.executable, "-c", f"from bench.coldstart import child; child({kind!r})"]
+            samples = []
+            for i in range(repeat + 1):
+                output = subprocess.run(command, cwd=REPO_ROOT, env=env, capture_output=True, text=True, check=True)
+                # La primera ejecución solo calienta el bytecode (.pyc) y la caché del sistema de archivos
+                if i: samples.append(json.loads(output.stdout.strip().splitlines()[-1]))
+            profiled = subprocess.run([sys.executable, "-X", "importtime", *command[1:]], cwd=REPO_ROOT, env=env, capture_output=True, text=True, check=True)
+            results[kind] = {
+                "import": summarize([s["import_s"] for s in samples]),
+                "first_update": summarize([s["first_update_s"] for s in samples]),
+                "total": summarize([s["total_s"] for s in samples]),
+                "heavy_modules": samples[-1]["heavy_modules"],
+                "top_imports": _parse_importtime(profiled.stderr, top),
+            }
+    finally:
+        api.stop_thread()
+    return results
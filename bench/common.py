@@ -0,0 +1,105 @@
+# bench/common.py
+
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_ROOT, "bench", "results")
+
+def prepare_environment(api_base_url: str = None):
+    """
+    Configura las variables que necesita 'bot_logic.handlers' ANTES de importarlo: credenciales falsas
+    (nunca se llega a la API real) y, si se indica, el Bot API falso. Se sobrescriben a propósito
+    para que un .env con claves reales no haga que el benchmark hable con Telegram o Gemini.
+    """
+    os.environ["TELEGRAM_TOKEN"] = "123456:BENCH-TOKEN"
+    os.environ["GOOGLE_API_KEY"] = "bench-key-1"
+    os.environ["GOOGLE_API_KEY_2"] = "bench-key-2"
+    os.environ["TELEGRAM_API_BASE_URL"] = api_base_url or "http://127.0.0.1:9"
+    # La carga sintética pregunta sin pausas: sin esto casi todo acabaría en el límite por usuario
+    # del planificador. Se puede fijar otro valor desde fuera para medir precisamente ese límite.
+    os.environ.setdefault("LLM_USER_BURST", "1000")
+    # handlers.py usa rutas relativas ('books', 'library_artifact')
+    os.chdir(REPO_ROOT)
+    if REPO_ROOT not in sys.path: sys.path.insert(0, REPO_ROOT)
+
+def summarize(samples) -> dict:
+    """Resumen de una lista de duraciones en segundos, expresado en milisegundos."""
+    if not samples: return {"n": 0}
+    ordered = sorted(samples)
+    def pct(p): return ordered[min(len(ordered) - 1, int(round(p * (len(ordered) - 1))))] * 1000
+    return {
+        "n": len(ordered),
+        "mean_ms": statistics.fmean(ordered) * 1000,
+        "p50_ms": pct(0.50),
+        "p95_ms": pct(0.95),
+        "min_ms": ordered[0] * 1000,
+        "max_ms": ordered[-1] * 1000,
+    }
+
+def time_call(func, repeat: int, *args, **kwargs) -> dict:
+    """Ejecuta 'func' 'repeat' veces y devuelve el resumen de sus duraciones."""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(*args, **kwargs)
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+def git_revision() -> dict:
+    def git(*args):
+        try:
+            return subprocess.run(["git", *args], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+    return {"commit": git("rev-parse", "HEAD"), "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+def write_results(kind: str, config: dict, results: dict, out_path: str = None) -> str:
+    """
+    Guarda los resultados en JSON junto con el commit, la máquina y la configuración usada,
+    para poder compararlos entre commits con 'python -m bench compare'.
+    """
+    revision = git_revision()
+    document = {
+        "kind": kind,
+        "git": revision,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": config,
+        "results": results,
+    }
+    if out_path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        out_path = os.path.join(RESULTS_DIR, f"{kind}_{time.strftime('%Y%m%d-%H%M%S')}_{(revision['commit'] or 'nogit')[:10]}.json")
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(document, f, ensure_ascii=False, indent=2)
+    return out_path
+
+def _flatten(prefix: str, value, out: dict):
+    if isinstance(value, dict):
+        for key, item in value.items(): _flatten(f"{prefix}.{key}" if prefix else key, item, out)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        out[prefix] = value
+
+def compare(base_path: str, new_path: str, metric_suffixes=("p50_ms", "p95_ms", "mean_ms", "updates_per_s")):
+    """Imprime las métricas comunes de dos archivos de resultados y su variación porcentual."""
+    with open(base_path, encoding="utf-8") as f: base = json.load(f)
+    with open(new_path, encoding="utf-8") as f: new = json.load(f)
+    base_flat, new_flat = {}, {}
+    _flatten("", base["results"], base_flat)
+    _flatten("", new["results"], new_flat)
+    print(f"base: {base['git']['commit'] or '?'}{' (dirty)' if base['git']['dirty'] else ''}  {base['timestamp']}")
+    print(f"new:  {new['git']['commit'] or '?'}{' (dirty)' if new['git']['dirty'] else ''}  {new['timestamp']}")
+    if base["config"] != new["config"]: print("⚠️  Las configuraciones difieren; la comparación puede no ser válida.")
+    for key in sorted(base_flat.keys() & new_flat.keys()):
+        if not key.endswith(metric_suffixes): continue
+        before, after = base_flat[key], new_flat[key]
+        change = (after - before) / before * 100 if before else float("nan")
+        print(f"{key:<60} {before:>12.2f} {after:>12.2f} {change:>+8.1f}%")
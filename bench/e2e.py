@@ -0,0 +1,244 @@
+# bench/e2e.py
+
+import asyncio
+import functools
+import logging
+import threading
+import time
+from collections import defaultdict
+from http.server import HTTPServer
+
+import aiohttp
+
+from bench import fake_gemini
+from bench.common import prepare_environment, summarize
+from bench.fake_telegram import FakeBotApi
+from bench.workload import group_by_user, update_kind
+
+logger = logging.getLogger(__name__)
+
+class _Recorder:
+    """
+    Envuelve 'application.process_update' para medir cuánto tarda el bot en procesar cada update
+    (independientemente de cuándo se respondió el HTTP) y avisar cuando termina.
+    """
+
+    def __init__(self, application):
+        self.processing = defaultdict(list)
+        self.errors = 0
+        self._waiters = {}
+        self._original = application.process_update
+        application.process_update = self._process_update
+
+    def expect(self, update_id: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[update_id] = future
+        return future
+
+    def finish(self, update):
+        """Con workers el update se procesa en otro proceso: el ShardedDispatcher avisa al terminar."""
+        future = self._waiters.pop(update.update_id, None)
+        if future is not None and not future.done(): future.set_result(None)
+
+    async def _process_update(self, update):
+        started = time.perf_counter()
+        try:
+            await self._original(update)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.processing[update_kind(update.to_dict())].append(time.perf_counter() - started)
+            future = self._waiters.pop(update.update_id, None)
+            if future is not None and not future.done(): future.set_result(None)
+
+async def _replay(post, sessions: dict, concurrency: int, think_time: float):
+    """
+    Reproduce cada sesión de usuario en orden (un usuario no pulsa el siguiente botón hasta que el bot
+    terminó con el anterior) con hasta 'concurrency' usuarios a la vez. 'post(update)' debe volver
+    cuando el bot haya terminado de procesar el update y devolver (status, segundos hasta el ACK).
+    """
+    end_to_end = defaultdict(list)
+    ack = []
+    statuses = defaultdict(int)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_session(updates):
+        async with semaphore:
+            for update in updates:
+                started = time.perf_counter()
+                status, ack_seconds = await post(update)
+                end_to_end[update_kind(update)].append(time.perf_counter() - started)
+                ack.append(ack_seconds)
+                statuses[str(status)] += 1
+                if think_time: await asyncio.sleep(think_time)
+
+    await asyncio.gather(*(run_session(updates) for updates in sessions.values()))
+    return end_to_end, ack, statuses
+
+async def _run_server_mode(updates, concurrency: int, think_time: float, workers: int = 1, worker_initializer=None):
+    """
+    Modo servidor (api/server.py): un único event loop, ACK inmediato y procesamiento en segundo plano.
+    Con 'workers' > 1 los updates se procesan en procesos worker (ShardedDispatcher).
+    """
+    from aiohttp import web
+    from api import server
+    from bot_logic import handlers
+
+    recorder = _Recorder(handlers.application)
+    runner = web.AppRunner(server.create_app(workers, worker_initializer), access_log=None)
+    await runner.setup()
+    dispatcher = runner.app[server.DISPATCHER_KEY]
+    if workers > 1:
+        submit = dispatcher.submit
+        dispatcher.submit = lambda update, on_done=None: submit(update, on_done=recorder.finish)
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}{server.WEBHOOK_PATH}"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": server.WEBHOOK_SECRET_TOKEN} if server.WEBHOOK_SECRET_TOKEN else {}
+
+    async with aiohttp.ClientSession() as session:
+        async def post(update):
+            done = recorder.expect(update["update_id"])
+            started = time.perf_counter()
+            async with session.post(url, json=update, headers=headers) as response:
+                status = response.status
+            ack_seconds = time.perf_counter() - started
+            if status == 200: await done
+            return status, ack_seconds
+
+        started = time.perf_counter()
+        end_to_end, ack, statuses = await _replay(post, group_by_user(updates), concurrency, think_time)
+        wall = time.perf_counter() - started
+
+    # Tras apagar: con workers, sus últimas estadísticas llegan al terminar cada uno
+    await runner.cleanup()
+    extra = {"dispatcher": dispatcher.stats()}
+    if workers > 1: recorder.errors = extra["dispatcher"]["failed"]
+    return wall, end_to_end, ack, statuses, recorder, extra
+
+async def _run_index_mode(updates, concurrency: int, think_time: float):
+    """
+    Modo Vercel (api/index.py): el 'handler' síncrono se sirve con HTTPServer en su propio hilo y
+    event loop, así cada petición se procesa entera antes de responder, como en una instancia serverless.
+    """
+    from api import index
+    from bot_logic import handlers
+
+    class QuietHandler(index.handler):
+        def log_message(self, format, *args): pass
+
+    recorder = _Recorder(handlers.application)
+    httpd = HTTPServer(("127.0.0.1", 0), QuietHandler)
+
+    def serve():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        httpd.serve_forever()
+        if index._application_ready.is_set(): loop.run_until_complete(handlers.application.shutdown())
+        # Tareas de fondo que quedaron a medias entre peticiones (p. ej. la cola de ingesta)
+        pending = asyncio.all_tasks(loop)
+        for task in pending: task.cancel()
+        loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.close()
+
+    thread = threading.Thread(target=serve, name="vercel-handler", daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{httpd.server_address[1]}/"
+
+    async with aiohttp.ClientSession() as session:
+        async def post(update):
+            started = time.perf_counter()
+            async with session.post(url, json=update) as response:
+                status = response.status
+            return status, time.perf_counter() - started
+
+        started = time.perf_counter()
+        end_to_end, ack, statuses = await _replay(post, group_by_user(updates), concurrency, think_time)
+        wall = time.perf_counter() - started
+
+    httpd.shutdown()
+    thread.join()
+    return wall, end_to_end, ack, statuses, recorder, {}
+
+async def _run_polling_mode(api: FakeBotApi, updates, concurrency: int, think_time: float):
+    """
+    Modo long polling (api/polling.py): los updates se encolan en el Bot API falso y el runner los recoge
+    con getUpdates. El 'ACK' es el tiempo hasta que el runner recibe el update en un lote.
+    """
+    from api import polling
+    from bot_logic import handlers
+
+    recorder = _Recorder(handlers.application)
+    runner = polling.PollingRunner(handlers.application, poll_timeout=1, busy_interval=0.05)
+    task = asyncio.create_task(runner.run())
+
+    async def post(update):
+        started = time.perf_counter()
+        update_id = api.push_update(update)
+        await recorder.expect(update_id)
+        return 200, api.delivered[update_id] - started
+
+    started = time.perf_counter()
+    end_to_end, ack, statuses = await _replay(post, group_by_user(updates), concurrency, think_time)
+    wall = time.perf_counter() - started
+
+    runner.stop()
+    await task
+    extra = {"dispatcher": runner.dispatcher.stats(), "polling": {**runner.stats(), "confirmed_offset": api.confirmed_offset}}
+    return wall, end_to_end, ack, statuses, recorder, extra
+
+def install_fake_llm(llm_options: dict = None, context_cache: bool = False):
+    """
+    Sustituye el pool de Gemini de handlers.py por uno con modelos falsos (y una API de caché de contexto
+    falsa). Devuelve (modelos, caché de contexto o None, API de caché). Con --workers se ejecuta en cada worker.
+    """
+    from bot_logic import handlers
+    from bot_logic.llm_pool import GeminiClientPool
+    from bot_logic.context_cache import ContextCacheManager
+    caching_api = fake_gemini.FakeCachingAPI(latency=(llm_options or {}).get("first_token_latency", 0.0))
+    factory, models = fake_gemini.model_factory(**(llm_options or {}), caching_api=caching_api)
+    cache = ContextCacheManager(api=caching_api) if context_cache else None
+    handlers.llm_pool = GeminiClientPool(handlers.api_keys, model_factory=factory, context_cache=cache)
+    return models, cache, caching_api
+
+def run(mode: str, updates, upload_files=(), llm_options: dict = None, api_latency: float = 0.0,
+        concurrency: int = 8, think_time: float = 0.0, context_cache: bool = False, workers: int = 1) -> dict:
+    """
+    Ejecuta la carga 'updates' contra el bot real (handlers.py) con un Bot API falso y un Gemini falso,
+    en el modo 'index' (Vercel), 'server' (aiohttp) o 'polling' (getUpdates). Debe ejecutarse en un proceso nuevo: el bot se
+    importa y se inicializa una sola vez por proceso. Con 'context_cache' las preguntas sobre libros
+    de la biblioteca usan la caché de contexto contra un FakeCachingAPI. Con 'workers' > 1 (solo en el modo
+    'server') 'llm' y 'answer_cache' son los del proceso principal; los de cada worker están en 'dispatcher'.
+    """
+    api = FakeBotApi(latency=api_latency)
+    api.start_in_thread()
+    for file_id, path in upload_files: api.register_file(file_id, path)
+    prepare_environment(api.base_url)
+
+    from bot_logic import handlers, answer_cache
+    models, cache, caching_api = install_fake_llm(llm_options, context_cache)
+
+    runner = {"server": functools.partial(_run_server_mode, workers=workers, worker_initializer=functools.partial(install_fake_llm, llm_options, context_cache)), "index": _run_index_mode, "polling": functools.partial(_run_polling_mode, api)}[mode]
+    try:
+        wall, end_to_end, ack, statuses, recorder, extra = asyncio.run(runner(updates, concurrency, think_time))
+    finally:
+        api.stop_thread()
+
+    total = sum(len(samples) for samples in end_to_end.values())
+    return {
+        "mode": mode,
+        "updates": total,
+        "wall_s": wall,
+        "updates_per_s": total / wall if wall else 0.0,
+        "http_status": dict(statuses),
+        "ack": summarize(ack),
+        "end_to_end": {kind: summarize(samples) for kind, samples in sorted(end_to_end.items())},
+        "processing": {kind: summarize(samples) for kind, samples in sorted(recorder.processing.items())},
+        "handler_errors": recorder.errors,
+        "bot_api_calls": dict(sorted(api.snapshot().items())),
+        "llm": {**{name: sum(m.stats[name] for m in models) for name in ("calls", "cached_calls", "prompt_chars")}, "keys": handlers.llm_pool.stats()},
+        "context_cache": {**cache.stats(), "api": caching_api.stats} if cache else None,
+        "answer_cache": answer_cache.stats(),
+        **extra,
+    }
@@ -0,0 +1,138 @@
+# bench/fake_gemini.py
+
+import asyncio
+import itertools
+import random
+import time
+
+from google.api_core.exceptions import NotFound
+
+ANSWER_TEMPLATE = """📚 **Respuesta de prueba**
+
+{body}
+###PREGUNTAS_SUGERIDAS###
+¿Qué otros autores tratan este tema?
+¿Cómo se aplica esto en la práctica?
+¿Qué diferencias hay con el enfoque clásico?"""
+
+class _Usage:
+    """Como 'usage_metadata' de Gemini, estimando ~4 caracteres por token."""
+
+    def __init__(self, prompt: str, text: str, cached_chars: int = 0):
+        self.cached_content_token_count = cached_chars // 4
+        self.prompt_token_count = (len(prompt) + cached_chars) // 4
+        self.candidates_token_count = len(text) // 4
+
+class _Chunk:
+    def __init__(self, text: str, usage_metadata=None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+class _Response:
+    def __init__(self, text: str, usage_metadata=None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+class FakeModel:
+    """
+    Sustituto de GenerativeModel con latencia configurable. Implementa solo lo que usa
+    GeminiClientPool: 'generate_content_async(prompt, stream=False)'.
+
+    - 'first_token_latency': espera antes de la respuesta (o del primer trozo en streaming).
+    - 'chunks' y 'chunk_interval': número de trozos y separación entre ellos en streaming.
+    - 'jitter': variación aleatoria relativa (0.2 = ±20%) aplicada a cada espera.
+    - 'answer_chars': longitud aproximada del cuerpo de la respuesta.
+
+    Los contadores están en 'stats', compartido con las copias que hace el pool para usar una
+    caché de contexto ('_cached_content'); 'caching_api' es el FakeCachingAPI que resuelve esas cachés.
+    """
+
+    def __init__(self, first_token_latency: float = 0.8, chunks: int = 8, chunk_interval: float = 0.15,
+                 jitter: float = 0.0, answer_chars: int = 1500, seed: int = None, caching_api=None):
+        self.first_token_latency = first_token_latency
+        self.chunks = max(1, chunks)
+        self.chunk_interval = chunk_interval
+        self.jitter = jitter
+        self.answer_chars = answer_chars
+        self.caching_api = caching_api
+        self._cached_content = None
+        self.stats = {"calls": 0, "cached_calls": 0, "prompt_chars": 0}
+        self._random = random.Random(seed)
+
+    def _delay(self, seconds: float) -> float:
+        if not self.jitter: return seconds
+        return max(0.0, seconds * (1 + self._random.uniform(-self.jitter, self.jitter)))
+
+    def _answer(self, prompt: str) -> str:
+        sentence = "La criminología estudia el delito, al delincuente, a la víctima y el control social. "
+        body = (sentence * (self.answer_chars // len(sentence) + 1))[:self.answer_chars]
+        return ANSWER_TEMPLATE.format(body=body)
+
+    async def generate_content_async(self, prompt, stream: bool = False):
+        self.stats["calls"] += 1
+        self.stats["prompt_chars"] += len(prompt)
+        cached_chars = 0
+        if self._cached_content is not None:
+            self.stats["cached_calls"] += 1
+            cached_chars = self.caching_api.chars(self._cached_content)
+        await asyncio.sleep(self._delay(self.first_token_latency))
+        text = self._answer(prompt)
+        usage = _Usage(prompt, text, cached_chars)
+        if not stream: return _Response(text, usage)
+        return self._stream(text, usage)
+
+    async def _stream(self, text: str, usage):
+        size = len(text) // self.chunks + 1
+        for i in range(0, len(text), size):
+            if i: await asyncio.sleep(self._delay(self.chunk_interval))
+            # Como en la API real, el recuento de tokens completo llega con el último trozo
+            yield _Chunk(text[i:i + size], usage if i + size >= len(text) else None)
+
+class FakeCachingAPI:
+    """
+    Sustituto de GeminiCachingAPI para ContextCacheManager: guarda las cachés en memoria, con
+    'latency' en cada llamada, y responde NotFound (como la API real) a las que ya caducaron.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.stats = {"create": 0, "update_ttl": 0, "delete": 0}
+        self._entries = {}
+        self._ids = itertools.count(1)
+
+    def chars(self, name: str) -> int:
+        """Caracteres cacheados bajo 'name'; NotFound si no existe o caducó."""
+        entry = self._entries.get(name)
+        if entry is None or entry[1] <= time.time(): raise NotFound(f"CachedContent not found: {name}")
+        return entry[0]
+
+    async def create(self, api_key: str, model_name: str, text: str, ttl_seconds: float, display_name: str):
+        await asyncio.sleep(self.latency)
+        self.stats["create"] += 1
+        name = f"cachedContents/fake-{next(self._ids)}"
+        self._entries[name] = [len(text), time.time() + ttl_seconds]
+        return name, self._entries[name][1]
+
+    async def update_ttl(self, api_key: str, name: str, ttl_seconds: float) -> float:
+        await asyncio.sleep(self.latency)
+        self.stats["update_ttl"] += 1
+        self.chars(name)
+        self._entries[name][1] = time.time() + ttl_seconds
+        return self._entries[name][1]
+
+    async def delete(self, api_key: str, name: str):
+        await asyncio.sleep(self.latency)
+        self.stats["delete"] += 1
+        self._entries.pop(name, None)
+
+def model_factory(**options):
+    """
+    Devuelve un 'model_factory(api_key, model_name)' para GeminiClientPool que crea un FakeModel por
+    clave, y la lista de modelos creados (para leer sus contadores al terminar).
+    """
+    models = []
+    def factory(api_key: str, model_name: str):
+        model = FakeModel(**options)
+        models.append(model)
+        return model
+    return factory, models
@@ -0,0 +1,154 @@
+# bench/fake_telegram.py
+
+import asyncio
+import itertools
+import logging
+import threading
+import time
+from collections import Counter
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+BOT_USER = {"id": 100000001, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+class FakeBotApi:
+    """
+    Servidor local que imita lo justo del Bot API de Telegram para que python-telegram-bot funcione
+    sin red: responde a los métodos que usa el bot, sirve los archivos registrados con
+    'register_file' y cuenta las llamadas por método. 'latency' simula el tiempo de ida y vuelta.
+    Para el long polling (api/polling.py), 'push_update' encola updates que se entregan con getUpdates;
+    'confirmed_offset' es el último offset con el que el bot los confirmó y 'delivered' guarda cuándo se
+    entregó cada update por primera vez.
+    """
+
+    def __init__(self, latency: float = 0.0, host: str = "127.0.0.1", port: int = 0):
+        self.latency = latency
+        self.host = host
+        self.port = port
+        self.calls = Counter()
+        self.files = {}
+        self._message_ids = itertools.count(1000)
+        # Se usa desde el hilo del benchmark y desde el del servidor
+        self._updates_lock = threading.Lock()
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self.confirmed_offset = None
+        self.delivered = {}
+        self._runner = None
+        self._thread = None
+        self._loop = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def register_file(self, file_id: str, path: str):
+        self.files[file_id] = path
+
+    def push_update(self, update: dict) -> int:
+        """
+        Encola un update y devuelve su update_id. Como Telegram, los numera en orden de llegada
+        (la carga sintética los numera al generarla, y varios usuarios los envían intercalados).
+        """
+        with self._updates_lock:
+            update_id = next(self._update_ids)
+            self._updates.append({**update, "update_id": update_id})
+        return update_id
+
+    async def _get_updates(self, params: dict) -> list:
+        """Como getUpdates: el offset confirma (y descarta) los anteriores y se espera hasta 'timeout' s."""
+        offset = int(params["offset"]) if params.get("offset") not in (None, "") else None
+        limit = int(params.get("limit") or 100)
+        deadline = time.monotonic() + float(params.get("timeout") or 0)
+        while True:
+            with self._updates_lock:
+                if offset is not None:
+                    self._updates = [u for u in self._updates if u["update_id"] >= offset]
+                    # Lo confirmado no se "desconfirma" con un offset anterior que llegue tarde
+                    self.confirmed_offset = offset if self.confirmed_offset is None else max(self.confirmed_offset, offset)
+                batch = self._updates[:limit]
+                now = time.perf_counter()
+                for update in batch: self.delivered.setdefault(update["update_id"], now)
+            if batch or time.monotonic() >= deadline: return batch
+            await asyncio.sleep(0.005)
+
+    def _message(self, params: dict) -> dict:
+        chat_id = int(params.get("chat_id", 0))
+        message_id = int(params["message_id"]) if "message_id" in params else next(self._message_ids)
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+
+    async def _handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post()) if request.can_read_body else {}
+        if not params and request.content_type == "application/json":
+            params = await request.json()
+        self.calls[method] += 1
+        if self.latency: await asyncio.sleep(self.latency)
+
+        if method == "getMe":
+            result = BOT_USER
+        elif method == "getUpdates":
+            result = await self._get_updates(params)
+        elif method in ("sendMessage", "editMessageText", "editMessageReplyMarkup"):
+            result = self._message(params)
+        elif method == "getFile":
+            file_id = params.get("file_id")
+            if file_id not in self.files:
+                return web.json_response({"ok": False, "error_code": 400, "description": "Bad Request: invalid file_id"})
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_path": f"documents/{file_id}"}
+        else:
+            # answerCallbackQuery, deleteMessage, sendChatAction...
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def _handle_file(self, request: web.Request) -> web.StreamResponse:
+        self.calls["download"] += 1
+        path = self.files.get(request.match_info["file_id"])
+        if path is None: return web.Response(status=404)
+        return web.FileResponse(path)
+
+    def _create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(r"/bot{token}/{method}", self._handle_method)
+        app.router.add_get(r"/file/bot{token}/documents/{file_id}", self._handle_file)
+        return app
+
+    async def start(self):
+        self._runner = web.AppRunner(self._create_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        logger.info(f"Bot API falso escuchando en {self.base_url}")
+
+    async def stop(self):
+        if self._runner: await self._runner.cleanup()
+
+    def start_in_thread(self):
+        """Arranca el servidor en un hilo con su propio event loop (para el modo Vercel, que es síncrono)."""
+        started = threading.Event()
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.start())
+            started.set()
+            self._loop.run_forever()
+        self._thread = threading.Thread(target=run, name="fake-bot-api", daemon=True)
+        self._thread.start()
+        started.wait()
+
+    def stop_thread(self):
+        if self._loop is None: return
+        asyncio.run_coroutine_threadsafe(self.stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def snapshot(self) -> dict:
+        return dict(self.calls)
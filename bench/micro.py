@@ -0,0 +1,110 @@
+# bench/micro.py
+
+import os
+import shutil
+import tempfile
+import time
+
+from bench.common import prepare_environment, summarize, time_call
+
+CORPUS_DIR = os.path.join("books", "Criminología")
+
+def corpus_files(extension: str = ".docx") -> list:
+    return sorted(os.path.join(CORPUS_DIR, name) for name in os.listdir(CORPUS_DIR) if name.lower().endswith(extension))
+
+def bench_extractors(repeat: int) -> dict:
+    """Cada extractor de texto sobre el corpus DOCX, sin caché, más la caché de texto en frío y en caliente."""
+    from bot_logic import extractors, text_cache
+    files = corpus_files()
+    results = {"files": len(files), "bytes": sum(os.path.getsize(p) for p in files)}
+    results["docx_to_text"] = time_call(lambda: [extractors.docx_to_text(p) for p in files], repeat)
+    results["iter_sections"] = time_call(lambda: [sum(1 for _ in extractors.iter_sections(p)) for p in files], repeat)
+    results["chars"] = sum(len(extractors.docx_to_text(p) or "") for p in files)
+    results["per_file"] = {os.path.basename(p): time_call(extractors.docx_to_text, repeat, p) for p in files}
+
+    # Disco: se vacía la LRU en memoria antes de cada vuelta para leer siempre de /tmp
+    for p in files: text_cache.get_text(p, extractors.docx_to_text)
+    def from_disk():
+        text_cache.clear_memory()
+        for p in files: text_cache.get_text(p, extractors.docx_to_text)
+    results["text_cache_disk"] = time_call(from_disk, repeat)
+    results["text_cache_memory"] = time_call(lambda: [text_cache.get_text(p, extractors.docx_to_text) for p in files], repeat)
+    return results
+
+def _sample_state(user_id: int) -> dict:
+    return {
+        "current_book_path": os.path.join(CORPUS_DIR, "1 INTRODUCCIÓN.docx"),
+        "last_question": f"¿Pregunta de prueba número {user_id}?",
+        "suggestions": {f"sugg_{i}": f"¿Sugerencia {i} para {user_id}?" for i in range(3)},
+    }
+
+def bench_state(users: int, repeat: int) -> dict:
+    """load/save de cada backend de state_manager con 'users' usuarios distintos."""
+    from bot_logic import state_manager
+    user_ids = range(990000000, 990000000 + users)
+    tmp_dir = tempfile.mkdtemp(prefix="bench_state_")
+    backends = {
+        "json": state_manager.JsonFileBackend(),
+        "sqlite": state_manager.SQLiteBackend(os.path.join(tmp_dir, "states.sqlite3")),
+        "json_write_behind": state_manager.WriteBehindBackend(state_manager.JsonFileBackend()),
+        "sqlite_write_behind": state_manager.WriteBehindBackend(state_manager.SQLiteBackend(os.path.join(tmp_dir, "wb.sqlite3"))),
+    }
+    results = {"users": users}
+    try:
+        for name, backend in backends.items():
+            save_samples, load_samples = [], []
+            for _ in range(repeat):
+                for user_id in user_ids:
+                    state = _sample_state(user_id)
+                    started = time.perf_counter()
+                    backend.save(user_id, state)
+                    save_samples.append(time.perf_counter() - started)
+                started = time.perf_counter()
+                backend.flush()
+                flush_seconds = time.perf_counter() - started
+                for user_id in user_ids:
+                    started = time.perf_counter()
+                    backend.load(user_id)
+                    load_samples.append(time.perf_counter() - started)
+            results[name] = {"save": summarize(save_samples), "load": summarize(load_samples), "last_flush_ms": flush_seconds * 1000}
+            backend.close()
+    finally:
+        for user_id in user_ids:
+            try: os.remove(state_manager.get_state_filepath(user_id))
+            except OSError: pass
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return results
+
+def bench_prompt(repeat: int) -> dict:
+    """Construcción del prompt: índice BM25, selección de contexto y plantilla, para cada nivel de detalle."""
+    from bot_logic import extractors, retrieval, text_cache
+    from bot_logic.handlers import build_prompt
+    from bench.workload import QUESTIONS
+    # El documento más largo del corpus y todo el corpus unido (para superar el presupuesto de 'detailed')
+    texts = [text_cache.get_text(p, extractors.docx_to_text) or "" for p in corpus_files()]
+    documents = {"largest_doc": max(texts, key=len), "whole_corpus": "\n".join(texts)}
+    results = {}
+    for name, text in documents.items():
+        doc_key = f"bench-{name}"
+        entry = {"chars": len(text), "bm25_build": time_call(retrieval.BM25Index.build, repeat, text)}
+        retrieval.get_index(doc_key, text)
+        for detail_level in retrieval.DETAIL_CONFIG:
+            def build():
+                for question in QUESTIONS:
+                    build_prompt(retrieval.build_context(doc_key, text, question, detail_level), question, detail_level)
+            summary = time_call(build, repeat)
+            entry[detail_level] = {key: value / len(QUESTIONS) if key.endswith("_ms") else value for key, value in summary.items()}
+            entry[detail_level]["prompt_chars"] = len(build_prompt(retrieval.build_context(doc_key, text, QUESTIONS[0], detail_level), QUESTIONS[0], detail_level))
+        results[name] = entry
+        retrieval.drop_index(doc_key)
+    return results
+
+SUITES = {"extractors": bench_extractors, "state": bench_state, "prompt": bench_prompt}
+
+def run(suites, repeat: int = 5, state_users: int = 200) -> dict:
+    prepare_environment()
+    results = {}
+    for name in suites:
+        if name == "state": results[name] = bench_state(state_users, repeat)
+        else: results[name] = SUITES[name](repeat)
+    return results
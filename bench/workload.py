@@ -0,0 +1,128 @@
+# bench/workload.py
+
+import json
+import os
+import random
+import time
+
+QUESTIONS = [
+    "¿Qué es la criminología?",
+    "¿Cuál es el objeto de estudio de la criminología?",
+    "¿Qué diferencia hay entre criminología y derecho penal?",
+    "¿Qué es la victimología?",
+    "¿Cómo ha evolucionado el sistema penitenciario?",
+    "¿Qué es la prevención del delito?",
+    "¿Qué se entiende por política criminal?",
+    "¿Qué papel tiene la familia en la conducta delictiva?",
+    "¿Qué son los niños en conflicto con la ley penal?",
+    "¿Cuáles son las principales escuelas del pensamiento criminológico?",
+]
+
+class UpdateFactory:
+    """Construye updates de Telegram (como dicts JSON) con update_id y message_id correlativos."""
+
+    def __init__(self, first_update_id: int = 1):
+        self.next_update_id = first_update_id
+        self.next_message_id = 1
+
+    def _ids(self):
+        update_id, message_id = self.next_update_id, self.next_message_id
+        self.next_update_id += 1
+        self.next_message_id += 1
+        return update_id, message_id
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"Bench{user_id}", "language_code": "es"}
+
+    def message(self, user_id: int, text: str = None, document: dict = None) -> dict:
+        update_id, message_id = self._ids()
+        message = {"message_id": message_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id)}
+        if text is not None:
+            message["text"] = text
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if document is not None:
+            message["document"] = document
+        return {"update_id": update_id, "message": message}
+
+    def callback(self, user_id: int, data: str) -> dict:
+        update_id, message_id = self._ids()
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {"message_id": message_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"}, "text": "..."},
+            },
+        }
+
+def synthetic_updates(users: int, questions_per_user: int, books, upload_files=(), upload_ratio: float = 0.0,
+                      detailed_ratio: float = 0.3, suggestion_ratio: float = 0.3, seed: int = 0, first_user_id: int = 900000000,
+                      category_ratio: float = 0.0):
+    """
+    Genera una sesión típica por usuario: /start, elegir (o subir) un libro y hacer varias preguntas
+    eligiendo el nivel de detalle y, a veces, una pregunta sugerida. 'books' es una lista de
+    (categoría, índice); 'upload_files' una lista de (file_id, nombre, tamaño) servidos por el Bot API falso.
+    Una fracción 'category_ratio' de los usuarios pregunta a toda la categoría en vez de elegir un libro.
+    Con la misma semilla se obtiene exactamente la misma carga.
+    """
+    rng = random.Random(seed)
+    factory = UpdateFactory()
+    updates = []
+    for n in range(users):
+        user_id = first_user_id + n
+        updates.append(factory.message(user_id, "/start"))
+        if upload_files and rng.random() < upload_ratio:
+            file_id, file_name, file_size = rng.choice(upload_files)
+            updates.append(factory.message(user_id, document={"file_id": file_id, "file_unique_id": file_id, "file_name": file_name, "file_size": file_size}))
+        else:
+            category, index = rng.choice(books)
+            updates.append(factory.message(user_id, "/books"))
+            updates.append(factory.callback(user_id, f"cat_{category}"))
+            # Sin 'category_ratio' no se consume el generador: las cargas de siempre no cambian
+            if category_ratio and rng.random() < category_ratio:
+                updates.append(factory.callback(user_id, f"askcat_{category}"))
+            else:
+                updates.append(factory.callback(user_id, f"select_{category}_{index}"))
+        for _ in range(questions_per_user):
+            if rng.random() < suggestion_ratio and updates[-1].get("callback_query", {}).get("data", "").startswith("detail_"):
+                updates.append(factory.callback(user_id, f"sugg_{rng.randrange(3)}"))
+            else:
+                updates.append(factory.message(user_id, rng.choice(QUESTIONS)))
+            updates.append(factory.callback(user_id, "detail_detailed" if rng.random() < detailed_ratio else "detail_simple"))
+    return updates
+
+def load_updates(path: str) -> list:
+    """Lee un archivo JSONL con un update de Telegram por línea (grabado o generado)."""
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def save_updates(path: str, updates):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        for update in updates:
+            f.write(json.dumps(update, ensure_ascii=False) + "\n")
+
+def update_user_id(update: dict):
+    for key in ("message", "edited_message", "callback_query"):
+        if key in update: return update[key]["from"]["id"]
+    return None
+
+def update_kind(update: dict) -> str:
+    """Clasifica el update para agrupar las latencias: 'command', 'question', 'document' o 'callback:<prefijo>'."""
+    if "callback_query" in update:
+        return "callback:" + update["callback_query"].get("data", "").split("_", 1)[0]
+    message = update.get("message", {})
+    if "document" in message: return "document"
+    if message.get("text", "").startswith("/"): return "command"
+    return "question"
+
+def group_by_user(updates) -> dict:
+    """Agrupa los updates por usuario conservando su orden (cada usuario se reproduce en secuencia)."""
+    sessions = {}
+    for update in updates:
+        sessions.setdefault(update_user_id(update), []).append(update)
+    return sessions
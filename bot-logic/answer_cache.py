@@ -0,0 +1,83 @@
+# bot_logic/answer_cache.py
+
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from bot_logic import metrics
+
+# Obtenemos una instancia del logger para este módulo
+logger = logging.getLogger(__name__)
+
+# Cuánto vive una respuesta y cuántas se guardan como máximo (las menos usadas se expulsan primero).
+TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL", 6 * 3600))
+MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 1024))
+
+_SPACES_RE = re.compile(r"\s+")
+_EDGE_PUNCTUATION = "¿?¡!.,;: \"'«»"
+
+_lock = threading.Lock()
+# clave -> (caduca_en, respuesta, sugerencias)
+_entries = OrderedDict()
+_hits = 0
+_misses = 0
+
+def normalize_question(question: str) -> str:
+    """Normaliza la pregunta para que variaciones triviales (mayúsculas, espacios, signos) compartan entrada."""
+    normalized = unicodedata.normalize("NFKC", question).lower()
+    return _SPACES_RE.sub(" ", normalized).strip(_EDGE_PUNCTUATION)
+
+def make_key(doc_key: str, question: str, detail_level: str) -> tuple:
+    return (doc_key, normalize_question(question), detail_level)
+
+def get(doc_key: str, question: str, detail_level: str):
+    """Devuelve (respuesta, sugerencias) si hay una respuesta vigente, o None."""
+    global _hits, _misses
+    key = make_key(doc_key, question, detail_level)
+    now = time.monotonic()
+    with _lock:
+        entry = _entries.get(key)
+        if entry and entry[0] > now:
+            _entries.move_to_end(key)
+            _hits += 1
+            return entry[1], list(entry[2])
+        if entry: del _entries[key]
+        _misses += 1
+    return None
+
+def contains(doc_key: str, question: str, detail_level: str) -> bool:
+    """Si hay una respuesta vigente, sin contarla como acierto ni fallo (para no preparar dos veces la misma)."""
+    with _lock:
+        entry = _entries.get(make_key(doc_key, question, detail_level))
+    return entry is not None and entry[0] > time.monotonic()
+
+def put(doc_key: str, question: str, detail_level: str, answer: str, suggestions: list):
+    if not answer: return
+    key = make_key(doc_key, question, detail_level)
+    with _lock:
+        _entries[key] = (time.monotonic() + TTL_SECONDS, answer, tuple(suggestions))
+        _entries.move_to_end(key)
+        while len(_entries) > MAX_ENTRIES:
+            _entries.popitem(last=False)
+
+def stats() -> dict:
+    with _lock:
+        return {"hits": _hits, "misses": _misses, "entries": len(_entries)}
+
+def _metric_samples() -> list:
+    current = stats()
+    return [
+        ("bot_answer_cache_hits", "counter", "Preguntas respondidas desde la caché.", [({}, current["hits"])]),
+        ("bot_answer_cache_misses", "counter", "Preguntas que no estaban en la caché.", [({}, current["misses"])]),
+        ("bot_answer_cache_entries", "gauge", "Respuestas guardadas en la caché.", [({}, current["entries"])]),
+    ]
+
+metrics.register_collector(_metric_samples)
+
+def clear():
+    with _lock:
+        _entries.clear()
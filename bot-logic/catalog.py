@@ -0,0 +1,124 @@
+# bot_logic/catalog.py
+
+import hashlib
+import logging
+import os
+
+from bot_logic import text_cache
+
+# Obtenemos una instancia del logger para este módulo
+logger = logging.getLogger(__name__)
+
+class BookMeta:
+    """
+    Metadatos de un libro de la biblioteca. 'content_hash' se calcula la primera vez que se usa (leer
+    todos los libros al escanear alargaría el arranque en frío).
+    """
+
+    __slots__ = ("category", "filename", "path", "size", "mtime_ns", "_content_hash")
+
+    def __init__(self, category: str, filename: str, path: str, size: int, mtime_ns: int):
+        self.category = category
+        self.filename = filename
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self._content_hash = None
+
+    @property
+    def content_hash(self) -> str:
+        if self._content_hash is None: self._content_hash = text_cache.file_content_hash(self.path)
+        return self._content_hash
+
+    def changed_on_disk(self) -> bool:
+        """Si el archivo se modificó o se sustituyó (otro tamaño o mtime) o ya no existe."""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return True
+        return st.st_size != self.size or st.st_mtime_ns != self.mtime_ns
+
+class LibraryCatalog:
+    """
+    Índice incremental de BOOKS_DIR. 'refresh' solo vuelve a listar el directorio raíz si cambió su
+    mtime y solo reescanea las categorías cuyo mtime cambió (se añadió, borró o renombró un libro) o en
+    las que algún libro cambió de tamaño o mtime (se editó o sustituyó sin tocar el directorio);
+    los libros que no cambiaron conservan sus metadatos.
+    """
+
+    def __init__(self, books_dir: str, valid_extensions):
+        self.books_dir = books_dir
+        self.valid_extensions = set(valid_extensions)
+        self.categories = {}
+        self._by_path = {}
+        self._root_mtime = None
+        self._category_mtimes = {}
+
+    def refresh(self) -> set:
+        """Sincroniza el catálogo con el disco y devuelve el conjunto de categorías que cambiaron."""
+        changed = set()
+        root_mtime = os.stat(self.books_dir).st_mtime_ns
+        if root_mtime != self._root_mtime:
+            current = {name for name in os.listdir(self.books_dir) if os.path.isdir(os.path.join(self.books_dir, name))}
+            for removed in set(self._category_mtimes) - current:
+                self._drop_category(removed)
+                changed.add(removed)
+            for added in current - set(self._category_mtimes):
+                self._category_mtimes[added] = None
+            self._root_mtime = root_mtime
+
+        for category_name in list(self._category_mtimes):
+            category_path = os.path.join(self.books_dir, category_name)
+            try:
+                mtime = os.stat(category_path).st_mtime_ns
+            except FileNotFoundError:
+                self._drop_category(category_name)
+                changed.add(category_name)
+                continue
+            if mtime != self._category_mtimes[category_name] or any(meta.changed_on_disk() for meta in self.books(category_name)):
+                self._scan_category(category_name, category_path)
+                self._category_mtimes[category_name] = mtime
+                changed.add(category_name)
+        if changed:
+            logger.info(f"Catálogo actualizado. Categorías reescaneadas: {sorted(changed)}")
+        return changed
+
+    def _drop_category(self, category_name: str):
+        for meta in self.categories.pop(category_name, []):
+            self._by_path.pop(meta.path, None)
+        self._category_mtimes.pop(category_name, None)
+
+    def _scan_category(self, category_name: str, category_path: str):
+        previous = {meta.filename: meta for meta in self.categories.get(category_name, [])}
+        books = []
+        for filename in sorted(os.listdir(category_path)):
+            if os.path.splitext(filename.lower())[1] not in self.valid_extensions: continue
+            path = os.path.normpath(os.path.join(category_path, filename))
+            st = os.stat(path)
+            meta = previous.get(filename)
+            if meta is None or meta.size != st.st_size or meta.mtime_ns != st.st_mtime_ns:
+                meta = BookMeta(category_name, filename, path, st.st_size, st.st_mtime_ns)
+            books.append(meta)
+        for meta in previous.values():
+            self._by_path.pop(meta.path, None)
+        if books:
+            self.categories[category_name] = books
+            self._by_path.update((meta.path, meta) for meta in books)
+        else:
+            self.categories.pop(category_name, None)
+
+    def category_names(self) -> list:
+        return sorted(self.categories)
+
+    def books(self, category_name: str) -> list:
+        return self.categories.get(category_name, [])
+
+    def category_key(self, category_name: str) -> str:
+        """Hash del contenido de toda la categoría: cambia si se añade, borra o modifica alguno de sus libros."""
+        digest = hashlib.sha256(category_name.encode("utf-8"))
+        for meta in self.books(category_name):
+            digest.update(f"\0{meta.filename}\0{meta.content_hash}".encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, path: str):
+        return self._by_path.get(os.path.normpath(path))
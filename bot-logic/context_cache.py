@@ -0,0 +1,196 @@
+# bot_logic/context_cache.py
+
+import asyncio
+import datetime
+import logging
+import os
+import time
+import weakref
+from collections import OrderedDict
+
+# Obtenemos una instancia del logger para este módulo
+logger = logging.getLogger(__name__)
+
+# Con CONTEXT_CACHE=1 los libros de la biblioteca se registran en la caché de contexto de Gemini y cada
+# pregunta solo envía la parte final del prompt. Requiere un modelo con versión fija (p. ej. gemini-2.0-flash-001).
+CONTEXT_CACHE_ENABLED = os.getenv("CONTEXT_CACHE", "0") == "1"
+TTL_SECONDS = float(os.getenv("CONTEXT_CACHE_TTL", 3600))
+# Si a una caché le queda menos que esto al usarla, se renueva antes de la llamada.
+REFRESH_MARGIN = float(os.getenv("CONTEXT_CACHE_REFRESH_MARGIN", 300))
+# La API no admite cachés pequeñas (un mínimo de tokens que depende del modelo) y no compensan.
+MIN_CHARS = int(os.getenv("CONTEXT_CACHE_MIN_CHARS", 16000))
+MAX_CHARS = int(os.getenv("CONTEXT_CACHE_MAX_CHARS", 2000000))
+# Cachés vivas a la vez (se paga su almacenamiento); al superarlo se borran las menos usadas.
+MAX_ENTRIES = int(os.getenv("CONTEXT_CACHE_MAX_ENTRIES", 64))
+# Tras un fallo al crear una caché no se vuelve a intentar con ese documento y clave durante este tiempo.
+FAILURE_COOLDOWN = 300.0
+
+def _is_not_found(error: Exception) -> bool:
+    """Si 'error' es un NotFound de la API (sin importar google.api_core al arrancar)."""
+    from google.api_core.exceptions import NotFound
+    return isinstance(error, NotFound)
+
+class CacheablePrefix:
+    """
+    Prompt partido en un prefijo estable ('text', el mismo en todas las preguntas sobre el documento
+    'key') y un sufijo pequeño con la pregunta ('suffix'). Solo el sufijo viaja si el prefijo está cacheado.
+    """
+
+    __slots__ = ("key", "text", "suffix")
+
+    def __init__(self, key: str, text: str, suffix: str):
+        self.key = key
+        self.text = text
+        self.suffix = suffix
+
+class CacheHandle:
+    __slots__ = ("name", "expires_at")
+
+    def __init__(self, name: str, expires_at: float):
+        self.name = name
+        self.expires_at = expires_at
+
+class GeminiCachingAPI:
+    """
+    Llamadas a la API de caché de contexto de Gemini con un cliente asíncrono por clave API
+    (cada caché pertenece al proyecto de la clave que la creó). Las horas son timestamps Unix.
+    """
+
+    def __init__(self):
+        self._clients = {}
+
+    def _client(self, api_key: str):
+        client = self._clients.get(api_key)
+        if client is None:
+            from google.ai import generativelanguage as glm
+            client = self._clients[api_key] = glm.CacheServiceAsyncClient(client_options={"api_key": api_key})
+        return client
+
+    async def create(self, api_key: str, model_name: str, text: str, ttl_seconds: float, display_name: str):
+        """Crea la caché y devuelve (nombre, caduca_en)."""
+        from google.ai import generativelanguage as glm
+        model = model_name if "/" in model_name else f"models/{model_name}"
+        cached = await self._client(api_key).create_cached_content(cached_content=glm.CachedContent(
+            model=model,
+            display_name=display_name[:128],
+            contents=[glm.Content(role="user", parts=[glm.Part(text=text)])],
+            ttl=datetime.timedelta(seconds=ttl_seconds),
+        ))
+        return cached.name, cached.expire_time.timestamp()
+
+    async def update_ttl(self, api_key: str, name: str, ttl_seconds: float) -> float:
+        """Amplía la vida de la caché y devuelve su nueva hora de caducidad."""
+        from google.ai import generativelanguage as glm
+        from google.protobuf import field_mask_pb2
+        cached = await self._client(api_key).update_cached_content(
+            cached_content=glm.CachedContent(name=name, ttl=datetime.timedelta(seconds=ttl_seconds)),
+            update_mask=field_mask_pb2.FieldMask(paths=["ttl"]),
+        )
+        return cached.expire_time.timestamp()
+
+    async def delete(self, api_key: str, name: str):
+        await self._client(api_key).delete_cached_content(name=name)
+
+class ContextCacheManager:
+    """
+    Lleva las cachés de contexto por (clave API, documento): las crea la primera vez que se pregunta
+    por un documento, las renueva cuando les queda poco y borra las menos usadas si hay demasiadas.
+    'api' permite sustituir la API real por una falsa (ver bench/fake_gemini.py).
+    """
+
+    def __init__(self, api=None, ttl: float = TTL_SECONDS, refresh_margin: float = REFRESH_MARGIN,
+                 max_entries: int = MAX_ENTRIES, min_chars: int = MIN_CHARS, max_chars: int = MAX_CHARS):
+        self.api = api or GeminiCachingAPI()
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.max_entries = max_entries
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        # (etiqueta de la clave, documento) -> CacheHandle. El orden refleja el uso más reciente al final.
+        self._handles = OrderedDict()
+        # Un lock por hueco; con WeakValueDictionary desaparece cuando nadie lo usa.
+        self._locks = weakref.WeakValueDictionary()
+        self._failed_until = {}
+        self._api_keys = {}
+        self.hits = 0
+        self.created = 0
+        self.refreshed = 0
+        self.failures = 0
+
+    def eligible(self, text: str) -> bool:
+        return self.min_chars <= len(text) <= self.max_chars
+
+    async def resolve(self, key_state, model_name: str, prefix: CacheablePrefix):
+        """
+        Devuelve el nombre de la caché con 'prefix' para la clave 'key_state', creándola o renovándola si
+        hace falta, o None si no se puede usar (el llamador envía entonces el prompt completo).
+        """
+        if not self.eligible(prefix.text): return None
+        slot = (key_state.label, prefix.key)
+        if self._failed_until.get(slot, 0) > time.monotonic(): return None
+        handle = self._handles.get(slot)
+        if handle and handle.expires_at - time.time() > self.refresh_margin:
+            self._handles.move_to_end(slot)
+            self.hits += 1
+            return handle.name
+
+        # Un lock por documento y clave: varias preguntas simultáneas crean una sola caché.
+        lock = self._locks.get(slot)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[slot] = lock
+        async with lock:
+            handle = self._handles.get(slot)
+            now = time.time()
+            try:
+                if handle and handle.expires_at - now > self.refresh_margin:
+                    self.hits += 1
+                elif handle and handle.expires_at > now:
+                    handle.expires_at = await self.api.update_ttl(key_state.api_key, handle.name, self.ttl)
+                    self.refreshed += 1
+                    logger.info(f"Caché de contexto renovada para {prefix.key[:12]} (clave {key_state.label}).")
+                else:
+                    handle = await self._create(key_state, model_name, prefix, slot)
+            except Exception as e:
+                if _is_not_found(e):
+                    # Caducó o se borró por fuera: se crea de nuevo.
+                    self._handles.pop(slot, None)
+                    handle = await self._create(key_state, model_name, prefix, slot)
+                else:
+                    self.failures += 1
+                    self._failed_until[slot] = time.monotonic() + FAILURE_COOLDOWN
+                    logger.warning(f"No se pudo usar la caché de contexto para {prefix.key[:12]} (clave {key_state.label}): {e!r}")
+                    return None
+            if handle is None: return None
+            self._handles[slot] = handle
+            self._handles.move_to_end(slot)
+        await self._evict()
+        return handle.name
+
+    async def _create(self, key_state, model_name: str, prefix: CacheablePrefix, slot):
+        try:
+            name, expires_at = await self.api.create(key_state.api_key, model_name, prefix.text, self.ttl, f"bot:{prefix.key[:32]}")
+        except Exception as e:
+            self.failures += 1
+            self._failed_until[slot] = time.monotonic() + FAILURE_COOLDOWN
+            logger.warning(f"No se pudo crear la caché de contexto para {prefix.key[:12]} (clave {key_state.label}): {e!r}")
+            return None
+        self.created += 1
+        self._api_keys[slot] = key_state.api_key
+        logger.info(f"Caché de contexto creada para {prefix.key[:12]} (clave {key_state.label}): {len(prefix.text)} caracteres.")
+        return CacheHandle(name, expires_at)
+
+    def invalidate(self, key_state, prefix_key: str):
+        """Olvida la caché de un documento (p. ej. si Gemini dice que ya no existe)."""
+        self._handles.pop((key_state.label, prefix_key), None)
+
+    async def _evict(self):
+        while len(self._handles) > self.max_entries:
+            slot, handle = self._handles.popitem(last=False)
+            try:
+                await self.api.delete(self._api_keys.pop(slot), handle.name)
+            except Exception as e:
+                logger.warning(f"No se pudo borrar la caché de contexto {handle.name}: {e!r}")
+
+    def stats(self) -> dict:
+        return {"entries": len(self._handles), "hits": self.hits, "created": self.created, "refreshed": self.refreshed, "failures": self.failures}
@@ -0,0 +1,218 @@
+# bot_logic/dispatcher.py
+
+import asyncio
+import logging
+import os
+import threading
+from collections import OrderedDict, deque
+
+from bot_logic import metrics
+
+# Obtenemos una instancia del logger para este módulo
+logger = logging.getLogger(__name__)
+
+# Cuántos updates se procesan a la vez y cuántos pueden esperar turno antes de rechazar nuevos.
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", 16))
+MAX_PENDING_UPDATES = int(os.getenv("MAX_PENDING_UPDATES", 256))
+# Segundos que se espera a los updates en curso al apagar el servidor.
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", 30))
+# Cuántos update_id recientes se recuerdan para descartar las reentregas de Telegram.
+DEDUP_WINDOW = int(os.getenv("UPDATE_DEDUP_WINDOW", 2048))
+# Botones que se fusionan si se pulsan otra vez sobre el mismo mensaje antes de terminar el anterior.
+COALESCED_CALLBACK_PREFIXES = ("detail_", "sugg_")
+
+class RecentUpdates:
+    """
+    Ventana acotada con los últimos update_id vistos. Telegram reintenta un update si el webhook
+    tarda o falla, y sin esto cada reentrega volvería a llamar a Gemini y a responder dos veces.
+    Es segura entre hilos (api/index.py puede atender peticiones en varios).
+    """
+
+    def __init__(self, size: int = DEDUP_WINDOW):
+        self.size = size
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    def seen(self, update_id) -> bool:
+        """Devuelve True si 'update_id' ya estaba en la ventana; si no, lo registra."""
+        if update_id is None: return False
+        with self._lock:
+            if update_id in self._ids:
+                self.duplicates += 1
+                metrics.UPDATES_SKIPPED.inc(reason="duplicate")
+                return True
+            self._ids[update_id] = None
+            while len(self._ids) > self.size:
+                self._ids.popitem(last=False)
+            return False
+
+    def forget(self, update_id):
+        """Saca un update de la ventana (p. ej. si falló) para que su reentrega sí se procese."""
+        with self._lock:
+            self._ids.pop(update_id, None)
+
+def chat_key(update):
+    """Chat al que pertenece el update (o el usuario si no hay chat); None si no tiene ninguno."""
+    chat = getattr(update, 'effective_chat', None)
+    if chat is not None: return chat.id
+    user = getattr(update, 'effective_user', None)
+    return user.id if user is not None else None
+
+def coalesce_key(update):
+    """
+    Para las pulsaciones de 'detail_' y 'sugg_', (datos del botón, mensaje): dos pulsaciones con la misma
+    clave son el mismo botón del mismo mensaje y basta con procesar la primera. Un botón distinto del
+    mismo mensaje ("Detallada" tras "Simple", otra sugerencia) se procesa. None para el resto.
+    """
+    query = getattr(update, 'callback_query', None)
+    if query is None or not query.data or query.message is None: return None
+    for prefix in COALESCED_CALLBACK_PREFIXES:
+        if query.data.startswith(prefix):
+            return query.data, query.message.message_id
+    return None
+
+class UpdateDispatcher:
+    """
+    Procesa updates de Telegram en tareas de fondo sobre un único event loop persistente.
+    'submit' devuelve al instante (el webhook puede responder 200 enseguida) y un semáforo
+    limita cuántos updates llegan a la vez a 'application.process_update'.
+
+    Los updates de un mismo chat se procesan en orden, de uno en uno, en una cola por chat (así no
+    compiten por el mismo estado del usuario); chats distintos siguen en paralelo. Los update_id
+    repetidos se descartan y las pulsaciones repetidas de 'detail_'/'sugg_' sobre el mismo mensaje
+    (el mismo botón) se fusionan con la que ya está en cola o en curso.
+    """
+
+    def __init__(self, application, max_concurrency: int = MAX_CONCURRENT_UPDATES, max_pending: int = MAX_PENDING_UPDATES,
+                 dedup_window: int = DEDUP_WINDOW):
+        self.application = application
+        self.max_pending = max_pending
+        self.recent = RecentUpdates(dedup_window)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._tasks = set()
+        # chat -> cola de updates pendientes; el chat tiene una tarea de fondo mientras su cola no esté vacía
+        self._queues = {}
+        # chat -> claves de fusión de los updates en cola o en curso
+        self._coalesce_keys = {}
+        self._pending = 0
+        self._accepting = True
+        self.processed = 0
+        self.failed = 0
+        self.coalesced = 0
+
+    @property
+    def in_flight(self) -> int:
+        return self._pending
+
+    @property
+    def duplicates(self) -> int:
+        return self.recent.duplicates
+
+    def submit(self, update, on_done=None) -> bool:
+        """
+        Programa el procesamiento de un update. Devuelve False si el servidor se está apagando
+        o hay demasiados updates pendientes; en ese caso el llamador debe pedir a Telegram que reintente.
+        Un update repetido o fusionado cuenta como aceptado (True) aunque no se procese.
+        Si se pasa 'on_done(update)', se llama cuando el update termina (haya fallado o no) o en el acto
+        si se descarta; así api/polling.py solo confirma a Telegram los updates ya procesados.
+        """
+        if not self._accepting or self._pending >= self.max_pending:
+            return False
+        update_id = getattr(update, 'update_id', None)
+        if self.recent.seen(update_id):
+            logger.info(f"Update {update_id} repetido: se descarta.")
+            if on_done is not None: on_done(update)
+            return True
+
+        chat = chat_key(update)
+        key = coalesce_key(update)
+        if key is not None:
+            keys = self._coalesce_keys.setdefault(chat, set())
+            if key in keys:
+                self.coalesced += 1
+                metrics.UPDATES_SKIPPED.inc(reason="coalesced")
+                logger.info(f"Update {update_id} fusionado con otra pulsación de '{key[0]}' en el chat {chat}.")
+                self._spawn(self._dismiss(update))
+                if on_done is not None: on_done(update)
+                return True
+            keys.add(key)
+
+        self._pending += 1
+        if chat is None:
+            self._spawn(self._run_one(update, None, key, on_done))
+            return True
+        queue = self._queues.get(chat)
+        if queue is None:
+            queue = self._queues[chat] = deque()
+            self._spawn(self._run_chat(chat, queue))
+        queue.append((update, key, on_done))
+        return True
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_chat(self, chat, queue: deque):
+        """Procesa la cola de un chat en orden y termina cuando se vacía."""
+        try:
+            while queue:
+                update, key, on_done = queue[0]
+                try:
+                    await self._run_one(update, chat, key, on_done)
+                finally:
+                    queue.popleft()
+        finally:
+            if self._queues.get(chat) is queue: del self._queues[chat]
+            # Si se canceló a medias (al apagar), los que quedaban en cola ya no cuentan como pendientes
+            self._pending -= len(queue)
+
+    async def _run_one(self, update, chat, key, on_done=None):
+        try:
+            await self._process(update)
+            # Uno cancelado al apagar no cuenta como terminado: Telegram lo volverá a entregar
+            if on_done is not None: on_done(update)
+        finally:
+            self._pending -= 1
+            if key is not None: self._release_key(chat, key)
+
+    def _release_key(self, chat, key):
+        keys = self._coalesce_keys.get(chat)
+        if keys is None: return
+        keys.discard(key)
+        if not keys: del self._coalesce_keys[chat]
+
+    async def _dismiss(self, update):
+        """Responde a la pulsación fusionada para que Telegram deje de mostrar el reloj en el botón."""
+        try:
+            await update.callback_query.answer()
+        except Exception as e:
+            logger.debug(f"No se pudo responder a la pulsación fusionada: {e}")
+
+    async def _process(self, update):
+        async with self._semaphore:
+            try:
+                with metrics.bind(update_id=getattr(update, 'update_id', None)), metrics.span("process_update"):
+                    await self.application.process_update(update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                # Un update que falló puede procesarse si Telegram lo vuelve a entregar
+                self.recent.forget(getattr(update, 'update_id', None))
+                logger.error(f"Error procesando el update {getattr(update, 'update_id', '?')}: {e}", exc_info=True)
+
+    def stats(self) -> dict:
+        return {"processed": self.processed, "failed": self.failed, "duplicates": self.duplicates,
+                "coalesced": self.coalesced, "pending": self._pending, "chats": len(self._queues)}
+
+    async def drain(self, timeout: float = DRAIN_TIMEOUT):
+        """Deja de aceptar updates y espera a que terminen los que están en curso."""
+        self._accepting = False
+        if not self._tasks: return
+        logger.info(f"Esperando a {self._pending} updates en curso antes de apagar...")
+        done, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(f"{len(pending)} tareas no terminaron a tiempo y se cancelaron.")
@@ -0,0 +1,248 @@
+# bot_logic/extractors.py
+
+import os
+import logging
+import importlib
+import importlib.util
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from bot_logic import metrics
+
+# Backend opcional para PDF y EPUB. Solo se comprueba si está instalado; se importa al usarlo.
+HAS_PYMUPDF = importlib.util.find_spec("pymupdf") is not None
+
+# Obtenemos una instancia del logger para este módulo
+logger = logging.getLogger(__name__)
+
+# Backend por formato, p. ej. EXTRACTOR_BACKENDS="pdf=pymupdf,epub=pymupdf".
+# Por defecto se usan las librerías de siempre (PyPDF2 y ebooklib).
+BACKENDS = dict(item.split("=", 1) for item in os.getenv("EXTRACTOR_BACKENDS", "").replace(" ", "").split(",") if "=" in item)
+# Los PDF con al menos estas páginas se extraen en paralelo en un pool de procesos (0 lo desactiva).
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", 64))
+PDF_PARALLEL_WORKERS = int(os.getenv("PDF_PARALLEL_WORKERS", os.cpu_count() or 1))
+PDF_PAGES_PER_TASK = 16
+# Bloques de páginas encargados a la vez: los resultados que aún no se han consumido ocupan memoria.
+PDF_MAX_IN_FLIGHT = PDF_PARALLEL_WORKERS * 2
+TXT_BLOCK_CHARS = 1024 * 1024
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+# Librerías de extracción ya importadas (ver _library)
+_loaded = {}
+
+def _library(name: str):
+    """
+    Importa la librería de un formato la primera vez que se necesita (PyPDF2, ebooklib, bs4, docx,
+    pymupdf). La mayoría de updates (/start, categorías, paginación) no extraen texto, y así el
+    arranque en frío de cada instancia no paga estas importaciones.
+    """
+    module = _loaded.get(name)
+    if module is None:
+        with metrics.span("import_library", library=name):
+            module = _loaded[name] = importlib.import_module(name)
+    return module
+
+def _get_process_pool():
+    """
+    Pool de procesos para los PDF grandes. Se crea la primera vez desde un hilo de 'asyncio.to_thread'
+    de un proceso con el event loop, httpx y sqlite en marcha: con 'fork' los hijos podrían heredar
+    bloqueos tomados por otros hilos y quedarse colgados, así que se usa 'spawn' (como los workers de
+    bot_logic/sharding.py).
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(max_workers=PDF_PARALLEL_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _process_pool
+
+def _with_offsets(parts, separator: str = "", skip_empty: bool = False):
+    """
+    Convierte un iterable de trozos de texto en pares (desplazamiento, texto) según su posición
+    en el texto final, que es la concatenación de cada trozo seguido de 'separator'.
+    """
+    offset = 0
+    for part in parts:
+        if skip_empty and not part: continue
+        yield offset, part
+        offset += len(part) + len(separator)
+
+# ===================== EXTRACCIÓN POR PÁGINAS / SECCIONES =====================
+def _pdf_page_count(file_path: str, backend: str) -> int:
+    if backend == "pymupdf":
+        with _library("pymupdf").open(file_path) as pdf: return pdf.page_count
+    with open(file_path, "rb") as f:
+        return len(_library("PyPDF2").PdfReader(f).pages)
+
+def _pdf_page_range(file_path: str, backend: str, start: int, stop: int) -> list:
+    """Trabajo de cada proceso: extrae el texto de las páginas [start, stop)."""
+    if backend == "pymupdf":
+        with _library("pymupdf").open(file_path) as pdf:
+            return [pdf[i].get_text() or "" for i in range(start, stop)]
+    with open(file_path, "rb") as f:
+        reader = _library("PyPDF2").PdfReader(f)
+        return [reader.pages[i].extract_text() or "" for i in range(start, stop)]
+
+def iter_pdf_pages(file_path: str, backend: str = None):
+    """
+    Genera el texto de cada página en orden. Los PDF grandes se reparten por bloques de páginas
+    entre procesos; los resultados se siguen entregando en orden según van llegando, y como mucho hay
+    PDF_MAX_IN_FLIGHT bloques encargados a la vez (no se encarga el libro entero de golpe).
+    """
+    backend = backend or BACKENDS.get("pdf", "pypdf2")
+    if backend == "pymupdf" and not HAS_PYMUPDF:
+        logger.warning("PyMuPDF no está instalado. Se usará PyPDF2 para los PDF.")
+        backend = "pypdf2"
+    page_count = _pdf_page_count(file_path, backend)
+    if PDF_PARALLEL_WORKERS > 1 and PDF_PARALLEL_MIN_PAGES and page_count >= PDF_PARALLEL_MIN_PAGES:
+        pool = _get_process_pool()
+        pending = deque()
+        try:
+            for start in range(0, page_count, PDF_PAGES_PER_TASK):
+                pending.append(pool.submit(_pdf_page_range, file_path, backend, start, min(start + PDF_PAGES_PER_TASK, page_count)))
+                if len(pending) >= PDF_MAX_IN_FLIGHT: yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+        finally:
+            # Si se deja de leer a medias (o falla un bloque), lo que aún no empezó no se ejecuta
+            for future in pending: future.cancel()
+        return
+    if backend == "pymupdf":
+        with _library("pymupdf").open(file_path) as pdf:
+            for page in pdf:
+                yield page.get_text() or ""
+        return
+    with open(file_path, "rb") as f:
+        for page in _library("PyPDF2").PdfReader(f).pages:
+            yield page.extract_text() or ""
+
+def iter_epub_sections(file_path: str, backend: str = None):
+    backend = backend or BACKENDS.get("epub", "ebooklib")
+    if backend == "pymupdf" and HAS_PYMUPDF:
+        with _library("pymupdf").open(file_path) as book:
+            for page in book:
+                yield page.get_text()
+        return
+    ebooklib, BeautifulSoup = _library("ebooklib"), _library("bs4").BeautifulSoup
+    book = _library("ebooklib.epub").read_epub(file_path)
+    for item in book.get_items_of_type(ebooklib.ITEM_DOCUMENT):
+        yield BeautifulSoup(item.get_content(), "html.parser").get_text(separator=" ", strip=True)
+
+def iter_docx_paragraphs(file_path: str):
+    for para in _library("docx").Document(file_path).paragraphs:
+        yield para.text
+
+def iter_txt_blocks(file_path: str):
+    with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
+        while (block := f.read(TXT_BLOCK_CHARS)):
+            yield block
+
+def iter_sections(file_path: str):
+    """
+    API por secciones: genera pares (desplazamiento, texto) con cada página (PDF), documento
+    interno (EPUB), párrafo (DOCX) o bloque (TXT/HTML). Unir las secciones con el separador de su
+    formato da exactamente el mismo texto que la función '*_to_text' correspondiente.
+    """
+    ext = os.path.splitext(file_path.lower())[1]
+    if ext == ".pdf":
+        yield from _with_offsets(iter_pdf_pages(file_path), "\n", skip_empty=True)
+    elif ext == ".epub":
+        yield from _with_offsets(iter_epub_sections(file_path), "\n\n")
+    elif ext == ".docx":
+        yield from _with_offsets(iter_docx_paragraphs(file_path), "\n")
+    elif ext == ".txt":
+        yield from _with_offsets(iter_txt_blocks(file_path))
+    elif ext == ".html":
+        yield 0, html_to_text(file_path) or ""
+
+def _pdf_pieces(file_path: str, backend: str):
+    for page in iter_pdf_pages(file_path, backend):
+        if page:
+            yield page
+            yield "\n"
+
+def _joined(parts, separator: str):
+    """Trozos de 'separator.join(parts)', sin construir el texto entero."""
+    for i, part in enumerate(parts):
+        if i: yield separator
+        yield part
+
+# ===================== FUNCIONES DE EXTRACCIÓN DE TEXTO (Completas) =====================
+def epub_to_text(file_path):
+    try:
+        return "".join(_joined(iter_epub_sections(file_path, "ebooklib"), "\n\n"))
+    except Exception as e:
+        logger.error(f"Error procesando EPUB '{file_path}': {e}")
+        return None
+
+def epub_to_text_pymupdf(file_path):
+    try:
+        return "".join(_joined(iter_epub_sections(file_path, "pymupdf"), "\n\n"))
+    except Exception as e:
+        logger.error(f"Error procesando EPUB '{file_path}' con PyMuPDF: {e}")
+        return None
+
+def pdf_to_text(file_path):
+    # Se junta una sola vez al final en vez de concatenar página a página (coste cuadrático)
+    try:
+        return "".join(_pdf_pieces(file_path, "pypdf2"))
+    except Exception as e:
+        logger.error(f"Error procesando PDF '{file_path}': {e}")
+        return None
+
+def pdf_to_text_pymupdf(file_path):
+    try:
+        return "".join(_pdf_pieces(file_path, "pymupdf"))
+    except Exception as e:
+        logger.error(f"Error procesando PDF '{file_path}' con PyMuPDF: {e}")
+        return None
+
+def txt_to_text(file_path):
+    try:
+        with open(file_path, "r", encoding="utf-8", errors="ignore") as f: return f.read()
+    except Exception as e:
+        logger.error(f"Error leyendo TXT '{file_path}': {e}")
+        return None
+
+def html_to_text(file_path):
+    try:
+        with open(file_path, "r", encoding="utf-8", errors="ignore") as f: return _library("bs4").BeautifulSoup(f.read(), "html.parser").get_text(separator=" ", strip=True)
+    except Exception as e:
+        logger.error(f"Error procesando HTML '{file_path}': {e}")
+        return None
+
+def docx_to_text(file_path):
+    try:
+        return "".join(_joined(iter_docx_paragraphs(file_path), "\n"))
+    except Exception as e:
+        logger.error(f"Error procesando DOCX '{file_path}': {e}")
+        return None
+
+# Extensión -> función de extracción. Las claves son también las extensiones válidas de la biblioteca.
+# Cada backend tiene su propia función, así la caché de texto (que usa su nombre) no mezcla resultados.
+PROCESSORS = {
+    ".pdf": pdf_to_text_pymupdf if BACKENDS.get("pdf") == "pymupdf" and HAS_PYMUPDF else pdf_to_text,
+    ".epub": epub_to_text_pymupdf if BACKENDS.get("epub") == "pymupdf" and HAS_PYMUPDF else epub_to_text,
+    ".txt": txt_to_text,
+    ".html": html_to_text,
+    ".docx": docx_to_text,
+}
+VALID_EXTENSIONS = set(PROCESSORS)
+
+# Extractor -> generador de trozos de su mismo texto, en orden (las secciones de 'iter_sections' con
+# sus separadores). La caché de texto y el índice BM25 los consumen según llegan, así el texto no se
+# junta hasta el final. HTML no tiene versión por trozos: BeautifulSoup necesita el documento entero.
+STREAMS = {
+    pdf_to_text: lambda file_path: _pdf_pieces(file_path, "pypdf2"),
+    pdf_to_text_pymupdf: lambda file_path: _pdf_pieces(file_path, "pymupdf"),
+    epub_to_text: lambda file_path: _joined(iter_epub_sections(file_path, "ebooklib"), "\n\n"),
+    epub_to_text_pymupdf: lambda file_path: _joined(iter_epub_sections(file_path, "pymupdf"), "\n\n"),
+    docx_to_text: lambda file_path: _joined(iter_docx_paragraphs(file_path), "\n"),
+    txt_to_text: iter_txt_blocks,
+}
+
+def get_processor(file_path):
+    """Devuelve la función de extracción para el archivo según su extensión, o None si no está soportada."""
+    return PROCESSORS.get(os.path.splitext(file_path.lower())[1])
@@ -1,24 +1,36 @@
 # bot_logic/handlers.py
 
 import os
+import asyncio
 import logging
-import re
 import math
-import google.generativeai as genai
-import ebooklib
+import functools
+import time
+import ssl
+import certifi
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
 from telegram.constants import ParseMode
-from telegram.error import TelegramError, BadRequest
-from ebooklib import epub
-import PyPDF2
+from telegram.error import BadRequest
+from telegram.request import HTTPXRequest
 from dotenv import load_dotenv
-from bs4 import BeautifulSoup
-import docx
-from google.api_core.exceptions import PermissionDenied, InvalidArgument
 
 # Importamos nuestro nuevo gestor de estado
 from bot_logic import state_manager
+from bot_logic import text_cache
+from bot_logic import retrieval
+from bot_logic import library_artifact
+from bot_logic.llm_pool import GeminiClientPool
+from bot_logic.streaming import ProgressiveReply
+from bot_logic import renderer
+from bot_logic import answer_cache
+from bot_logic import metrics
+from bot_logic.catalog import LibraryCatalog
+from bot_logic.context_cache import ContextCacheManager, CacheablePrefix, CONTEXT_CACHE_ENABLED
+from bot_logic.ingest import UploadStore, IngestQueue
+from bot_logic.scheduler import FairScheduler, RateLimitedError, QueueFullError
+from bot_logic.speculative import SpeculativePrefetcher, SPECULATIVE_ENABLED
+from bot_logic.extractors import PROCESSORS, VALID_EXTENSIONS, get_processor
 
 # ===================== CONFIGURACIÓN Y LOGGING =====================
 logging.basicConfig(
@@ -37,95 +49,101 @@ if not TELEGRAM_TOKEN: raise ValueError("⚠️ TELEGRAM_TOKEN no encontrado.")
 if not api_keys: raise ValueError("⚠️ No se encontró ninguna GOOGLE_API_KEY.")
 
 logger.info(f"✅ Se encontraron {len(api_keys)} claves API de Google para utilizar.")
+# Caché de contexto de Gemini para los libros de la biblioteca (CONTEXT_CACHE=1)
+context_cache = ContextCacheManager() if CONTEXT_CACHE_ENABLED else None
+llm_pool = GeminiClientPool(api_keys, context_cache=context_cache)
+# Turnos justos entre usuarios para las llamadas a Gemini (límite global, por usuario y por nivel de detalle)
+llm_scheduler = FairScheduler()
+# Se resuelve en cada lectura, así sigue valiendo si se sustituye 'llm_pool' (p. ej. en bench/)
+metrics.register_collector(lambda: llm_pool.metric_samples())
+metrics.register_collector(lambda: [
+    (f"bot_context_cache_{name}", "gauge" if name == "entries" else "counter", f"Caché de contexto de Gemini: {name}.", [({}, value)])
+    for name, value in (llm_pool.context_cache.stats().items() if llm_pool.context_cache else ())
+])
+metrics.register_collector(lambda: [
+    ("bot_llm_scheduler_calls", "gauge", "Llamadas a Gemini en curso y en cola en el planificador.",
+     [({"state": "running"}, llm_scheduler.stats()["running"]), ({"state": "queued"}, llm_scheduler.stats()["queued"])]),
+])
+# Respuestas de las preguntas sugeridas preparadas de fondo (SPECULATIVE_ANSWERS=1)
+speculative = SpeculativePrefetcher() if SPECULATIVE_ENABLED else None
 
 preloaded_library = {}
 BOOKS_DIR = "books"
 BOOKS_PER_PAGE = 5
 MAX_CHARS = 4000000
 TELEGRAM_MSG_LIMIT = 4096
-
-# ===================== FUNCIONES DE EXTRACCIÓN DE TEXTO (Completas) =====================
-def epub_to_text(file_path):
-    try:
-        book = epub.read_epub(file_path)
-        text_parts = [BeautifulSoup(item.get_content(), "html.parser").get_text(separator=" ", strip=True) for item in book.get_items_of_type(ebooklib.ITEM_DOCUMENT)]
-        return "\n\n".join(text_parts)
-    except Exception as e:
-        logger.error(f"Error procesando EPUB '{file_path}': {e}")
-        return None
-
-def pdf_to_text(file_path):
-    text = ""
-    try:
-        with open(file_path, "rb") as f:
-            reader = PyPDF2.PdfReader(f)
-            for page in reader.pages:
-                if (extracted := page.extract_text()): text += extracted + "\n"
-        return text
-    except Exception as e:
-        logger.error(f"Error procesando PDF '{file_path}': {e}")
-        return None
-
-def txt_to_text(file_path):
-    try:
-        with open(file_path, "r", encoding="utf-8", errors="ignore") as f: return f.read()
-    except Exception as e:
-        logger.error(f"Error leyendo TXT '{file_path}': {e}")
-        return None
-
-def html_to_text(file_path):
-    try:
-        with open(file_path, "r", encoding="utf-8", errors="ignore") as f: return BeautifulSoup(f.read(), "html.parser").get_text(separator=" ", strip=True)
-    except Exception as e:
-        logger.error(f"Error procesando HTML '{file_path}': {e}")
-        return None
-
-def docx_to_text(file_path):
-    try:
-        doc = docx.Document(file_path)
-        full_text = [para.text for para in doc.paragraphs]
-        return '\n'.join(full_text)
-    except Exception as e:
-        logger.error(f"Error procesando DOCX '{file_path}': {e}")
-        return None
-
+SUGGESTIONS_SEPARATOR = "###PREGUNTAS_SUGERIDAS###"
+# Con STREAM_ANSWERS=1 la respuesta se muestra progresivamente mientras la genera Gemini
+STREAM_ANSWERS = os.getenv("STREAM_ANSWERS", "1") == "1"
+# Artefacto generado con `python -m bot_logic.library_artifact` (opcional)
+LIBRARY_ARTIFACT_DIR = os.getenv("LIBRARY_ARTIFACT_DIR", "library_artifact")
+# Documentos de una categoría que se leen y consultan a la vez al preguntar a toda la categoría
+CATEGORY_SEARCH_CONCURRENCY = int(os.getenv("CATEGORY_SEARCH_CONCURRENCY", 4))
+# Bot API alternativo (un servidor Bot API local o el falso de bench/); por defecto api.telegram.org
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL")
+
+# ===================== BIBLIOTECA Y LECTURA DE LIBROS =====================
 def scan_books_directory():
-    logger.info(f"Escaneando biblioteca en: '{BOOKS_DIR}'...")
+    """Sincroniza el catálogo con BOOKS_DIR; solo se reescanean las categorías que cambiaron."""
     if not os.path.exists(BOOKS_DIR):
         logger.warning(f"El directorio '{BOOKS_DIR}' no fue encontrado. Creándolo.")
         os.makedirs(BOOKS_DIR)
         return
+    changed = catalog.refresh()
+    if not changed: return
     preloaded_library.clear()
-    valid_extensions = {".pdf", ".epub", ".txt", ".html", ".docx"}
-    for category_name in sorted(os.listdir(BOOKS_DIR)):
-        category_path = os.path.join(BOOKS_DIR, category_name)
-        if os.path.isdir(category_path):
-            books_in_category = [filename for filename in sorted(os.listdir(category_path)) if os.path.splitext(filename.lower())[1] in valid_extensions]
-            if books_in_category: preloaded_library[category_name] = books_in_category
+    preloaded_library.update((name, [meta.filename for meta in catalog.books(name)]) for name in catalog.category_names())
     if not preloaded_library:
         logger.info("No se encontraron categorías con libros válidos.")
     else:
         logger.info(f"Biblioteca local cargada con {len(preloaded_library)} categorías.")
 
+def _ingest_book(book_path: str):
+    """Trabajo de la cola de ingesta: extrae el texto (queda en caché) y construye su índice."""
+    doc_key, book_text = load_book(book_path)
+    if book_text: retrieval.get_index(doc_key, book_text)
+
+def load_book(book_path: str):
+    """
+    Devuelve (doc_key, texto) del libro. Los libros precargados se leen del artefacto mmap
+    si está disponible y actualizado; el resto pasa por la caché de texto extraído.
+    """
+    doc_key = text_cache.file_content_hash(book_path)
+    artifact_doc = library.lookup(book_path, doc_key) if library else None
+    if artifact_doc:
+        retrieval.register_index(doc_key, artifact_doc.index())
+        return doc_key, artifact_doc.text()
+    ext = os.path.splitext(book_path.lower())[1]
+    # Si hay que extraer el texto, el índice BM25 se construye a la vez con los mismos trozos
+    builder = None if retrieval.has_index(doc_key) else retrieval.BM25Builder()
+    book_text = text_cache.get_text(book_path, PROCESSORS[ext], sink=builder.feed if builder else None)
+    if book_text and builder is not None and builder.fed:
+        index = builder.finish()
+        logger.info(f"Índice BM25 construido al extraer {doc_key[:12]}: {index.num_chunks} fragmentos, {len(index.vocab)} términos.")
+        retrieval.register_index(doc_key, index)
+    return doc_key, book_text
+
 # ===================== FUNCIONES DE AYUDA =====================
-async def send_final_message(context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str, reply_markup: InlineKeyboardMarkup = None):
-    try:
-        await context.bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-    except BadRequest as e:
-        if "Can't parse entities" in str(e):
-            logger.warning("Fallo en parseo de Markdown. Reenviando como texto plano.")
-            await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
-        else: raise e
+def _visible_answer(partial_text: str) -> str:
+    """Parte de una respuesta en curso que se puede enseñar: sin las preguntas sugeridas ni un separador a medias."""
+    visible = partial_text.split(SUGGESTIONS_SEPARATOR, 1)[0]
+    # Si el texto termina con el principio del separador (p. ej. '###PREG'), todavía no lo enseñamos
+    for i in range(min(len(SUGGESTIONS_SEPARATOR), len(visible)), 0, -1):
+        if visible.endswith(SUGGESTIONS_SEPARATOR[:i]):
+            visible = visible[:-i]
+            break
+    return visible.rstrip()
 
 def _build_paginated_book_list(category_name: str, page: int):
-    books_in_category = preloaded_library.get(category_name, [])
+    # Todo sale del catálogo en memoria: paginar no toca el sistema de archivos
+    books_in_category = catalog.books(category_name)
     if not books_in_category: return "⚠️ Esta categoría está vacía o ya no existe.", None
     total_pages = math.ceil(len(books_in_category) / BOOKS_PER_PAGE)
     start_index = page * BOOKS_PER_PAGE; end_index = start_index + BOOKS_PER_PAGE
-    keyboard = []
+    keyboard = [[InlineKeyboardButton("🔎 Preguntar a toda la categoría", callback_data=f"askcat_{category_name}")]]
     for i in range(start_index, end_index):
         if i < len(books_in_category):
-            filename = books_in_category[i]
+            filename = books_in_category[i].filename
             keyboard.append([InlineKeyboardButton(f"📖 {filename}", callback_data=f"select_{category_name}_{i}")])
     pagination_row = []
     if page > 0: pagination_row.append(InlineKeyboardButton("⬅️ Anterior", callback_data=f"page_{category_name}_{page - 1}"))
@@ -133,7 +151,7 @@ def _build_paginated_book_list(category_name: str, page: int):
     if end_index < len(books_in_category): pagination_row.append(InlineKeyboardButton("Siguiente ➡️", callback_data=f"page_{category_name}_{page + 1}"))
     keyboard.append(pagination_row)
     keyboard.append([InlineKeyboardButton("⬅️ Volver a Categorías", callback_data="back_to_categories")])
-    message_text = f"📖 *Libros en '{category_name}':*\n\nSelecciona un libro para cargarlo."
+    message_text = f"📖 *Libros en '{category_name}':*\n\nSelecciona un libro para cargarlo o pregunta a toda la categoría."
     return message_text, InlineKeyboardMarkup(keyboard)
 
 # ===================== HANDLERS DE TELEGRAM (ADAPTADOS PARA STATE_MANAGER) =====================
@@ -169,19 +187,30 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⚠️ No se ha podido obtener el archivo.")
         return
     
-    # En Vercel, los archivos temporales se guardan en /tmp
-    file_path = f"/tmp/{document.file_id}_{document.file_name}"
+    if get_processor(document.file_name or "") is None:
+        await update.message.reply_text("⚠️ Formato no soportado. Envía un PDF, DOCX, EPUB, TXT o HTML.")
+        return
     
     processing_message = await update.message.reply_text("⏳ Procesando tu archivo...")
     
     try:
-        file = await document.get_file()
-        await file.download_to_drive(custom_path=file_path)
+        async def download(path):
+            file = await document.get_file()
+            await file.download_to_drive(custom_path=path)
+
+        # Si este mismo archivo ya se subió antes (o se está descargando), no se vuelve a descargar.
+        # En Vercel, los archivos temporales se guardan en /tmp
+        file_path = await upload_store.obtain(document.file_unique_id, document.file_name, download, holder=user_id)
+        
+        # El texto y el índice se preparan ya en segundo plano, no en la primera pregunta
+        ingest_queue.enqueue(file_path)
         
         # Guardamos la RUTA del archivo en el estado del usuario
-        state = state_manager.load_state(user_id)
-        state['current_book_path'] = file_path
-        state_manager.save_state(user_id, state)
+        async with state_manager.edit_state(user_id) as state:
+            state['current_book_path'] = file_path
+            state.pop('current_category', None)
+        # Las respuestas que se preparaban eran del documento anterior
+        if speculative: speculative.cancel_user(user_id)
         
         await processing_message.edit_text(f"✅ Archivo '{document.file_name}' cargado. ¡Ya puedes preguntar!")
         logger.info(f"Archivo '{document.file_name}' guardado para {user_id} en {file_path}")
@@ -228,39 +257,67 @@ async def handle_book_selection(update: Update, context: ContextTypes.DEFAULT_TY
     try:
         _, category_name, book_index_str = query.data.split('_', 2)
         book_index = int(book_index_str)
-        filename = preloaded_library[category_name][book_index]
+        filename = catalog.books(category_name)[book_index].filename
     except (ValueError, KeyError, IndexError):
         await query.edit_message_text("⚠️ Selección inválida.")
         return
     
     # Guardamos la RUTA del libro precargado en el estado del usuario
     file_path = os.path.join(BOOKS_DIR, category_name, filename)
-    state = state_manager.load_state(user_id)
-    state['current_book_path'] = file_path
-    state_manager.save_state(user_id, state)
+    async with state_manager.edit_state(user_id) as state:
+        state['current_book_path'] = file_path
+        state.pop('current_category', None)
+    # Su subida anterior, si la tenía, ya se puede borrar al aplicar la cuota
+    upload_store.hold(user_id, None)
+    if speculative: speculative.cancel_user(user_id)
     
     logger.info(f"Usuario {user_id} seleccionó: '{filename}'.")
     await query.edit_message_text(f"✅ Libro '{filename}' seleccionado. ¡Ya puedes preguntar!")
 
+async def handle_category_ask(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Las siguientes preguntas se responden con todos los libros de la categoría, no con uno solo."""
+    query = update.callback_query
+    await query.answer()
+    user_id = query.from_user.id
+    category_name = query.data.split('askcat_', 1)[1]
+    books_in_category = catalog.books(category_name)
+    if not books_in_category:
+        await query.edit_message_text("⚠️ Esta categoría está vacía o ya no existe.")
+        return
+
+    async with state_manager.edit_state(user_id) as state:
+        state['current_category'] = category_name
+        state.pop('current_book_path', None)
+    upload_store.hold(user_id, None)
+    if speculative: speculative.cancel_user(user_id)
+
+    logger.info(f"Usuario {user_id} seleccionó la categoría completa: '{category_name}'.")
+    await query.edit_message_text(f"✅ Categoría '{category_name}' seleccionada ({len(books_in_category)} documentos). ¡Ya puedes preguntar!")
+
 async def ask_question_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    state = state_manager.load_state(user_id)
-    
-    if 'current_book_path' not in state or not os.path.exists(state['current_book_path']):
+    question = update.message.text
+    metrics.log_event("question", user_id=user_id, question_chars=len(question))
+    async with state_manager.edit_state(user_id) as state:
+        has_book = bool(catalog.books(state['current_category'])) if 'current_category' in state else (
+            'current_book_path' in state and os.path.exists(state['current_book_path']))
+        if has_book: state['last_question'] = question
+
+    if not has_book:
         await update.message.reply_text("⚠️ Primero debes subir o seleccionar un archivo.")
         return
-        
-    question = update.message.text
-    state['last_question'] = question
-    state_manager.save_state(user_id, state)
+    # Ha preguntado otra cosa: las sugeridas que aún se preparan ya no hacen falta
+    if speculative: speculative.cancel_user(user_id)
     
     logger.info(f"Usuario {user_id} preguntó: '{question}'")
     keyboard = [[InlineKeyboardButton("🎯 Simple", callback_data="detail_simple"), InlineKeyboardButton("📚 Detallada", callback_data="detail_detailed")]]
-    await update.message.reply_text('¿Cómo prefieres la respuesta?', reply_markup=InlineKeyboardMarkup(keyboard))
+    with metrics.span("send_detail_prompt"):
+        await update.message.reply_text('¿Cómo prefieres la respuesta?', reply_markup=InlineKeyboardMarkup(keyboard))
 
 async def handle_detail_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
+    with metrics.span("answer_callback"):
+        await query.answer()
     user_id = query.from_user.id
     
     state = state_manager.load_state(user_id)
@@ -273,7 +330,8 @@ async def handle_detail_choice(update: Update, context: ContextTypes.DEFAULT_TYP
         
     target_message = None
     try:
-        await query.edit_message_text("🧠 Analizando tu pregunta...", reply_markup=None)
+        with metrics.span("send_analyzing"):
+            await query.edit_message_text("🧠 Analizando tu pregunta...", reply_markup=None)
         target_message = query.message
     except BadRequest as e:
         if "not found" in str(e).lower():
@@ -283,7 +341,8 @@ async def handle_detail_choice(update: Update, context: ContextTypes.DEFAULT_TYP
 
     if target_message:
         logger.info(f"Usuario {user_id} eligió detalle '{detail_level}' para: '{question}'")
-        await _generate_and_send_answer(target_message, user_id, question, detail_level, context)
+        with metrics.bind(user_id=user_id, detail_level=detail_level), metrics.span("generate_and_send_answer"):
+            await _generate_and_send_answer(target_message, user_id, question, detail_level, context)
 
 async def handle_suggested_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -303,35 +362,35 @@ async def handle_suggested_question(update: Update, context: ContextTypes.DEFAUL
     except BadRequest as e:
         logger.warning(f"No se pudieron quitar los botones: {e}")
 
-    state['last_question'] = question
-    state_manager.save_state(user_id, state)
+    async with state_manager.edit_state(user_id) as state:
+        state['last_question'] = question
+    # Se sigue preparando solo la respuesta de la sugerida elegida
+    if speculative:
+        chosen = answer_cache.normalize_question(question)
+        speculative.cancel_user(user_id, keep=lambda key: key[1] == chosen)
     
     logger.info(f"Usuario {user_id} eligió pregunta: '{question}'")
     keyboard = [[InlineKeyboardButton("🎯 Simple", callback_data="detail_simple"), InlineKeyboardButton("📚 Detallada", callback_data="detail_detailed")]]
-    await query.message.reply_text(f"Nueva pregunta:\n*\"{question}\"*\n\n¿Cómo prefieres la respuesta?", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
+    # La pregunta sugerida la escribió el modelo: se escapa para que no rompa el formato
+    await query.message.reply_text(f"Nueva pregunta:\n*\"{renderer.escape(question)}\"*\n\n¿Cómo prefieres la respuesta?", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN_V2)
 
-async def _generate_and_send_answer(target_message, user_id, question, detail_level, context):
-    state = state_manager.load_state(user_id)
-    book_path = state.get('current_book_path')
-    
-    if not book_path or not os.path.exists(book_path):
-        await target_message.edit_text("⚠️ No encuentro el libro cargado. Por favor, súbelo o selecciónalo de nuevo.")
-        return
-        
-    # Leemos el texto del libro desde el archivo en cada pregunta
-    ext = os.path.splitext(book_path.lower())[1]
-    processors = {".pdf": pdf_to_text, ".epub": epub_to_text, ".txt": txt_to_text, ".html": html_to_text, ".docx": docx_to_text}
-    book_text = processors[ext](book_path)
+DETAIL_INSTRUCTIONS = {"simple": "explica de forma muy concisa, en uno o dos párrafos.", "detailed": """Es crucial que la respuesta sea profunda y exhaustiva. Busca en el texto múltiples puntos de vista, ejemplos, definiciones y contexto relacionado para construir tu respuesta. La respuesta no debe ser un simple resumen; debe tener varios párrafos y explorar el tema a fondo, utilizando toda la información relevante disponible en el documento."""}
 
-    if not book_text:
-        await target_message.edit_text("⚠️ No se pudo leer el contenido del libro seleccionado.")
-        return
+CITATION_RULE = """
+    **Regla de Fuentes:** El contenido viene de varios documentos y cada bloque empieza con el nombre de su archivo entre corchetes. Indica entre corchetes de qué archivo sale cada dato de tu respuesta, por ejemplo [Tema IV.-Prevención.docx].
+    """
 
-    detail_instructions = {"simple": "explica de forma muy concisa, en uno o dos párrafos.", "detailed": """Es crucial que la respuesta sea profunda y exhaustiva. Busca en el texto múltiples puntos de vista, ejemplos, definiciones y contexto relacionado para construir tu respuesta. La respuesta no debe ser un simple resumen; debe tener varios párrafos y explorar el tema a fondo, utilizando toda la información relevante disponible en el documento."""}
-    
-    prompt = f"""
-    Eres un tutor experto del documento proporcionado. Tu misión es responder a las preguntas del usuario basándote ESTRICTAMENTE en esa información brinda la informacion estructurada de una forma visual por encabezados y usando emojis.
-    **Regla de Detalle:** El usuario ha pedido una respuesta '{detail_level}'. Debes {detail_instructions[detail_level]}
+def build_prompt_prefix(document_context: str, citations: bool = False) -> str:
+    """
+    Parte estable del prompt: primero el documento y después las reglas que no dependen de la pregunta.
+    Es idéntica en todas las preguntas sobre el mismo contexto, así Gemini puede reutilizarla (caché de contexto).
+    Con 'citations' el contexto trae fragmentos de varios documentos y se pide citar el archivo de cada dato.
+    """
+    return f"""
+    --- INICIO DEL CONTENIDO DEL DOCUMENTO ---
+    {document_context}
+    --- FIN DEL CONTENIDO DEL DOCUMENTO ---
+    Eres un tutor experto del documento anterior (puede que recibas solo los fragmentos del documento más relevantes para la pregunta). Tu misión es responder a las preguntas del usuario basándote ESTRICTAMENTE en esa información brinda la informacion estructurada de una forma visual por encabezados y usando emojis.
     **Regla de Contenido:** Si la pregunta no se puede responder con el documento, responde amablemente que no encuentras la información.
     **Regla de Formato OBLIGATORIA:** Tu respuesta DEBE seguir esta estructura exacta:
     1.  La respuesta a la pregunta del usuario.
@@ -342,46 +401,177 @@ async def _generate_and_send_answer(target_message, user_id, question, detail_le
     ###PREGUNTAS_SUGERIDAS###
     ¿Cuáles son las subcapas de la dermis?
     ¿Qué función tienen los fibroblastos?
-    --- INICIO DEL CONTENIDO DEL DOCUMENTO ---
-    {book_text}
-    --- FIN DEL CONTENIDO DEL DOCUMENTO ---
+    {CITATION_RULE if citations else ""}"""
+
+def build_prompt_suffix(question: str, detail_level: str) -> str:
+    """Parte variable del prompt: el nivel de detalle y la pregunta."""
+    return f"""
+    **Regla de Detalle:** El usuario ha pedido una respuesta '{detail_level}'. Debes {DETAIL_INSTRUCTIONS[detail_level]}
     **Pregunta del usuario:** {question}
     **Tu respuesta estructurada:**
     """
-    
-    response = None
-    last_error = None
-    
-    for i, api_key in enumerate(api_keys):
-        try:
-            logger.info(f"Intentando llamada a la API con la clave #{i+1}...")
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel("gemini-2.0-flash")
-            response = model.generate_content(prompt)
-            _ = response.text 
-            logger.info(f"✅ Éxito con la clave API #{i+1}.")
-            break
-        except (PermissionDenied, InvalidArgument) as e:
-            logger.warning(f"La clave API #{i+1} falló: {e}")
-            last_error = e
-            continue
-        except Exception as e:
-            logger.error(f"Error al generar contenido con la clave #{i+1}: {e}", exc_info=False)
-            last_error = e
-            break 
 
-    try:
-        if response is None:
-            raise Exception("No se pudo obtener una respuesta válida de la API.", last_error)
+def build_prompt(document_context: str, question: str, detail_level: str, citations: bool = False) -> str:
+    """Construye el prompt completo para Gemini: prefijo estable con el documento + sufijo con la pregunta."""
+    return build_prompt_prefix(document_context, citations) + build_prompt_suffix(question, detail_level)
 
-        full_text = response.text
-        logger.debug("Respuesta completa de la IA: %s", full_text)
-        
-        main_answer, suggested_questions = full_text, []
-        if "###PREGUNTAS_SUGERIDAS###" in full_text:
-            parts = full_text.split("###PREGUNTAS_SUGERIDAS###")
-            main_answer = parts[0].strip()
-            suggested_questions = [q.strip() for q in parts[1].strip().split('\n') if q.strip() and len(q) > 1]
+def cacheable_prefix(book_path: str, doc_key: str, book_text: str, question: str, detail_level: str):
+    """
+    Para los libros de la biblioteca, con la caché de contexto activa, devuelve el prompt partido con
+    el libro ENTERO en el prefijo (se cachea una vez por clave y se reutiliza en cada pregunta).
+    Devuelve None si no aplica; entonces se usa solo el prompt con los fragmentos relevantes.
+    """
+    cache = llm_pool.context_cache
+    if cache is None or catalog.get(book_path) is None: return None
+    if not cache.eligible(book_text): return None
+    return CacheablePrefix(doc_key, build_prompt_prefix(book_text), build_prompt_suffix(question, detail_level))
+
+def _search_book(meta, question: str, top_k: int):
+    """Busca en un libro de la categoría (en un hilo): lee su texto e índice y devuelve sus mejores fragmentos."""
+    doc_key, book_text = load_book(meta.path)
+    if not book_text: return []
+    return retrieval.search_passages(retrieval.get_index(doc_key, book_text), book_text, question, top_k)
+
+async def build_category_context(category_name: str, question: str, detail_level: str):
+    """
+    Contexto para una pregunta sobre toda la categoría: se busca en el índice de cada libro a la vez
+    (como mucho CATEGORY_SEARCH_CONCURRENCY) y se juntan los mejores fragmentos de todos en un contexto
+    con el mismo presupuesto que el de un solo libro. Devuelve (contexto, archivos citados).
+    """
+    top_k = retrieval.DETAIL_CONFIG.get(detail_level, retrieval.DETAIL_CONFIG["simple"])["top_k"]
+    semaphore = asyncio.Semaphore(CATEGORY_SEARCH_CONCURRENCY)
+
+    async def search(meta):
+        async with semaphore:
+            try:
+                return meta.filename, await asyncio.to_thread(_search_book, meta, question, top_k)
+            except Exception as e:
+                # Un libro ilegible no impide responder con el resto
+                logger.warning(f"No se pudo buscar en '{meta.filename}': {e}")
+                return meta.filename, []
+
+    results = await asyncio.gather(*(search(meta) for meta in catalog.books(category_name)))
+    return retrieval.build_multi_context(results, detail_level, max_chars=MAX_CHARS)
+
+def with_sources(main_answer: str, sources: list) -> str:
+    """Añade al final de la respuesta la lista de archivos de los que salieron los fragmentos del prompt."""
+    return main_answer + "\n\n**📚 Fuentes consultadas:**\n" + "\n".join(f"- {name}" for name in sources)
+
+def parse_answer(full_text: str):
+    """Separa la respuesta de la IA en (respuesta principal, lista de preguntas sugeridas)."""
+    main_answer, suggested_questions = full_text, []
+    if SUGGESTIONS_SEPARATOR in full_text:
+        parts = full_text.split(SUGGESTIONS_SEPARATOR)
+        main_answer = parts[0].strip()
+        suggested_questions = [q.strip() for q in parts[1].strip().split('\n') if q.strip() and len(q) > 1]
+    return main_answer, suggested_questions
+
+async def build_answer_prompt(book_path, category_name, doc_key, book_text, question, detail_level):
+    """
+    Contexto y prompt de una pregunta (de un libro o de toda la categoría). Devuelve
+    (prompt, prefijo cacheable, contexto, archivos citados), o None si ningún libro de la categoría
+    tiene nada que ver con la pregunta.
+    """
+    # Solo los fragmentos relevantes (o el documento entero si es pequeño) van al prompt
+    sources = []
+    with metrics.span("build_context"):
+        if category_name:
+            document_context, sources = await build_category_context(category_name, question, detail_level)
+        else:
+            document_context = retrieval.build_context(doc_key, book_text, question, detail_level, max_chars=MAX_CHARS)
+    if category_name and not document_context: return None
+    with metrics.span("build_prompt"):
+        prompt = build_prompt(document_context, question, detail_level, citations=bool(category_name))
+        cached_prefix = cacheable_prefix(book_path, doc_key, book_text, question, detail_level) if not category_name else None
+    metrics.PROMPT_CHARS.observe(len(prompt), detail_level=detail_level)
+    return prompt, cached_prefix, document_context, sources
+
+async def _precompute_answer(user_id, book_path, category_name, doc_key, book_text, question, detail_level, started):
+    """
+    Genera de fondo la respuesta a una pregunta sugerida y la deja en answer_cache. Usa el carril de
+    fondo del planificador, así nunca quita turno a las preguntas que los usuarios esperan.
+    """
+    with metrics.bind(user_id=user_id, detail_level=detail_level, speculative=True):
+        built = await build_answer_prompt(book_path, category_name, doc_key, book_text, question, detail_level)
+        if built is None: return
+        prompt, cached_prefix, _, sources = built
+        async with llm_scheduler.slot(user_id, detail_level, background=True):
+            started.set()
+            with metrics.span("llm_generate_speculative"):
+                full_text = await llm_pool.generate(prompt, cached_prefix=cached_prefix)
+    main_answer, suggested_questions = parse_answer(full_text)
+    if sources: main_answer = with_sources(main_answer, sources)
+    answer_cache.put(doc_key, question, detail_level, main_answer, suggested_questions)
+    logger.info(f"Respuesta especulativa lista para {user_id}: '{question}' ({detail_level}).")
+
+async def _generate_and_send_answer(target_message, user_id, question, detail_level, context):
+    state = state_manager.load_state(user_id)
+    category_name = state.get('current_category')
+    book_path = state.get('current_book_path')
+
+    if category_name:
+        # Pregunta a toda la categoría: los libros se leen al buscar en ellos, y la clave de la caché
+        # de respuestas cambia si cambia cualquiera de los libros
+        if not catalog.books(category_name):
+            await target_message.edit_text("⚠️ Esta categoría está vacía o ya no existe. Elige otra con /books.")
+            return
+        doc_key, book_text = f"category:{catalog.category_key(category_name)}", None
+    else:
+        if not book_path or not os.path.exists(book_path):
+            await target_message.edit_text("⚠️ No encuentro el libro cargado. Por favor, súbelo o selecciónalo de nuevo.")
+            return
+
+        # Si el archivo se acaba de subir y aún se está ingiriendo, esperamos a ese trabajo en vez de repetirlo
+        with metrics.span("ingest_wait"):
+            await ingest_queue.wait_for(book_path)
+        upload_store.touch(book_path)
+        # El texto sale del artefacto precompilado o de la caché; solo se extrae la primera vez,
+        # y en un hilo aparte para no bloquear el resto de updates mientras tanto
+        with metrics.span("load_book"):
+            doc_key, book_text = await asyncio.to_thread(load_book, book_path)
+
+        if not book_text:
+            await target_message.edit_text("⚠️ No se pudo leer el contenido del libro seleccionado.")
+            return
+
+    # Si la respuesta ya se está preparando de fondo (pregunta sugerida), se espera a ella
+    if speculative: await speculative.join(user_id, answer_cache.make_key(doc_key, question, detail_level))
+    # Las preguntas repetidas sobre el mismo documento se responden sin llamar a Gemini
+    cached_answer = answer_cache.get(doc_key, question, detail_level)
+
+    try:
+        progressive_reply = ProgressiveReply(context.bot, user_id, target_message, TELEGRAM_MSG_LIMIT) if STREAM_ANSWERS else None
+        if cached_answer:
+            metrics.log_event("answer", question_chars=len(question), cached=True)
+            logger.info(f"Respuesta en caché para {user_id}: '{question}' ({detail_level}). {answer_cache.stats()}")
+            main_answer, suggested_questions = cached_answer
+        else:
+            built = await build_answer_prompt(book_path, category_name, doc_key, book_text, question, detail_level)
+            if built is None:
+                # Ningún libro de la categoría tiene nada que ver con la pregunta: no hace falta llamar a Gemini
+                await target_message.edit_text("🔎 No encontré nada relacionado con tu pregunta en los documentos de esta categoría.")
+                return
+            prompt, cached_prefix, document_context, sources = built
+            # Espera su turno entre las preguntas de todos los usuarios (o se rechaza al momento)
+            async with llm_scheduler.slot(user_id, detail_level):
+                if progressive_reply:
+                    # La respuesta se va mostrando mientras llega, editando el mensaje 'Analizando...'
+                    # (el span incluye esas ediciones; la latencia pura de Gemini está en bot_llm_call_seconds)
+                    full_text = ""
+                    with metrics.span("llm_stream"):
+                        async for chunk in llm_pool.stream(prompt, cached_prefix=cached_prefix):
+                            full_text += chunk
+                            await progressive_reply.update(_visible_answer(full_text))
+                else:
+                    # El pool reparte la llamada entre las claves API sin bloquear el event loop
+                    with metrics.span("llm_generate"):
+                        full_text = await llm_pool.generate(prompt, cached_prefix=cached_prefix)
+            metrics.RESPONSE_CHARS.observe(len(full_text), detail_level=detail_level)
+            metrics.log_event("answer", question_chars=len(question), context_chars=len(document_context), prompt_chars=len(prompt), response_chars=len(full_text))
+            logger.debug("Respuesta completa de la IA: %s", full_text)
+            main_answer, suggested_questions = parse_answer(full_text)
+            if sources: main_answer = with_sources(main_answer, sources)
+            answer_cache.put(doc_key, question, detail_level, main_answer, suggested_questions)
         
         keyboard = []
         if suggested_questions:
@@ -392,26 +582,42 @@ async def _generate_and_send_answer(target_message, user_id, question, detail_le
                 button_text = q[:60] + '...' if len(q) > 60 else q
                 keyboard.append([InlineKeyboardButton(f"› {button_text}", callback_data=callback_id)])
             
-            # Guardamos las sugerencias en el estado del usuario
-            state['suggestions'] = suggestions_map
-            state_manager.save_state(user_id, state)
+            # Guardamos las sugerencias releyendo el estado: mientras respondía la IA pudo cambiar
+            async with state_manager.edit_state(user_id) as state:
+                state['suggestions'] = suggestions_map
+
+            # Mientras el usuario lee, se preparan de fondo las respuestas de las sugeridas (con el mismo detalle)
+            if speculative:
+                speculative.schedule(user_id, [
+                    (answer_cache.make_key(doc_key, q, detail_level),
+                     functools.partial(_precompute_answer, user_id, book_path, category_name, doc_key, book_text, q, detail_level))
+                    for q in suggested_questions if not answer_cache.contains(doc_key, q, detail_level)
+                ])
         
         reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
+
+        if progressive_reply:
+            with metrics.span("send_answer"):
+                await progressive_reply.finish(main_answer, reply_markup)
+            return
         
-        try:
-            await target_message.delete()
-        except BadRequest as e:
-            if "not found" in str(e).lower(): logger.warning("El mensaje 'Analizando...' ya había sido borrado.")
-            else: raise e
-
-        if len(main_answer) > TELEGRAM_MSG_LIMIT:
-            parts = [main_answer[i:i + TELEGRAM_MSG_LIMIT] for i in range(0, len(main_answer), TELEGRAM_MSG_LIMIT)]
-            for i, part in enumerate(parts):
-                final_markup = reply_markup if i == len(parts) - 1 else None
-                await send_final_message(context, user_id, part, final_markup)
-        else:
-            await send_final_message(context, user_id, main_answer, reply_markup)
+        # La respuesta se convierte a MarkdownV2 válido y se reparte entre párrafos: cada parte se envía
+        # una sola vez, y el mensaje 'Analizando...' se borra mientras sale la primera
+        with metrics.span("send_answer"):
+            await renderer.send_messages(context.bot, user_id, renderer.render_messages(main_answer, TELEGRAM_MSG_LIMIT), reply_markup, replaces=target_message)
             
+    except (RateLimitedError, QueueFullError) as e:
+        # Se responde enseguida con cuándo reintentar; la pregunta sigue guardada para los botones
+        logger.info(f"Pregunta de {user_id} rechazada por el planificador: {e}")
+        if isinstance(e, QueueFullError):
+            text = f"⏳ Ahora mismo hay muchas preguntas en cola (la tuya sería la n.º {e.position}). Inténtalo de nuevo en unos {max(1, round(e.retry_after))} s."
+        else:
+            text = f"⏳ Has hecho muchas preguntas seguidas. Podrás volver a preguntar en unos {max(1, round(e.retry_after))} s."
+        keyboard = [[InlineKeyboardButton("🎯 Simple", callback_data="detail_simple"), InlineKeyboardButton("📚 Detallada", callback_data="detail_detailed")]]
+        try:
+            await target_message.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+        except BadRequest:
+            logger.warning("No se pudo editar el mensaje de espera porque ya no existía.")
     except Exception as e:
         logger.error(f"Error al procesar la respuesta para {user_id}: {e}", exc_info=True)
         try:
@@ -420,9 +626,30 @@ async def _generate_and_send_answer(target_message, user_id, question, detail_le
             logger.warning("No se pudo editar el mensaje de error porque ya no existía.")
 
 # ===================== FUNCIÓN DE CONFIGURACIÓN DE LA APLICACIÓN =====================
+class TimedHTTPXRequest(HTTPXRequest):
+    """Transporte HTTP de python-telegram-bot que mide cada llamada al Bot API por método."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = "download" if "/file/bot" in url else url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            metrics.TELEGRAM_API_SECONDS.observe(time.perf_counter() - started, method=api_method)
+
 def setup_application():
     """Crea la instancia de la aplicación y registra todos los handlers."""
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    # Mismo tamaño de pool que usa la librería por defecto; TimedHTTPXRequest solo añade la medición.
+    # Las dos conexiones (peticiones y getUpdates) comparten un contexto TLS: cargar los certificados
+    # es lo más caro de crearlas y se hace en cada arranque en frío.
+    httpx_kwargs = {"verify": ssl.create_default_context(cafile=certifi.where())}
+    builder = (Application.builder().token(TELEGRAM_TOKEN)
+               .request(TimedHTTPXRequest(connection_pool_size=256, httpx_kwargs=httpx_kwargs))
+               .get_updates_request(TimedHTTPXRequest(connection_pool_size=1, httpx_kwargs=httpx_kwargs)))
+    if TELEGRAM_API_BASE_URL:
+        base_url = TELEGRAM_API_BASE_URL.rstrip("/")
+        builder = builder.base_url(f"{base_url}/bot").base_file_url(f"{base_url}/file/bot")
+    application = builder.build()
     
     application.add_handler(CommandHandler("start", start))
     application.add_handler(MessageHandler(filters.Document.ALL, handle_file))
@@ -431,6 +658,7 @@ def setup_application():
     application.add_handler(CallbackQueryHandler(handle_pagination, pattern=r'^page_'))
     application.add_handler(CallbackQueryHandler(handle_category_selection, pattern=r'^cat_'))
     application.add_handler(CallbackQueryHandler(handle_book_selection, pattern=r'^select_'))
+    application.add_handler(CallbackQueryHandler(handle_category_ask, pattern=r'^askcat_'))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, ask_question_handler))
     application.add_handler(CallbackQueryHandler(handle_detail_choice, pattern=r'^detail_'))
     application.add_handler(CallbackQueryHandler(handle_suggested_question, pattern=r'^sugg_'))
@@ -439,5 +667,9 @@ def setup_application():
     return application
 
 # Inicializar la app una vez al arrancar el servidor (para Vercel)
+library = library_artifact.open_artifact(LIBRARY_ARTIFACT_DIR)
+catalog = LibraryCatalog(BOOKS_DIR, VALID_EXTENSIONS)
+upload_store = UploadStore()
+ingest_queue = IngestQueue(_ingest_book)
 scan_books_directory()
 application = setup_application()
\ No newline at end of file
@@ -0,0 +1,218 @@
+# bot_logic/ingest.py
+
+import asyncio
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from bot_logic import retrieval, text_cache
+
+# Obtenemos una instancia del logger para este módulo
+logger = logging.getLogger(__name__)
+
+# Los archivos subidos por los usuarios viven aquí, con un índice para deduplicarlos.
+UPLOAD_DIR = '/tmp/uploads'
+# Espacio máximo para subidas; al superarlo se borran las menos usadas y todo lo derivado de ellas.
+UPLOAD_QUOTA_BYTES = int(os.getenv("UPLOAD_QUOTA_BYTES", 256 * 1024 * 1024))
+
+_UNSAFE_CHARS_RE = re.compile(r'[^\w.\- ]')
+
+try:
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+except OSError as e:
+    logger.error(f"CRÍTICO: No se pudo crear el directorio de subidas en {UPLOAD_DIR}: {e}")
+
+class UploadStore:
+    """
+    Registro de archivos subidos: file_unique_id -> {path, content_hash, size, last_used}.
+    Dos subidas del mismo archivo (mismo file_unique_id o mismo contenido) comparten una sola copia,
+    y dos descargas simultáneas del mismo file_unique_id se hacen una sola vez ('obtain').
+
+    También se apunta qué subida tiene cargada cada usuario ('hold'): la cuota nunca borra un archivo
+    que es el libro actual de alguien.
+    """
+
+    def __init__(self, directory: str = UPLOAD_DIR, quota_bytes: int = UPLOAD_QUOTA_BYTES):
+        self.directory = directory
+        self.quota_bytes = quota_bytes
+        self.index_path = os.path.join(directory, 'index.json')
+        self._lock = threading.Lock()
+        self._entries, self._holders = self._load_index()
+        # file_unique_id -> futuro con la ruta, mientras se descarga
+        self._downloads = {}
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}, {}
+        # Los índices antiguos solo tenían las entradas
+        entries, holders = (data['entries'], data.get('holders', {})) if 'entries' in data else (data, {})
+        # Descartamos entradas cuyo archivo ya no existe (por ejemplo, /tmp se limpió).
+        entries = {uid: e for uid, e in entries.items() if os.path.exists(e['path'])}
+        return entries, {user_id: path for user_id, path in holders.items() if os.path.exists(path)}
+
+    def _save_index(self):
+        tmp_path = f"{self.index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'entries': self._entries, 'holders': self._holders}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            logger.error(f"No se pudo guardar el índice de subidas: {e}")
+
+    def path_for(self, file_unique_id: str, file_name: str) -> str:
+        safe_name = _UNSAFE_CHARS_RE.sub('_', os.path.basename(file_name or 'documento'))
+        return os.path.join(self.directory, f"{file_unique_id}_{safe_name}")
+
+    def lookup(self, file_unique_id: str):
+        """Devuelve la ruta de una subida ya conocida (y la marca como usada), o None."""
+        with self._lock:
+            entry = self._entries.get(file_unique_id)
+            if entry and os.path.exists(entry['path']):
+                entry['last_used'] = time.time()
+                return entry['path']
+        return None
+
+    async def obtain(self, file_unique_id: str, file_name: str, download, holder=None) -> str:
+        """
+        Devuelve la ruta local de una subida: la ya registrada, la de una descarga en curso del mismo
+        archivo o, si no hay ninguna, la descarga con 'await download(ruta)' y la registra. Se descarga a
+        un archivo temporal propio y se renombra al terminar: nadie ve un archivo a medias.
+        Con 'holder', el archivo queda como libro actual de ese usuario (ver 'hold').
+        """
+        file_path = self.lookup(file_unique_id)
+        if file_path is None:
+            pending = self._downloads.get(file_unique_id)
+            if pending is not None: file_path = await asyncio.shield(pending)
+        if file_path is not None:
+            if holder is not None: self.hold(holder, file_path)
+            return file_path
+
+        future = asyncio.get_running_loop().create_future()
+        self._downloads[file_unique_id] = future
+        target = self.path_for(file_unique_id, file_name)
+        tmp_path = f"{target}.{os.getpid()}.{id(future)}.part"
+        try:
+            await download(tmp_path)
+            os.replace(tmp_path, target)
+            file_path = await asyncio.to_thread(self.register, file_unique_id, target, holder)
+            future.set_result(file_path)
+            return file_path
+        except BaseException as e:
+            try: os.remove(tmp_path)
+            except OSError: pass
+            if isinstance(e, Exception):
+                future.set_exception(e)
+                # Quien espera recibe el mismo error; así no queda como "excepción nunca recuperada"
+                future.exception()
+            else:
+                future.cancel()
+            raise
+        finally:
+            self._downloads.pop(file_unique_id, None)
+
+    def hold(self, user_id, file_path: str = None):
+        """Apunta 'file_path' como el libro actual del usuario (None: ya no tiene una subida cargada)."""
+        user_id = str(user_id)
+        with self._lock:
+            if self._holders.get(user_id) == file_path: return
+            if file_path is None: self._holders.pop(user_id, None)
+            else: self._holders[user_id] = file_path
+            self._save_index()
+
+    def register(self, file_unique_id: str, file_path: str, holder=None) -> str:
+        """
+        Registra un archivo recién descargado. Si ya había otro con el mismo contenido, borra el nuevo
+        y devuelve la ruta del existente. Después aplica la cuota de espacio.
+        """
+        content_hash = text_cache.file_content_hash(file_path)
+        with self._lock:
+            duplicate = next((e for e in self._entries.values() if e['content_hash'] == content_hash and os.path.exists(e['path']) and e['path'] != file_path), None)
+            if duplicate:
+                os.remove(file_path)
+                file_path = duplicate['path']
+                logger.info(f"Subida duplicada por contenido. Se reutiliza {file_path}")
+            self._entries[file_unique_id] = {'path': file_path, 'content_hash': content_hash, 'size': os.path.getsize(file_path), 'last_used': time.time()}
+            if holder is not None: self._holders[str(holder)] = file_path
+            self._enforce_quota(keep=file_path)
+            self._save_index()
+        return file_path
+
+    def touch(self, file_path: str):
+        with self._lock:
+            for entry in self._entries.values():
+                if entry['path'] == file_path: entry['last_used'] = time.time()
+
+    def _enforce_quota(self, keep: str):
+        """
+        Borra los archivos usados hace más tiempo (y su texto e índice) hasta caber en la cuota. Los que
+        son el libro actual de algún usuario no se borran; si solo quedan esos, se supera la cuota.
+        """
+        # Varias subidas pueden compartir archivo: cuenta el uso más reciente de cada uno.
+        files = {}
+        for entry in self._entries.values():
+            current = files.get(entry['path'])
+            if current is None or entry['last_used'] > current['last_used']: files[entry['path']] = entry
+        total = sum(e['size'] for e in files.values())
+        held = set(self._holders.values())
+        for path, entry in sorted(files.items(), key=lambda item: item[1]['last_used']):
+            if total <= self.quota_bytes: break
+            if path == keep or path in held: continue
+            try: os.remove(path)
+            except OSError: pass
+            text_cache.evict(entry['content_hash'])
+            retrieval.drop_index(entry['content_hash'])
+            for uid in [uid for uid, e in self._entries.items() if e['path'] == path]:
+                del self._entries[uid]
+            total -= entry['size']
+            logger.info(f"Cuota de subidas: eliminado {path} ({entry['size']} bytes).")
+        if total > self.quota_bytes:
+            logger.warning(f"Cuota de subidas superada ({total} bytes): los archivos restantes están en uso.")
+
+class IngestQueue:
+    """
+    Cola de ingesta en segundo plano: extrae e indexa cada archivo en cuanto se sube, en un hilo
+    para no bloquear el event loop. Un mismo archivo solo se procesa una vez aunque se encole varias.
+    """
+
+    def __init__(self, process):
+        self.process = process
+        self._queue = None
+        self._worker = None
+        self._jobs = {}
+
+    def enqueue(self, file_path: str):
+        if file_path in self._jobs: return self._jobs[file_path]
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._jobs[file_path] = future
+        self._queue.put_nowait(file_path)
+        return future
+
+    async def wait_for(self, file_path: str):
+        """Si el archivo se está ingiriendo, espera a que termine (así no se extrae dos veces)."""
+        future = self._jobs.get(file_path)
+        if future is not None and not future.done():
+            await asyncio.shield(future)
+
+    async def _run(self):
+        while True:
+            file_path = await self._queue.get()
+            future = self._jobs.get(file_path)
+            try:
+                started = time.perf_counter()
+                await asyncio.to_thread(self.process, file_path)
+                logger.info(f"Ingesta de '{file_path}' completada en {time.perf_counter() - started:.2f}s.")
+            except Exception as e:
+                logger.error(f"Error en la ingesta de '{file_path}': {e}", exc_info=True)
+            finally:
+                if future is not None and not future.done(): future.set_result(None)
+                self._jobs.pop(file_path, None)
+                self._queue.task_done()
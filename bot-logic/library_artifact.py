@@ -0,0 +1,219 @@
+# bot_logic/library_artifact.py
+"""
+Artefacto precompilado de la biblioteca local.
+
+Se genera una sola vez (en el build o a mano) con:
+
+    python -m bot_logic.library_artifact --books books --out library_artifact
+
+y contiene, para cada libro de BOOKS_DIR, su texto extraído y su índice BM25 en un
+formato que se abre con mmap. Así una instancia serverless en frío no tiene que
+parsear ningún PDF/DOCX para responder sobre los libros precargados.
+
+Estructura del directorio:
+    manifest.json      metadatos y desplazamientos de cada documento
+    text.bin           textos en UTF-8 concatenados
+    vocab.txt          vocabularios de cada índice, un término por línea
+    *.npy              arrays del índice concatenados (se cargan con mmap_mode='r')
+"""
+
+import argparse
+import json
+import logging
+import mmap
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from bot_logic import extractors, retrieval, text_cache
+
+# Obtenemos una instancia del logger para este módulo
+logger = logging.getLogger(__name__)
+
+ARTIFACT_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+TEXT_NAME = "text.bin"
+VOCAB_NAME = "vocab.txt"
+ARRAY_NAMES = ("chunk_starts", "chunk_ends", "chunk_lens", "term_ptr", "post_chunks", "post_tf")
+
+def _extract_and_index(file_path: str):
+    """Trabajo de cada proceso: extrae el texto de un libro y construye su índice."""
+    processor = extractors.get_processor(file_path)
+    text = processor(file_path) if processor else None
+    if not text: return file_path, None, None, None
+    index = retrieval.BM25Index.build(text)
+    return file_path, text_cache.file_content_hash(file_path), text, index
+
+def _list_books(books_dir: str):
+    books = []
+    for category_name in sorted(os.listdir(books_dir)):
+        category_path = os.path.join(books_dir, category_name)
+        if not os.path.isdir(category_path): continue
+        for filename in sorted(os.listdir(category_path)):
+            if os.path.splitext(filename.lower())[1] in extractors.VALID_EXTENSIONS:
+                books.append(os.path.join(category_path, filename))
+    return books
+
+def build_artifact(books_dir: str, out_dir: str, workers: int = None) -> int:
+    """
+    Extrae e indexa todos los libros de 'books_dir' en paralelo y escribe el artefacto en 'out_dir'.
+    El artefacto se escribe en un directorio temporal y se sustituye al final, de modo que
+    un lector nunca ve un artefacto a medio escribir. Devuelve el número de documentos incluidos.
+    """
+    import numpy as np
+    books = _list_books(books_dir)
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(_extract_and_index, books))
+
+    tmp_dir = f"{out_dir}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    documents = []
+    arrays = {name: [] for name in ARRAY_NAMES}
+    counters = {"text": 0, "chunks": 0, "terms": 0, "term_ptr": 0, "postings": 0}
+    with open(os.path.join(tmp_dir, TEXT_NAME), "wb") as text_file, open(os.path.join(tmp_dir, VOCAB_NAME), "w", encoding="utf-8") as vocab_file:
+        for file_path, content_hash, text, index in results:
+            if text is None:
+                logger.warning(f"Se omite '{file_path}': no se pudo extraer texto.")
+                continue
+            data = text.encode("utf-8")
+            text_file.write(data)
+            # El vocabulario se guarda en el orden de sus ids para reconstruir el diccionario al leer.
+            terms = sorted(index.vocab, key=index.vocab.get)
+            vocab_file.write("".join(f"{term}\n" for term in terms))
+            documents.append({
+                "path": os.path.normpath(file_path),
+                "category": os.path.basename(os.path.dirname(file_path)),
+                "filename": os.path.basename(file_path),
+                "content_hash": content_hash,
+                "size": os.path.getsize(file_path),
+                "num_chars": len(text),
+                "text_offset": counters["text"], "text_bytes": len(data),
+                "chunk_offset": counters["chunks"], "num_chunks": index.num_chunks,
+                "vocab_offset": counters["terms"], "vocab_size": len(terms), "term_ptr_offset": counters["term_ptr"],
+                "postings_offset": counters["postings"], "num_postings": len(index.post_chunks),
+            })
+            for name in ARRAY_NAMES:
+                arrays[name].append(getattr(index, name))
+            counters["text"] += len(data)
+            counters["chunks"] += index.num_chunks
+            counters["terms"] += len(terms)
+            counters["term_ptr"] += len(index.term_ptr)
+            counters["postings"] += len(index.post_chunks)
+
+    dtypes = {"chunk_starts": np.int64, "chunk_ends": np.int64, "chunk_lens": np.float32, "term_ptr": np.int64, "post_chunks": np.int32, "post_tf": np.float32}
+    for name in ARRAY_NAMES:
+        joined = np.concatenate(arrays[name]) if arrays[name] else np.zeros(0, dtype=dtypes[name])
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), joined.astype(dtypes[name], copy=False))
+
+    manifest = {
+        "version": ARTIFACT_VERSION,
+        "extractor_version": text_cache.EXTRACTOR_VERSION,
+        "chunk_chars": retrieval.CHUNK_CHARS,
+        "chunk_overlap": retrieval.CHUNK_OVERLAP,
+        "documents": documents,
+    }
+    with open(os.path.join(tmp_dir, MANIFEST_NAME), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+    logger.info(f"Artefacto de biblioteca escrito en '{out_dir}': {len(documents)} documentos en {time.perf_counter() - started:.1f}s.")
+    return len(documents)
+
+class ArtifactDocument:
+    """Un documento del artefacto. El texto y el índice se leen desde mmap bajo demanda."""
+
+    def __init__(self, artifact, entry):
+        self._artifact = artifact
+        self.entry = entry
+        self.path = entry["path"]
+        self.content_hash = entry["content_hash"]
+        self._index = None
+
+    def text(self) -> str:
+        start = self.entry["text_offset"]
+        return self._artifact.text_map[start:start + self.entry["text_bytes"]].decode("utf-8")
+
+    def index(self) -> retrieval.BM25Index:
+        if self._index is None:
+            a, e = self._artifact.arrays, self.entry
+            chunks = slice(e["chunk_offset"], e["chunk_offset"] + e["num_chunks"])
+            # term_ptr tiene vocab_size + 1 entradas por documento y sus valores son relativos al documento.
+            term_ptr = a["term_ptr"][e["term_ptr_offset"]:e["term_ptr_offset"] + e["vocab_size"] + 1]
+            postings = slice(e["postings_offset"], e["postings_offset"] + e["num_postings"])
+            vocab = self._artifact.vocab(e["vocab_offset"], e["vocab_size"])
+            self._index = retrieval.BM25Index(vocab, a["chunk_starts"][chunks], a["chunk_ends"][chunks], a["chunk_lens"][chunks], term_ptr, a["post_chunks"][postings], a["post_tf"][postings])
+        return self._index
+
+class LibraryArtifact:
+    """Artefacto abierto en modo solo lectura."""
+
+    def __init__(self, directory: str, manifest: dict):
+        self.directory = directory
+        self.manifest = manifest
+        with open(os.path.join(directory, TEXT_NAME), "rb") as f:
+            self.text_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+        self._arrays = None
+        self.documents = [ArtifactDocument(self, entry) for entry in manifest["documents"]]
+        self._by_path = {doc.path: doc for doc in self.documents}
+        self._vocab_lines = None
+
+    @property
+    def arrays(self) -> dict:
+        """Arrays del índice; se abren (y se importa NumPy) la primera vez que se lee un índice."""
+        if self._arrays is None:
+            import numpy as np
+            self._arrays = {name: np.load(os.path.join(self.directory, f"{name}.npy"), mmap_mode="r") for name in ARRAY_NAMES}
+        return self._arrays
+
+    def vocab(self, offset: int, size: int) -> dict:
+        if self._vocab_lines is None:
+            with open(os.path.join(self.directory, VOCAB_NAME), "r", encoding="utf-8") as f:
+                self._vocab_lines = f.read().split("\n")
+        return {term: i for i, term in enumerate(self._vocab_lines[offset:offset + size])}
+
+    def lookup(self, file_path: str, content_hash: str = None):
+        """
+        Busca un libro por su ruta. Si se pasa 'content_hash' y no coincide con el del artefacto
+        (el libro cambió después del build), devuelve None para que se extraiga de nuevo.
+        """
+        doc = self._by_path.get(os.path.normpath(file_path))
+        if doc is None: return None
+        if content_hash and doc.content_hash != content_hash: return None
+        return doc
+
+def open_artifact(directory: str):
+    """Abre el artefacto si existe y es compatible; si no, devuelve None y se trabaja sin él."""
+    manifest_path = os.path.join(directory, MANIFEST_NAME)
+    if not os.path.exists(manifest_path): return None
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("version") != ARTIFACT_VERSION or manifest.get("extractor_version") != text_cache.EXTRACTOR_VERSION:
+            logger.warning(f"El artefacto en '{directory}' es de otra versión. Se ignorará.")
+            return None
+        if manifest.get("chunk_chars") != retrieval.CHUNK_CHARS or manifest.get("chunk_overlap") != retrieval.CHUNK_OVERLAP:
+            logger.warning(f"El artefacto en '{directory}' usa otra configuración de fragmentos. Se ignorará.")
+            return None
+        artifact = LibraryArtifact(directory, manifest)
+        logger.info(f"Artefacto de biblioteca abierto: {len(artifact.documents)} documentos.")
+        return artifact
+    except Exception as e:
+        logger.error(f"No se pudo abrir el artefacto de biblioteca en '{directory}': {e}")
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pre-extrae e indexa la biblioteca local en un artefacto mmap.")
+    parser.add_argument("--books", default="books", help="Directorio de la biblioteca (por defecto: books)")
+    parser.add_argument("--out", default="library_artifact", help="Directorio de salida (por defecto: library_artifact)")
+    parser.add_argument("--workers", type=int, default=None, help="Número de procesos (por defecto: uno por CPU)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    build_artifact(args.books, args.out, args.workers)
+
+if __name__ == "__main__":
+    main()
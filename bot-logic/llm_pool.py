@@ -0,0 +1,306 @@
+# bot_logic/llm_pool.py
+
+import asyncio
+import copy
+import itertools
+import logging
+import os
+import random
+import time
+
+from bot_logic import metrics
+
+# Obtenemos una instancia del logger para este módulo
+logger = logging.getLogger(__name__)
+
+MODEL_NAME = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
+# Intentos totales por pregunta (contando los cambios de clave).
+MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", 4))
+REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", 120))
+# Espera máxima entre dos trozos de una respuesta en streaming (y hasta el primero una vez abierta).
+STREAM_CHUNK_TIMEOUT = float(os.getenv("LLM_STREAM_CHUNK_TIMEOUT", 60))
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8.0
+# Tiempo que una clave queda fuera de la rotación según el tipo de fallo.
+QUOTA_COOLDOWN = float(os.getenv("LLM_QUOTA_COOLDOWN", 60))
+AUTH_COOLDOWN = float(os.getenv("LLM_AUTH_COOLDOWN", 3600))
+ERROR_COOLDOWN = float(os.getenv("LLM_ERROR_COOLDOWN", 30))
+# Errores transitorios seguidos que abren el circuito de una clave.
+FAILURE_THRESHOLD = 3
+
+
+class NoAvailableKeyError(Exception):
+    """Todas las claves están con el circuito abierto o se agotaron los intentos."""
+
+def _api_errors():
+    """
+    google.api_core.exceptions (que arrastra grpc) se importa al clasificar el primer error y no al
+    arrancar: la mayoría de updates no llegan a llamar a Gemini.
+    """
+    from google.api_core import exceptions
+    return exceptions
+
+def default_model_factory(api_key: str, model_name: str):
+    """
+    Crea un GenerativeModel con su propio cliente asíncrono ligado a 'api_key'.
+    Así cada clave tiene su cliente y no hace falta el 'genai.configure' global en cada petición.
+    """
+    import google.generativeai as genai
+    from google.ai import generativelanguage as glm
+    model = genai.GenerativeModel(model_name)
+    model._async_client = glm.GenerativeServiceAsyncClient(client_options={"api_key": api_key})
+    return model
+
+class KeyState:
+    """Salud y contadores de una clave API."""
+
+    def __init__(self, label: str, api_key: str):
+        self.label = label
+        self.api_key = api_key
+        self.model = None
+        # nombre de caché de contexto -> modelo que la usa (comparten el cliente de 'model')
+        self.cached_models = {}
+        self.in_flight = 0
+        self.calls = 0
+        self.successes = 0
+        self.errors = 0
+        self.quota_errors = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.total_latency = 0.0
+
+    def is_available(self, now: float) -> bool:
+        return now >= self.open_until
+
+    def open_circuit(self, seconds: float, reason: str):
+        self.open_until = time.monotonic() + seconds
+        logger.warning(f"Clave API {self.label} fuera de rotación durante {seconds:.0f}s ({reason}).")
+
+    def snapshot(self) -> dict:
+        return {
+            "key": self.label,
+            "in_flight": self.in_flight,
+            "calls": self.calls,
+            "successes": self.successes,
+            "errors": self.errors,
+            "quota_errors": self.quota_errors,
+            "circuit_open": not self.is_available(time.monotonic()),
+            "avg_latency": self.total_latency / self.successes if self.successes else 0.0,
+        }
+
+class GeminiClientPool:
+    """
+    Pool asíncrono de modelos Gemini, uno por clave API.
+    Elige la clave con menos peticiones en curso (en empate, por turno rotatorio), lleva la cuenta
+    de errores por clave, saca de la rotación las que devuelven errores de cuota o de autenticación
+    y reintenta un número acotado de veces con backoff exponencial con jitter.
+
+    'model_factory(api_key, model_name)' permite sustituir el modelo real por uno falso en pruebas:
+    solo necesita un método 'async generate_content_async(prompt, stream=False)' que devuelva un objeto
+    con '.text' o, con stream=True, un iterable asíncrono de trozos con '.text'.
+
+    Con 'context_cache' (un ContextCacheManager), las llamadas que traen 'cached_prefix' envían solo
+    el sufijo de la pregunta contra la caché de ese prefijo en la clave elegida; si no hay caché
+    disponible se envía 'prompt', que siempre es un prompt completo por sí mismo.
+    """
+
+    def __init__(self, api_keys, model_name: str = MODEL_NAME, model_factory=default_model_factory, max_attempts: int = MAX_ATTEMPTS, request_timeout: float = REQUEST_TIMEOUT, context_cache=None,
+                 stream_chunk_timeout: float = STREAM_CHUNK_TIMEOUT):
+        if not api_keys: raise ValueError("El pool necesita al menos una clave API.")
+        self.model_name = model_name
+        self.model_factory = model_factory
+        self.max_attempts = max_attempts
+        self.request_timeout = request_timeout
+        self.stream_chunk_timeout = stream_chunk_timeout
+        self.context_cache = context_cache
+        self.keys = [KeyState(f"#{i + 1}", key) for i, key in enumerate(api_keys)]
+        self._turn = itertools.count()
+
+    def _pick_key(self):
+        """Devuelve (clave, espera): la clave disponible menos cargada, o la que antes se reabre y cuánto falta."""
+        now = time.monotonic()
+        available = [k for k in self.keys if k.is_available(now)]
+        if available:
+            turn = next(self._turn)
+            n = len(available)
+            # Rotamos la lista según el turno para que los empates se repartan entre claves.
+            rotated = available[turn % n:] + available[:turn % n]
+            return min(rotated, key=lambda k: k.in_flight), 0.0
+        soonest = min(self.keys, key=lambda k: k.open_until)
+        return soonest, soonest.open_until - now
+
+    def _model_for(self, key: KeyState, cached_content: str = None):
+        if key.model is None:
+            key.model = self.model_factory(key.api_key, self.model_name)
+        if cached_content is None: return key.model
+        model = key.cached_models.get(cached_content)
+        if model is None:
+            # Igual que GenerativeModel.from_cached_content, pero reutilizando el cliente de la clave
+            model = copy.copy(key.model)
+            model._cached_content = cached_content
+            if len(key.cached_models) >= 64: key.cached_models.clear()
+            key.cached_models[cached_content] = model
+        return model
+
+    async def _prepare(self, key: KeyState, prompt, cached_prefix):
+        """Devuelve (modelo, contenido, nombre de la caché usada o None) para la llamada con 'key'."""
+        if cached_prefix is None or self.context_cache is None: return self._model_for(key), prompt, None
+        cache_name = await self.context_cache.resolve(key, self.model_name, cached_prefix)
+        if cache_name is None: return self._model_for(key), prompt, None
+        return self._model_for(key, cache_name), cached_prefix.suffix, cache_name
+
+    def _cache_rejected(self, key: KeyState, cached_prefix, cache_name, error: Exception) -> bool:
+        """Si Gemini no encuentra la caché (caducó o se borró) se olvida y se reintenta sin ella y sin penalizar la clave."""
+        if cache_name is None or not isinstance(error, _api_errors().NotFound): return False
+        logger.warning(f"La caché de contexto {cache_name} ya no existe (clave {key.label}).")
+        self.context_cache.invalidate(key, cached_prefix.key)
+        key.cached_models.pop(cache_name, None)
+        return True
+
+    @staticmethod
+    def _backoff(attempt: int) -> float:
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+    async def _acquire(self, attempt: int, last_error):
+        """Elige la clave para el intento, esperando si todas tienen el circuito abierto por poco tiempo."""
+        key, wait = self._pick_key()
+        if wait > 0:
+            if wait > BACKOFF_MAX:
+                raise NoAvailableKeyError("Todas las claves API están temporalmente fuera de servicio.", last_error)
+            await asyncio.sleep(wait)
+        key.in_flight += 1
+        key.calls += 1
+        logger.info(f"Intentando llamada a la API con la clave {key.label}...")
+        return key
+
+    def _record_success(self, key: KeyState, started: float, usage=None):
+        elapsed = time.monotonic() - started
+        key.successes += 1
+        key.consecutive_failures = 0
+        key.total_latency += elapsed
+        metrics.LLM_CALL_SECONDS.observe(elapsed, key=key.label, outcome="ok")
+        if usage is not None:
+            metrics.LLM_TOKENS.observe(getattr(usage, "prompt_token_count", 0) or 0, kind="prompt")
+            metrics.LLM_TOKENS.observe(getattr(usage, "candidates_token_count", 0) or 0, kind="response")
+            cached_tokens = getattr(usage, "cached_content_token_count", 0) or 0
+            if cached_tokens: metrics.LLM_TOKENS.observe(cached_tokens, kind="cached")
+        logger.info(f"✅ Éxito con la clave API {key.label}.")
+
+    @staticmethod
+    def _count_transient_failure(key: KeyState):
+        key.consecutive_failures += 1
+        if key.consecutive_failures >= FAILURE_THRESHOLD:
+            key.open_circuit(ERROR_COOLDOWN, f"{key.consecutive_failures} errores seguidos")
+
+    async def _record_failure(self, key: KeyState, started: float, error: Exception, attempt: int):
+        """Actualiza la salud de la clave. Vuelve a lanzar el error si no tiene sentido reintentar."""
+        key.errors += 1
+        metrics.LLM_CALL_SECONDS.observe(time.monotonic() - started, key=key.label, outcome=type(error).__name__)
+        errors = _api_errors()
+        if isinstance(error, (errors.ResourceExhausted, errors.TooManyRequests)):
+            key.quota_errors += 1
+            key.open_circuit(QUOTA_COOLDOWN, "cuota agotada")
+        elif isinstance(error, (errors.PermissionDenied, errors.Unauthenticated)):
+            key.open_circuit(AUTH_COOLDOWN, "clave rechazada")
+        elif isinstance(error, errors.InvalidArgument):
+            # Una clave inválida llega como InvalidArgument; cualquier otro InvalidArgument es del prompt
+            # y no se arregla cambiando de clave.
+            if "api key" not in str(error).lower(): raise error
+            key.open_circuit(AUTH_COOLDOWN, "clave inválida")
+        elif isinstance(error, (errors.ServiceUnavailable, errors.InternalServerError, errors.DeadlineExceeded, asyncio.TimeoutError)):
+            self._count_transient_failure(key)
+            logger.warning(f"Error transitorio con la clave {key.label}: {error!r}")
+            await asyncio.sleep(self._backoff(attempt))
+        else:
+            raise error
+
+    async def generate(self, prompt, cached_prefix=None) -> str:
+        """Genera la respuesta para 'prompt' y devuelve su texto."""
+        last_error = None
+        for attempt in range(self.max_attempts):
+            key = await self._acquire(attempt, last_error)
+            started = time.monotonic()
+            cache_name = None
+            try:
+                model, contents, cache_name = await self._prepare(key, prompt, cached_prefix)
+                response = await asyncio.wait_for(model.generate_content_async(contents), self.request_timeout)
+                text = response.text
+                self._record_success(key, started, getattr(response, "usage_metadata", None))
+                return text
+            except Exception as e:
+                last_error = e
+                if self._cache_rejected(key, cached_prefix, cache_name, e):
+                    # Se reintenta con el prompt completo; la caché se vuelve a crear en la próxima pregunta
+                    cached_prefix = None
+                    continue
+                await self._record_failure(key, started, e, attempt)
+            finally:
+                key.in_flight -= 1
+        raise NoAvailableKeyError("No se pudo obtener una respuesta válida de la API.", last_error)
+
+    async def stream(self, prompt, cached_prefix=None):
+        """
+        Genera la respuesta en modo streaming y va entregando los trozos de texto según llegan.
+        Solo se reintenta (con otra clave si hace falta) mientras no se haya entregado ningún trozo;
+        un fallo a mitad de respuesta se propaga al llamador. Si pasan más de 'stream_chunk_timeout'
+        segundos sin un trozo nuevo se abandona la respuesta (TimeoutError) y cuenta como fallo de la clave.
+        """
+        last_error = None
+        for attempt in range(self.max_attempts):
+            key = await self._acquire(attempt, last_error)
+            started = time.monotonic()
+            yielded = False
+            usage = None
+            cache_name = None
+            try:
+                model, contents, cache_name = await self._prepare(key, prompt, cached_prefix)
+                response = await asyncio.wait_for(model.generate_content_async(contents, stream=True), self.request_timeout)
+                chunks = response.__aiter__()
+                while True:
+                    # Un stream que se queda parado no debe retener la clave ni el turno del planificador
+                    try:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), self.stream_chunk_timeout)
+                    except StopAsyncIteration:
+                        break
+                    # El último trozo trae el recuento de tokens de toda la respuesta
+                    usage = getattr(chunk, "usage_metadata", None) or usage
+                    text = chunk.text
+                    if text:
+                        if not yielded: metrics.LLM_FIRST_CHUNK_SECONDS.observe(time.monotonic() - started, key=key.label)
+                        yielded = True
+                        yield text
+                self._record_success(key, started, usage)
+                return
+            except Exception as e:
+                last_error = e
+                if yielded:
+                    key.errors += 1
+                    metrics.LLM_CALL_SECONDS.observe(time.monotonic() - started, key=key.label, outcome=type(e).__name__)
+                    if isinstance(e, asyncio.TimeoutError):
+                        logger.warning(f"El stream de la clave {key.label} se detuvo a mitad de respuesta.")
+                        self._count_transient_failure(key)
+                    raise
+                if self._cache_rejected(key, cached_prefix, cache_name, e):
+                    # Se reintenta con el prompt completo; la caché se vuelve a crear en la próxima pregunta
+                    cached_prefix = None
+                    continue
+                await self._record_failure(key, started, e, attempt)
+            finally:
+                key.in_flight -= 1
+        raise NoAvailableKeyError("No se pudo obtener una respuesta válida de la API.", last_error)
+
+    def stats(self) -> list:
+        return [key.snapshot() for key in self.keys]
+
+    def metric_samples(self) -> list:
+        """Estado de cada clave para la ruta de métricas (ver 'metrics.register_collector')."""
+        snapshots = self.stats()
+        def family(name, kind, documentation, field):
+            return (name, kind, documentation, [({"key": s["key"]}, float(s[field])) for s in snapshots])
+        return [
+            family("bot_llm_key_in_flight", "gauge", "Llamadas en curso por clave API.", "in_flight"),
+            family("bot_llm_key_calls", "counter", "Llamadas iniciadas por clave API.", "calls"),
+            family("bot_llm_key_errors", "counter", "Errores por clave API.", "errors"),
+            family("bot_llm_key_quota_errors", "counter", "Errores de cuota por clave API.", "quota_errors"),
+            family("bot_llm_key_circuit_open", "gauge", "1 si la clave está fuera de rotación.", "circuit_open"),
+        ]
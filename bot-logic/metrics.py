@@ -0,0 +1,186 @@
+# bot_logic/metrics.py
+
+import bisect
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Obtenemos una instancia del logger para este módulo
+logger = logging.getLogger(__name__)
+
+# Con METRICS_JSON_LOGS=1 cada etapa medida se escribe además como una línea JSON en el log.
+METRICS_JSON_LOGS = os.getenv("METRICS_JSON_LOGS", "0") == "1"
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+# Si se configura, la ruta de métricas exige 'Authorization: Bearer <METRICS_TOKEN>'.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+CHARS_BUCKETS = (100, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000, 1000000, 4000000)
+TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 100000, 250000, 1000000)
+
+_metrics = []
+_collectors = []
+# Campos que acompañan a los logs JSON de la tarea actual (update_id, user_id...).
+_context = contextvars.ContextVar("metrics_context", default={})
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labels: dict) -> str:
+    if not labels: return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+def _format_value(value) -> str:
+    if value == float("inf"): return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        _metrics.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key: tuple, **extra) -> dict:
+        return {**dict(zip(self.labelnames, key)), **extra}
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._render_samples(items))
+        return lines
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_samples(self, items):
+        return [f"{self.name}_total{_format_labels(self._labels(key))} {_format_value(value)}" for key, value in items]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # [conteo por bucket (no acumulado), suma, total]
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets): entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def _render_samples(self, items):
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(self._labels(key, le=_format_value(float(bound))))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self._labels(key, le='+Inf'))} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self._labels(key))} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self._labels(key))} {count}")
+        return lines
+
+def register_collector(collector):
+    """
+    Registra una función que se llama en cada lectura de métricas y devuelve valores calculados en ese
+    momento: una lista de (nombre, tipo, descripción, [(etiquetas, valor)]). Sirve para exponer
+    estadísticas que ya lleva otro módulo (caché de respuestas, pool de claves) sin duplicarlas.
+    """
+    _collectors.append(collector)
+
+def render() -> str:
+    """Todas las métricas en el formato de texto de Prometheus."""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for collector in _collectors:
+        try:
+            families = collector()
+        except Exception as e:
+            logger.warning(f"Fallo en un colector de métricas: {e}")
+            continue
+        for name, kind, documentation, samples in families:
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            suffix = "_total" if kind == "counter" else ""
+            lines.extend(f"{name}{suffix}{_format_labels(labels)} {_format_value(value)}" for labels, value in samples)
+    return "\n".join(lines) + "\n"
+
+def authorized(authorization_header: str) -> bool:
+    return not METRICS_TOKEN or authorization_header == f"Bearer {METRICS_TOKEN}"
+
+# ===================== SPANS Y LOGS ESTRUCTURADOS =====================
+@contextmanager
+def bind(**fields):
+    """Añade campos (p. ej. update_id o user_id) a todos los logs JSON emitidos dentro del bloque."""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+def log_event(event: str, **fields):
+    if not METRICS_JSON_LOGS: return
+    record = {"event": event, "ts": round(time.time(), 3), **_context.get(), **fields}
+    logger.info(json.dumps(record, ensure_ascii=False, default=str))
+
+@contextmanager
+def span(stage: str, **fields):
+    """
+    Mide la duración de una etapa y la registra en 'bot_stage_seconds{stage=...}'.
+    Funciona igual alrededor de código síncrono o de 'await':
+
+        with metrics.span("build_prompt"):
+            prompt = build_prompt(...)
+    """
+    started = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        STAGE_SECONDS.observe(duration, stage=stage)
+        if outcome != "ok": STAGE_ERRORS.inc(stage=stage)
+        log_event("span", stage=stage, duration_ms=round(duration * 1000, 3), outcome=outcome, **fields)
+
+# ===================== MÉTRICAS DEL BOT =====================
+STAGE_SECONDS = Histogram("bot_stage_seconds", "Duración de cada etapa del procesamiento de un update.", ["stage"])
+STAGE_ERRORS = Counter("bot_stage_errors", "Etapas que terminaron con una excepción.", ["stage"])
+PROMPT_CHARS = Histogram("bot_prompt_chars", "Caracteres del prompt enviado a Gemini.", ["detail_level"], CHARS_BUCKETS)
+RESPONSE_CHARS = Histogram("bot_response_chars", "Caracteres de la respuesta de Gemini.", ["detail_level"], CHARS_BUCKETS)
+LLM_TOKENS = Histogram("bot_llm_tokens", "Tokens por llamada a Gemini según usage_metadata.", ["kind"], TOKEN_BUCKETS)
+LLM_CALL_SECONDS = Histogram("bot_llm_call_seconds", "Duración de cada llamada a Gemini por clave API.", ["key", "outcome"])
+LLM_FIRST_CHUNK_SECONDS = Histogram("bot_llm_first_chunk_seconds", "Tiempo hasta el primer trozo en streaming por clave API.", ["key"])
+LLM_SCHEDULER_REJECTED = Counter("bot_llm_scheduler_rejected", "Preguntas rechazadas por el planificador de llamadas a Gemini.", ["reason"])
+UPDATES_SKIPPED = Counter("bot_updates_skipped", "Updates no procesados: reentregas de Telegram o pulsaciones fusionadas.", ["reason"])
+TELEGRAM_API_SECONDS = Histogram("bot_telegram_api_seconds", "Duración de cada llamada al Bot API de Telegram.", ["method"])
+WORKER_RESTARTS = Counter("bot_worker_restarts", "Procesos worker que cayeron y se arrancaron de nuevo.", ["worker"])
+SPECULATIVE_ANSWERS = Counter("bot_speculative_answers", "Respuestas especulativas a preguntas sugeridas por resultado.", ["outcome"])
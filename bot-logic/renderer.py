@@ -0,0 +1,259 @@
+# bot_logic/renderer.py
+
+import asyncio
+import logging
+import re
+
+from telegram.constants import ParseMode
+from telegram.error import BadRequest
+
+# Obtenemos una instancia del logger para este módulo
+logger = logging.getLogger(__name__)
+
+TELEGRAM_LIMIT = 4096
+# Caracteres que MarkdownV2 obliga a escapar fuera de las entidades.
+_SPECIAL_CHARS = re.compile(r"([_*\[\]()~`>#+\-=|{}.!\\])")
+_CODE_CHARS = re.compile(r"([`\\])")
+_URL_CHARS = re.compile(r"([)\\])")
+
+# Formato en línea que usa Gemini: código, enlaces, **negrita**, __negrita__, ~~tachado~~, *cursiva*, _cursiva_
+_INLINE_RE = re.compile(
+    r"`(?P<code>[^`\n]+)`"
+    r"|\[(?P<link_text>[^\]\n]+)\]\((?P<link_url>[^()\s]+)\)"
+    r"|\*\*(?P<bold>(?:(?!\*\*).)+?)\*\*"
+    r"|__(?P<bold2>(?:(?!__).)+?)__"
+    r"|~~(?P<strike>(?:(?!~~).)+?)~~"
+    r"|(?<![\w*])\*(?P<italic>[^\s*](?:[^*\n]*?[^\s*])?)\*(?![\w*])"
+    r"|(?<![\w_])_(?P<italic2>[^\s_](?:[^_\n]*?[^\s_])?)_(?![\w_])"
+)
+_HEADING_RE = re.compile(r"^\s{0,3}#{1,6}\s+(.*?)\s*#*\s*$")
+_BULLET_RE = re.compile(r"^(\s*)[*+\-•]\s+(.*)$")
+_NUMBERED_RE = re.compile(r"^(\s*)(\d{1,3})[.)]\s+(.*)$")
+_QUOTE_RE = re.compile(r"^\s*>\s?(.*)$")
+_FENCE_RE = re.compile(r"^\s*```\s*([\w+-]*)\s*$")
+
+def utf16_len(text: str) -> int:
+    """Longitud tal como la cuenta Telegram (unidades UTF-16: un emoji suele contar 2)."""
+    return len(text.encode("utf-16-le")) // 2
+
+def utf16_fit(text: str, limit: int) -> int:
+    """Cuántos caracteres del principio de 'text' caben en 'limit' unidades UTF-16 (sin partir un emoji)."""
+    # Ningún carácter ocupa menos de una unidad: basta con mirar los 'limit' primeros
+    return len(text[:limit].encode("utf-16-le")[:2 * limit].decode("utf-16-le", "ignore"))
+
+def escape(text: str) -> str:
+    """Escapa texto literal para MarkdownV2."""
+    return _SPECIAL_CHARS.sub(r"\\\1", text)
+
+def _escape_code(text: str) -> str:
+    return _CODE_CHARS.sub(r"\\\1", text)
+
+def _escape_url(url: str) -> str:
+    return _URL_CHARS.sub(r"\\\1", url)
+
+def split_point(text: str, limit: int) -> int:
+    """
+    Posición (en caracteres) donde cortar 'text' para que el trozo no pase de 'limit' unidades UTF-16,
+    como las cuenta Telegram: fin de párrafo, de línea o de palabra. Siempre avanza al menos un carácter.
+    """
+    end = utf16_fit(text, limit)
+    if end == len(text): return end
+    for separator in ("\n\n", "\n", " "):
+        cut = text.rfind(separator, end // 2, end)
+        if cut != -1: return cut + len(separator)
+    return max(1, end)
+
+class _Style:
+    """Marcas de cada formato: MarkdownV2 o, con 'plain', texto sin formato (para el envío de reserva)."""
+
+    def __init__(self, plain: bool):
+        self.plain = plain
+
+    def text(self, text: str) -> str:
+        return text if self.plain else escape(text)
+
+    def wrap(self, marker: str, inner: str) -> str:
+        return inner if self.plain else f"{marker}{inner}{marker}"
+
+    def code(self, text: str) -> str:
+        return text if self.plain else f"`{_escape_code(text)}`"
+
+    def link(self, inner: str, url: str) -> str:
+        return f"{inner} ({url})" if self.plain else f"[{inner}]({_escape_url(url)})"
+
+    def code_block(self, language: str, body: str) -> str:
+        return body if self.plain else f"```{language}\n{_escape_code(body)}\n```"
+
+MARKDOWN = _Style(plain=False)
+PLAIN = _Style(plain=True)
+
+def render_inline(text: str, style: _Style, inside: frozenset = frozenset()) -> str:
+    """
+    Convierte el formato en línea de una línea de texto. Las marcas sin pareja se escapan como texto,
+    y un formato dentro de sí mismo (p. ej. cursiva dentro de cursiva) se deja sin marca.
+    """
+    out = []
+    position = 0
+    for match in _INLINE_RE.finditer(text):
+        out.append(style.text(text[position:match.start()]))
+        position = match.end()
+        groups = match.groupdict()
+        if groups["code"] is not None:
+            out.append(style.code(groups["code"]))
+        elif groups["link_text"] is not None:
+            out.append(style.link(render_inline(groups["link_text"], style, inside | {"link"}), groups["link_url"]) if "link" not in inside
+                       else style.text(match.group(0)))
+        else:
+            kind, marker = next((k, m) for k, m in (("bold", "*"), ("bold2", "*"), ("strike", "~"), ("italic", "_"), ("italic2", "_")) if groups[k] is not None)
+            name = {"bold2": "bold", "italic2": "italic"}.get(kind, kind)
+            inner = render_inline(groups[kind], style, inside | {name})
+            if name in inside:
+                out.append(inner)
+                continue
+            # '_' de cierre seguido de '_' de apertura se leería como subrayado ('__'); Telegram ignora '\r'
+            if marker == "_" and not style.plain and out and out[-1].endswith("_"): out.append("\r")
+            out.append(style.wrap(marker, inner))
+    out.append(style.text(text[position:]))
+    return "".join(out)
+
+def render_line(line: str, style: _Style) -> str:
+    """Una línea de texto: títulos en negrita, viñetas y listas numeradas, citas y formato en línea."""
+    if (match := _HEADING_RE.match(line)):
+        return style.wrap("*", render_inline(match.group(1), style, frozenset({"bold"})))
+    if (match := _BULLET_RE.match(line)):
+        return f"{match.group(1)}• {render_inline(match.group(2), style)}"
+    if (match := _NUMBERED_RE.match(line)):
+        return f"{match.group(1)}{match.group(2)}{style.text('.')} {render_inline(match.group(3), style)}"
+    if (match := _QUOTE_RE.match(line)):
+        return render_inline(match.group(1), style) if style.plain else ">" + render_inline(match.group(1), style)
+    return render_inline(line, style)
+
+def _paragraphs(text: str):
+    """Divide el texto en párrafos (separados por líneas en blanco) y bloques de código: [(lenguaje o None, líneas)]."""
+    paragraphs, current, code, language = [], [], None, ""
+    for line in text.replace("\r\n", "\n").split("\n"):
+        fence = _FENCE_RE.match(line)
+        if code is not None:
+            if fence and not fence.group(1):
+                paragraphs.append((language, code))
+                code = None
+            else:
+                code.append(line)
+        elif fence:
+            if current: paragraphs.append((None, current))
+            current, code, language = [], [], fence.group(1)
+        elif not line.strip():
+            if current: paragraphs.append((None, current))
+            current = []
+        else:
+            current.append(line)
+    # Un bloque de código sin cerrar se cierra al final; un párrafo pendiente se añade tal cual
+    if code is not None: paragraphs.append((language, code))
+    if current: paragraphs.append((None, current))
+    return paragraphs
+
+def _render_both(render, *args):
+    return render(*args, MARKDOWN), render(*args, PLAIN)
+
+def _split_line(line: str, limit: int) -> list:
+    """Trocea una línea demasiado larga en fin de palabra; cada trozo se renderiza por separado y cabe en 'limit'."""
+    pieces = []
+    while line:
+        budget = limit
+        while True:
+            cut = split_point(line, budget)
+            rendered = render_line(line[:cut], MARKDOWN)
+            if utf16_len(rendered) <= limit or budget <= 1: break
+            budget //= 2
+        pieces.append((rendered, render_line(line[:cut], PLAIN)))
+        line = line[cut:]
+    return pieces
+
+def _code_blocks(language: str, lines: list, limit: int) -> list:
+    """Un bloque de código que no cabe se reparte en varios bloques completos."""
+    blocks, body = [], []
+    for line in lines:
+        line = line[:limit // 2]
+        if body and utf16_len(MARKDOWN.code_block(language, "\n".join(body + [line]))) > limit:
+            blocks.append(body)
+            body = []
+        body.append(line)
+    blocks.append(body)
+    return [(MARKDOWN.code_block(language, "\n".join(b)), PLAIN.code_block(language, "\n".join(b))) for b in blocks]
+
+def _units(text: str, limit: int):
+    """
+    Genera (MarkdownV2, texto plano, separador previo) de forma que cada unidad cabe en un mensaje:
+    párrafos enteros si caben y, si no, sus líneas (o trozos de línea, o varios bloques de código).
+    """
+    for language, lines in _paragraphs(text):
+        if language is not None:
+            pieces = _code_blocks(language, lines, limit)
+        else:
+            rendered = [_render_both(render_line, line) for line in lines]
+            paragraph = ("\n".join(m for m, _ in rendered), "\n".join(p for _, p in rendered))
+            if utf16_len(paragraph[0]) <= limit:
+                yield (*paragraph, "\n\n")
+                continue
+            pieces = []
+            for line, (markdown, plain) in zip(lines, rendered):
+                pieces.extend([(markdown, plain)] if utf16_len(markdown) <= limit else _split_line(line, limit))
+        for i, (markdown, plain) in enumerate(pieces):
+            yield markdown, plain, "\n\n" if i == 0 else "\n"
+
+class RenderedMessage:
+    """Un mensaje listo para enviar: 'markdown' en MarkdownV2 válido y 'plain' con el mismo texto sin formato."""
+
+    __slots__ = ("markdown", "plain")
+
+    def __init__(self, markdown: str, plain: str):
+        self.markdown = markdown
+        self.plain = plain
+
+def render_messages(text: str, limit: int = TELEGRAM_LIMIT) -> list:
+    """
+    Convierte la respuesta del modelo a MarkdownV2 de Telegram y la reparte en mensajes de como mucho
+    'limit' caracteres, cortando entre párrafos (o líneas) para que ninguna entidad quede partida.
+    Así cada mensaje se envía una sola vez, sin probar con Markdown y reenviar como texto plano.
+    """
+    messages, markdown, plain = [], "", ""
+    for unit_markdown, unit_plain, separator in _units(text, limit):
+        candidate = f"{markdown}{separator}{unit_markdown}" if markdown else unit_markdown
+        if utf16_len(candidate) <= limit:
+            markdown = candidate
+            plain = f"{plain}{separator}{unit_plain}" if plain else unit_plain
+        else:
+            messages.append(RenderedMessage(markdown, plain))
+            markdown, plain = unit_markdown, unit_plain
+    if markdown or not messages: messages.append(RenderedMessage(markdown or escape("…"), plain or "…"))
+    return messages
+
+async def send_message(bot, chat_id: int, message: RenderedMessage, reply_markup=None):
+    """Envía un mensaje renderizado en MarkdownV2 y devuelve el Message de Telegram."""
+    try:
+        return await bot.send_message(chat_id=chat_id, text=message.markdown, parse_mode=ParseMode.MARKDOWN_V2, reply_markup=reply_markup)
+    except BadRequest as e:
+        # No debería pasar: sería un fallo del renderizado. Se registra y no se pierde la respuesta.
+        if "can't parse entities" not in str(e).lower(): raise
+        logger.error(f"Telegram rechazó el MarkdownV2 renderizado ({e}). Se envía sin formato.")
+        return await bot.send_message(chat_id=chat_id, text=message.plain, reply_markup=reply_markup)
+
+async def send_messages(bot, chat_id: int, messages: list, reply_markup=None, replaces=None):
+    """
+    Envía los mensajes en orden; el teclado va solo en el último. Si se pasa 'replaces' (p. ej. el
+    mensaje 'Analizando...'), se borra a la vez que se envía el primero en lugar de antes.
+    Los envíos de cada parte son secuenciales: Telegram los muestra en el orden en que llegan.
+    """
+    deletion = asyncio.ensure_future(_delete(replaces)) if replaces is not None else None
+    try:
+        for i, message in enumerate(messages):
+            await send_message(bot, chat_id, message, reply_markup if i == len(messages) - 1 else None)
+    finally:
+        if deletion is not None: await deletion
+
+async def _delete(message):
+    try:
+        await message.delete()
+    except BadRequest as e:
+        if "not found" in str(e).lower(): logger.warning("El mensaje 'Analizando...' ya había sido borrado.")
+        else: raise
@@ -0,0 +1,300 @@
+# bot_logic/retrieval.py
+
+import logging
+import math
+import os
+import re
+import threading
+import unicodedata
+from array import array
+from collections import Counter, OrderedDict
+
+# Obtenemos una instancia del logger para este módulo
+logger = logging.getLogger(__name__)
+
+# Tamaño de cada fragmento y solapamiento entre fragmentos consecutivos (en caracteres).
+# El solapamiento evita que una idea quede partida justo en el borde de dos fragmentos.
+CHUNK_CHARS = int(os.getenv("RETRIEVAL_CHUNK_CHARS", 1200))
+CHUNK_OVERLAP = int(os.getenv("RETRIEVAL_CHUNK_OVERLAP", 200))
+
+# Parámetros estándar de BM25.
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Cuántos fragmentos y cuántos caracteres como máximo van al prompt según el nivel de detalle.
+DETAIL_CONFIG = {
+    "simple": {
+        "top_k": int(os.getenv("RETRIEVAL_SIMPLE_TOP_K", 6)),
+        "max_chars": int(os.getenv("RETRIEVAL_SIMPLE_MAX_CHARS", 12000)),
+    },
+    "detailed": {
+        "top_k": int(os.getenv("RETRIEVAL_DETAILED_TOP_K", 24)),
+        "max_chars": int(os.getenv("RETRIEVAL_DETAILED_MAX_CHARS", 60000)),
+    },
+}
+
+# Número máximo de índices que se mantienen en memoria a la vez.
+MAX_CACHED_INDEXES = int(os.getenv("RETRIEVAL_MAX_CACHED_INDEXES", 32))
+
+PASSAGE_SEPARATOR = "\n[...]\n"
+
+_TOKEN_RE = re.compile(r"\w+")
+_STOPWORDS = frozenset("""
+a al algo ante antes como con cual cuales cuando de del desde donde el ella ellas ellos en entre era es esa
+esas ese eso esos esta estas este esto estos fue ha hay la las le les lo los mas me mi mas muy no nos o para
+pero por porque que quien se segun ser si sin sobre son su sus tambien te tiene un una uno unos unas y ya
+""".split())
+
+def tokenize(text: str) -> list:
+    """
+    Divide un texto en términos normalizados: minúsculas, sin tildes y sin palabras vacías.
+    Se usa la misma función para indexar y para consultar.
+    """
+    normalized = unicodedata.normalize("NFKD", text.lower())
+    normalized = "".join(c for c in normalized if not unicodedata.combining(c))
+    return [t for t in _TOKEN_RE.findall(normalized) if len(t) > 1 and t not in _STOPWORDS]
+
+def _chunk_bounds(text: str, offset: int, start: int, length: int, chunk_chars: int, overlap: int):
+    """
+    Un paso del troceo: para el fragmento que empieza en 'start' devuelve (fin, inicio del siguiente,
+    o None si es el último). 'text' es el documento a partir de la posición 'offset' y 'length' su
+    longitud total (o cualquier valor mayor que start + chunk_chars si aún no se conoce).
+    Los cortes se desplazan hacia el salto de línea o espacio más cercano para no partir palabras.
+    """
+    end = min(start + chunk_chars, length)
+    if end < length:
+        window_start = start + chunk_chars // 2
+        cut = text.rfind("\n", window_start - offset, end - offset)
+        if cut == -1: cut = text.rfind(" ", window_start - offset, end - offset)
+        if cut != -1: end = cut + offset + 1
+    if end >= length: return end, None
+    next_start = max(end - overlap, start + 1)
+    # Igual que al cortar, empezamos el siguiente fragmento al inicio de una palabra.
+    space = text.find(" ", next_start - offset, end - offset)
+    if space != -1: next_start = space + offset + 1
+    return end, next_start
+
+def split_into_chunks(text: str, chunk_chars: int = CHUNK_CHARS, overlap: int = CHUNK_OVERLAP):
+    """Devuelve dos arrays (inicios, finales) con los límites de cada fragmento dentro de 'text'."""
+    import numpy as np  # se importa al indexar el primer documento, no al arrancar
+    starts, ends = [], []
+    start = 0 if text else None
+    while start is not None:
+        end, next_start = _chunk_bounds(text, 0, start, len(text), chunk_chars, overlap)
+        starts.append(start); ends.append(end)
+        start = next_start
+    return np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+
+class BM25Builder:
+    """
+    Construye un BM25Index con el texto por trozos ('feed'), p. ej. según se extrae: solo guarda la
+    parte del texto a partir del fragmento en curso, y las apariciones en arrays compactos en vez de
+    listas de enteros. Los fragmentos son los mismos que daría 'split_into_chunks' con el texto entero.
+    """
+
+    def __init__(self, chunk_chars: int = CHUNK_CHARS, overlap: int = CHUNK_OVERLAP):
+        self.chunk_chars = chunk_chars
+        self.overlap = overlap
+        # Texto pendiente desde la posición '_offset'; '_length' es lo recibido hasta ahora
+        self._buffer = ""
+        self._offset = 0
+        self._length = 0
+        self._start = 0
+        self.vocab = {}
+        self._starts, self._ends, self._lens = array("q"), array("q"), array("f")
+        self._term_ids, self._chunk_ids, self._tfs = array("i"), array("i"), array("f")
+
+    @property
+    def fed(self) -> bool:
+        return self._length > 0
+
+    def feed(self, piece: str):
+        if not piece: return
+        self._buffer += piece
+        self._length += len(piece)
+        # Un fragmento se puede cerrar en cuanto hay texto más allá de su tamaño máximo
+        while self._start is not None and self._start + self.chunk_chars < self._length:
+            self._emit(self._length)
+        if self._start is not None and self._start > self._offset:
+            self._buffer = self._buffer[self._start - self._offset:]
+            self._offset = self._start
+
+    def _emit(self, length: int):
+        start = self._start
+        end, self._start = _chunk_bounds(self._buffer, self._offset, start, length, self.chunk_chars, self.overlap)
+        tokens = tokenize(self._buffer[start - self._offset:end - self._offset])
+        chunk_id = len(self._starts)
+        self._starts.append(start); self._ends.append(end); self._lens.append(len(tokens))
+        for term, tf in Counter(tokens).items():
+            self._term_ids.append(self.vocab.setdefault(term, len(self.vocab)))
+            self._chunk_ids.append(chunk_id)
+            self._tfs.append(tf)
+
+    def finish(self) -> "BM25Index":
+        import numpy as np
+        while self._start is not None and self._start < self._length:
+            self._emit(self._length)
+        self._buffer = ""
+        vocab = self.vocab
+        term_ids = np.frombuffer(self._term_ids, dtype=np.int32)
+        order = np.argsort(term_ids, kind="stable")
+        term_ptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=len(vocab)), out=term_ptr[1:])
+        post_chunks = np.frombuffer(self._chunk_ids, dtype=np.int32)[order]
+        post_tf = np.frombuffer(self._tfs, dtype=np.float32)[order]
+        return BM25Index(vocab, np.array(self._starts, dtype=np.int64), np.array(self._ends, dtype=np.int64),
+                         np.array(self._lens, dtype=np.float32), term_ptr, post_chunks, post_tf)
+
+class BM25Index:
+    """
+    Índice BM25 de un documento almacenado en arrays de NumPy (formato tipo CSC):
+    para cada término 'term_ptr[t]:term_ptr[t+1]' delimita sus apariciones en
+    'post_chunks' (fragmento) y 'post_tf' (frecuencia en ese fragmento).
+    """
+
+    def __init__(self, vocab, chunk_starts, chunk_ends, chunk_lens, term_ptr, post_chunks, post_tf):
+        self.vocab = vocab
+        self.chunk_starts = chunk_starts
+        self.chunk_ends = chunk_ends
+        self.chunk_lens = chunk_lens
+        self.term_ptr = term_ptr
+        self.post_chunks = post_chunks
+        self.post_tf = post_tf
+        self.avg_len = float(chunk_lens.mean()) if len(chunk_lens) else 0.0
+
+    @property
+    def num_chunks(self) -> int:
+        return len(self.chunk_starts)
+
+    @classmethod
+    def build(cls, text: str):
+        """Fragmenta 'text' y construye su índice."""
+        builder = BM25Builder()
+        builder.feed(text)
+        return builder.finish()
+
+    def scores(self, query: str):
+        """Calcula la puntuación BM25 de todos los fragmentos para la consulta."""
+        import numpy as np
+        scores = np.zeros(self.num_chunks, dtype=np.float32)
+        if not self.num_chunks: return scores
+        n = self.num_chunks
+        for term in set(tokenize(query)):
+            term_id = self.vocab.get(term)
+            if term_id is None: continue
+            lo, hi = int(self.term_ptr[term_id]), int(self.term_ptr[term_id + 1])
+            chunks = self.post_chunks[lo:hi]
+            tf = self.post_tf[lo:hi]
+            df = hi - lo
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.chunk_lens[chunks] / max(self.avg_len, 1.0))
+            # Cada fragmento aparece una sola vez por término, así que la indexación directa es segura.
+            scores[chunks] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return scores
+
+    def search(self, query: str, top_k: int):
+        """Devuelve una lista [(id_fragmento, puntuación)] con los 'top_k' mejores, de mayor a menor."""
+        import numpy as np
+        scores = self.scores(query)
+        if not self.num_chunks: return []
+        top_k = min(top_k, self.num_chunks)
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(int(c), float(scores[c])) for c in candidates if scores[c] > 0]
+
+    def chunk_text(self, text: str, chunk_id: int) -> str:
+        return text[int(self.chunk_starts[chunk_id]):int(self.chunk_ends[chunk_id])]
+
+_index_lock = threading.Lock()
+_indexes = OrderedDict()
+
+def get_index(doc_key: str, text: str) -> BM25Index:
+    """
+    Devuelve el índice del documento identificado por 'doc_key' (el hash de su contenido),
+    construyéndolo la primera vez. Se mantienen en memoria los MAX_CACHED_INDEXES más recientes.
+    """
+    with _index_lock:
+        index = _indexes.get(doc_key)
+        if index is not None:
+            _indexes.move_to_end(doc_key)
+            return index
+    index = BM25Index.build(text)
+    logger.info(f"Índice BM25 construido para {doc_key[:12]}: {index.num_chunks} fragmentos, {len(index.vocab)} términos.")
+    register_index(doc_key, index)
+    return index
+
+def has_index(doc_key: str) -> bool:
+    with _index_lock:
+        return doc_key in _indexes
+
+def register_index(doc_key: str, index: BM25Index):
+    """Registra un índice ya construido (por ejemplo, uno cargado desde disco)."""
+    with _index_lock:
+        _indexes[doc_key] = index
+        _indexes.move_to_end(doc_key)
+        while len(_indexes) > MAX_CACHED_INDEXES:
+            _indexes.popitem(last=False)
+
+def drop_index(doc_key: str):
+    with _index_lock:
+        _indexes.pop(doc_key, None)
+
+def select_passages(index: BM25Index, text: str, question: str, top_k: int, max_chars: int):
+    """
+    Elige los fragmentos más relevantes sin superar 'max_chars' y los devuelve
+    como [(id_fragmento, puntuación, texto)] en orden de relevancia.
+    Si ningún fragmento coincide con la pregunta, se usan los primeros del documento.
+    """
+    hits = index.search(question, top_k)
+    if not hits:
+        hits = [(i, 0.0) for i in range(min(top_k, index.num_chunks))]
+    selected, used = [], 0
+    for chunk_id, score in hits:
+        passage = index.chunk_text(text, chunk_id)
+        if used + len(passage) > max_chars and selected: break
+        selected.append((chunk_id, score, passage[:max_chars]))
+        used += len(passage) + len(PASSAGE_SEPARATOR)
+    return selected
+
+def build_context(doc_key: str, text: str, question: str, detail_level: str, max_chars: int = None) -> str:
+    """
+    Construye el contexto que va al prompt: el documento entero si cabe en el presupuesto del
+    nivel de detalle o, si no, solo los fragmentos más relevantes en el orden en que aparecen.
+    """
+    config = DETAIL_CONFIG.get(detail_level, DETAIL_CONFIG["simple"])
+    budget = config["max_chars"] if max_chars is None else min(config["max_chars"], max_chars)
+    if len(text) <= budget: return text
+    index = get_index(doc_key, text)
+    selected = select_passages(index, text, question, config["top_k"], budget)
+    selected.sort(key=lambda item: item[0])
+    return PASSAGE_SEPARATOR.join(passage.strip() for _, _, passage in selected)
+
+def search_passages(index: BM25Index, text: str, question: str, top_k: int):
+    """Los 'top_k' fragmentos que coinciden con la pregunta como [(id_fragmento, puntuación, texto)]; sin relleno."""
+    return [(chunk_id, score, index.chunk_text(text, chunk_id)) for chunk_id, score in index.search(question, top_k)]
+
+def build_multi_context(results, detail_level: str, max_chars: int = None):
+    """
+    Contexto con varios documentos a partir de los resultados de 'search_passages' de cada uno
+    ('results' es [(nombre, fragmentos)] en el orden de los documentos). Se eligen los mejores fragmentos
+    de todos juntos con el mismo 'top_k' y presupuesto que una pregunta sobre un solo documento, así el
+    tamaño del prompt no crece con el número de documentos. Cada documento aparece una vez, con su nombre
+    entre corchetes delante de sus fragmentos (en el orden en que aparecen en él).
+    Devuelve (contexto, nombres de los documentos usados).
+    """
+    config = DETAIL_CONFIG.get(detail_level, DETAIL_CONFIG["simple"])
+    budget = config["max_chars"] if max_chars is None else min(config["max_chars"], max_chars)
+    candidates = [(score, position, chunk_id, passage) for position, (_, hits) in enumerate(results) for chunk_id, score, passage in hits]
+    # Las puntuaciones BM25 de índices distintos no son del todo comparables, pero sí lo bastante para ordenar
+    candidates.sort(key=lambda c: -c[0])
+    selected, used = {}, 0
+    for score, position, chunk_id, passage in candidates[:config["top_k"]]:
+        cost = len(passage) + len(PASSAGE_SEPARATOR) + (0 if position in selected else len(results[position][0]) + 4)
+        if used + cost > budget and selected: break
+        selected.setdefault(position, []).append((chunk_id, passage[:budget]))
+        used += cost
+    sections = []
+    for position in sorted(selected):
+        passages = sorted(selected[position])
+        sections.append(f"[{results[position][0]}]\n" + PASSAGE_SEPARATOR.join(passage.strip() for _, passage in passages))
+    return "\n\n".join(sections), [results[position][0] for position in sorted(selected)]
@@ -0,0 +1,273 @@
+# bot_logic/scheduler.py
+
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from bot_logic import metrics
+
+# Obtenemos una instancia del logger para este módulo
+logger = logging.getLogger(__name__)
+
+# Llamadas a Gemini a la vez (entre todas las claves) y cuántas pueden esperar turno antes de rechazar.
+MAX_CONCURRENT_CALLS = int(os.getenv("LLM_MAX_CONCURRENT_CALLS", 8))
+MAX_QUEUED_CALLS = int(os.getenv("LLM_MAX_QUEUED_CALLS", 32))
+# Llamadas de baja prioridad (respuestas especulativas) a la vez; nunca más que los huecos libres.
+MAX_BACKGROUND_CALLS = int(os.getenv("LLM_MAX_BACKGROUND_CALLS", max(1, MAX_CONCURRENT_CALLS // 4)))
+# Cubo de tokens por usuario: capacidad y tokens que se recuperan por minuto.
+USER_BURST = float(os.getenv("LLM_USER_BURST", 6))
+USER_RATE_PER_MINUTE = float(os.getenv("LLM_USER_RATE_PER_MINUTE", 6))
+# Coste de cada pregunta según el nivel de detalle: se descuenta del cubo del usuario y ordena la cola
+# (a menor coste, antes se atiende). Con los valores por defecto una respuesta simple pasa por delante
+# de las detalladas que ya esperan, y un usuario puede pedir 2 detalladas seguidas o 6 simples.
+LEVEL_COSTS = {
+    "simple": float(os.getenv("LLM_COST_SIMPLE", 1)),
+    "detailed": float(os.getenv("LLM_COST_DETAILED", 3)),
+}
+# Usuarios cuyo cubo se recuerda; por encima se olvidan los que ya lo tienen lleno.
+MAX_TRACKED_USERS = 10000
+# Duración estimada de una llamada hasta que haya mediciones (para el tiempo de espera que se sugiere).
+INITIAL_SERVICE_SECONDS = 5.0
+
+class SchedulerRejected(Exception):
+    """La pregunta no entra ahora; 'retry_after' son los segundos recomendados antes de repetirla."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class RateLimitedError(SchedulerRejected):
+    """El usuario agotó su cubo de tokens."""
+
+class QueueFullError(SchedulerRejected):
+    """La cola global está llena; 'position' es el puesto que habría ocupado la pregunta."""
+
+    def __init__(self, message: str, retry_after: float, position: int):
+        super().__init__(message, retry_after)
+        self.position = position
+
+class TokenBucket:
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity: float, rate: float, now: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, cost: float, now: float) -> float:
+        """Descuenta 'cost' y devuelve 0, o devuelve los segundos que faltan para poder hacerlo."""
+        self._refill(now)
+        # Una pregunta más cara que el cubo entero se admite con el cubo lleno
+        cost = min(cost, self.capacity)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class FairScheduler:
+    """
+    Turnos para las llamadas a Gemini, delante de GeminiClientPool:
+
+    - Como mucho 'max_concurrency' llamadas a la vez; el resto espera en una cola de hasta 'max_queue'.
+    - Cada usuario tiene un cubo de tokens ('burst' de capacidad, 'rate_per_minute' de recarga) y cada
+      pregunta gasta el coste de su nivel de detalle ('costs').
+    - La cola es justa entre usuarios (weighted fair queuing): cada pregunta recibe una marca de fin
+      virtual = max(tiempo virtual, fin de la anterior del mismo usuario) + coste, y se atiende antes
+      la de marca menor. Un usuario con muchas preguntas en cola no retrasa a los demás, y las simples
+      adelantan a las detalladas.
+
+    Si el usuario no tiene tokens o la cola está llena se lanza RateLimitedError o QueueFullError en el
+    acto, en vez de dejar la pregunta esperando hasta que Telegram o Gemini agoten su tiempo.
+
+    Las llamadas de fondo ('background', p. ej. respuestas especulativas) van en una cola aparte: solo
+    empiezan si no hay preguntas esperando y hay hueco, como mucho 'max_background' a la vez, y no gastan
+    tokens del usuario (su gasto lo limita quien las pide).
+
+    Con varios procesos worker (bot_logic/sharding.py), 'split' reparte los límites globales entre ellos.
+    """
+
+    def __init__(self, max_concurrency: int = MAX_CONCURRENT_CALLS, max_queue: int = MAX_QUEUED_CALLS,
+                 burst: float = USER_BURST, rate_per_minute: float = USER_RATE_PER_MINUTE, costs: dict = None,
+                 max_background: int = MAX_BACKGROUND_CALLS):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_background = max_background
+        # Límites de todo el bot, antes de repartirlos con 'split'
+        self._limits = (max_concurrency, max_queue, max_background)
+        self.burst = burst
+        self.rate = rate_per_minute / 60.0
+        self.costs = costs or LEVEL_COSTS
+        self._buckets = {}
+        self._last_finish = {}
+        self._virtual_time = 0.0
+        # (marca de fin, orden de llegada, futuro que se resuelve al tocarle el turno)
+        self._queue = []
+        self._seq = itertools.count()
+        self._running = 0
+        # Futuros de las llamadas de fondo en espera (por orden de llegada) y cuántas están en curso
+        self._background = deque()
+        self._background_running = 0
+        self._service_seconds = INITIAL_SERVICE_SECONDS
+        self.admitted = 0
+        self.rate_limited = 0
+        self.queue_full = 0
+
+    def split(self, parts: int):
+        """
+        Se queda con 1/'parts' de los límites globales (llamadas a la vez, cola y llamadas de fondo), para
+        que entre todos los workers no se pase de LLM_MAX_CONCURRENT_CALLS. Los cubos por usuario no se
+        reparten: cada chat va siempre al mismo worker.
+        """
+        concurrency, queue, background = self._limits
+        share = lambda limit: max(1, limit // parts) if limit else 0
+        self.max_concurrency, self.max_queue, self.max_background = share(concurrency), share(queue), share(background)
+        if concurrency < parts:
+            logger.warning(f"LLM_MAX_CONCURRENT_CALLS ({concurrency}) es menor que el número de workers ({parts}): "
+                           f"cada worker hará 1 llamada a la vez.")
+        logger.info(f"Planificador: {self.max_concurrency} llamadas a la vez y {self.max_queue} en cola en este worker ({parts} workers).")
+        # Si el reparto dejó más huecos, pasan las que esperaban
+        self._dispatch()
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    def cost(self, detail_level: str) -> float:
+        return self.costs.get(detail_level, 1.0)
+
+    def _bucket(self, user_id, now: float) -> TokenBucket:
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) >= MAX_TRACKED_USERS: self._forget_idle_users(now)
+            bucket = self._buckets[user_id] = TokenBucket(self.burst, self.rate, now)
+        return bucket
+
+    def _forget_idle_users(self, now: float):
+        for user_id in [u for u, bucket in self._buckets.items() if bucket.is_full(now)]:
+            del self._buckets[user_id]
+            if self._last_finish.get(user_id, 0.0) <= self._virtual_time: self._last_finish.pop(user_id, None)
+
+    def _estimated_wait(self, position: int) -> float:
+        return self._service_seconds * position / max(1, self.max_concurrency)
+
+    async def acquire(self, user_id, detail_level: str):
+        """Espera el turno de la pregunta. Hay que llamar a 'release()' al terminar la llamada."""
+        now = time.monotonic()
+        cost = self.cost(detail_level)
+        # Sin hueco en la cola se rechaza antes de gastar tokens del usuario
+        must_wait = self._running >= self.max_concurrency or self._queue
+        if must_wait and len(self._queue) >= self.max_queue:
+            self.queue_full += 1
+            metrics.LLM_SCHEDULER_REJECTED.inc(reason="queue_full")
+            position = len(self._queue) + 1
+            raise QueueFullError("Cola de llamadas a Gemini llena.", self._estimated_wait(position), position)
+        wait = self._bucket(user_id, now).take(cost, now)
+        if wait:
+            self.rate_limited += 1
+            metrics.LLM_SCHEDULER_REJECTED.inc(reason="rate_limited")
+            raise RateLimitedError(f"El usuario {user_id} superó su límite de preguntas.", wait)
+
+        start = max(self._virtual_time, self._last_finish.get(user_id, 0.0))
+        finish = self._last_finish[user_id] = start + cost
+        self.admitted += 1
+        if not must_wait:
+            self._running += 1
+            self._virtual_time = start
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (finish, next(self._seq), start, future)
+        heapq.heappush(self._queue, entry)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Le tocó el turno justo cuando se canceló: se devuelve el hueco
+                self.release()
+            elif entry in self._queue:
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+            raise
+
+    def _background_has_room(self) -> bool:
+        return not self._queue and self._running < self.max_concurrency and self._background_running < self.max_background
+
+    async def acquire_background(self):
+        """Espera un turno de fondo. Hay que llamar a 'release(background=True)' al terminar."""
+        if not self._background and self._background_has_room():
+            self._running += 1
+            self._background_running += 1
+            return
+        if len(self._background) >= self.max_queue:
+            metrics.LLM_SCHEDULER_REJECTED.inc(reason="background_full")
+            raise QueueFullError("Cola de llamadas de fondo llena.", self._estimated_wait(len(self._background) + 1), len(self._background) + 1)
+        future = asyncio.get_running_loop().create_future()
+        self._background.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(background=True)
+            elif future in self._background:
+                self._background.remove(future)
+            raise
+
+    def release(self, service_seconds: float = None, background: bool = False):
+        self._running -= 1
+        if background: self._background_running -= 1
+        if service_seconds is not None:
+            # Media móvil de la duración de las llamadas, para estimar esperas
+            self._service_seconds = 0.8 * self._service_seconds + 0.2 * service_seconds
+        self._dispatch()
+
+    def _dispatch(self):
+        """Da el turno a las que esperan mientras haya huecos."""
+        while self._queue and self._running < self.max_concurrency:
+            finish, _, start, future = heapq.heappop(self._queue)
+            if future.done(): continue
+            self._running += 1
+            self._virtual_time = start
+            future.set_result(None)
+        # Las de fondo solo aprovechan los huecos que no necesita ninguna pregunta
+        while self._background and self._background_has_room():
+            future = self._background.popleft()
+            if future.done(): continue
+            self._running += 1
+            self._background_running += 1
+            future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, user_id, detail_level: str, background: bool = False):
+        """
+        Turno para una llamada a Gemini:
+
+            async with llm_scheduler.slot(user_id, detail_level):
+                text = await llm_pool.generate(prompt)
+        """
+        with metrics.span("llm_queue"):
+            if background: await self.acquire_background()
+            else: await self.acquire(user_id, detail_level)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started, background)
+
+    def stats(self) -> dict:
+        return {"running": self._running, "queued": len(self._queue), "admitted": self.admitted,
+                "rate_limited": self.rate_limited, "queue_full": self.queue_full,
+                "background_running": self._background_running, "background_queued": len(self._background)}
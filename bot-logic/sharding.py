@@ -0,0 +1,439 @@
+# bot_logic/sharding.py
+
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing.connection import wait as wait_connections
+
+from bot_logic import metrics
+from bot_logic.dispatcher import DRAIN_TIMEOUT, MAX_PENDING_UPDATES, chat_key
+
+# Obtenemos una instancia del logger para este módulo
+logger = logging.getLogger(__name__)
+
+# Con WORKERS > 1, api/server.py y api/polling.py reparten los updates entre procesos.
+WORKERS = int(os.getenv("WORKERS", 1))
+# Puntos de cada worker en el anillo: con más, los chats se reparten de forma más pareja.
+VIRTUAL_NODES = 64
+# Cada cuántos segundos manda cada worker sus estadísticas al proceso principal.
+STATS_INTERVAL = float(os.getenv("WORKER_STATS_INTERVAL", 2.0))
+# Veces que se reenvía un update cuyo worker cayó mientras lo procesaba (después se descarta).
+MAX_REDELIVERIES = 1
+# Segundos que se espera a que arranquen los workers.
+START_TIMEOUT = 120.0
+# Espera antes de arrancar de nuevo un worker caído: se duplica con cada caída seguida, hasta el máximo.
+RESTART_BACKOFF = float(os.getenv("WORKER_RESTART_BACKOFF", 0.5))
+RESTART_BACKOFF_MAX = float(os.getenv("WORKER_RESTART_BACKOFF_MAX", 30.0))
+# Caídas seguidas tras las que un worker deja de reiniciarse y sus chats pasan a los demás.
+MAX_CONSECUTIVE_RESTARTS = int(os.getenv("WORKER_MAX_RESTARTS", 5))
+# Un worker que aguanta vivo estos segundos se considera estable: se olvidan sus caídas anteriores.
+RESTART_RESET_AFTER = 60.0
+# Estadísticas del UpdateDispatcher de cada worker que se suman en 'stats()'.
+_SUMMED_STATS = ("processed", "failed", "duplicates", "coalesced")
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+class HashRing:
+    """
+    Anillo de hash consistente: cada nodo ocupa 'replicas' puntos y una clave va al primer punto que
+    sigue a su hash. Al añadir o quitar un nodo solo cambian de nodo las claves de sus tramos
+    (~1/N del total); las demás siguen donde estaban, con su estado y sus cachés ya calientes.
+    """
+
+    def __init__(self, nodes, replicas: int = VIRTUAL_NODES):
+        self.nodes = list(nodes)
+        points = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(replicas))
+        self._hashes = [h for h, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key):
+        if not self._nodes: raise LookupError("El anillo no tiene nodos.")
+        i = bisect.bisect(self._hashes, _hash(str(key))) % len(self._hashes)
+        return self._nodes[i]
+
+def _worker_main(index: int, inbox, outbox, initializer=None, stats_interval: float = STATS_INTERVAL, log_level: int = None):
+    """Punto de entrada de cada proceso worker."""
+    asyncio.run(_worker(index, inbox, outbox, initializer, stats_interval, log_level))
+
+async def _worker(index: int, inbox, outbox, initializer, stats_interval: float, log_level: int):
+    """
+    Worker: la misma aplicación que en api/server.py, con su propio UpdateDispatcher. Recibe updates
+    (como dict) por 'inbox' y devuelve por 'outbox' ('done', update_id) al terminar cada uno y
+    ('stats', dict) cada 'stats_interval' segundos. Con ('share', workers) se queda con su parte de los
+    límites globales del planificador de llamadas a Gemini.
+    """
+    from bot_logic.handlers import application, Update, llm_scheduler
+    from bot_logic.dispatcher import UpdateDispatcher
+    from bot_logic import state_manager, answer_cache
+    # handlers.py configura el logging en INFO; el worker usa el mismo nivel que el proceso principal
+    if log_level is not None: logging.getLogger().setLevel(log_level)
+    if initializer is not None: initializer()
+
+    loop = asyncio.get_running_loop()
+    await application.initialize()
+    # El proceso principal ya limita el total de pendientes; aquí no se rechaza nada
+    dispatcher = UpdateDispatcher(application, max_pending=1 << 30)
+    stopping = asyncio.Event()
+
+    def on_done(update):
+        outbox.send(("done", update.update_id))
+
+    def receive(message):
+        if message[0] == "stop":
+            stopping.set()
+            return
+        if message[0] == "share":
+            llm_scheduler.split(message[1])
+            return
+        update = Update.de_json(message[1], application.bot)
+        if not dispatcher.submit(update, on_done=on_done):
+            outbox.send(("done", update.update_id))
+
+    def read_inbox():
+        while True:
+            message = inbox.get()
+            loop.call_soon_threadsafe(receive, message)
+            if message[0] == "stop": return
+
+    def send_stats():
+        outbox.send(("stats", {"pid": os.getpid(), **dispatcher.stats(), **{f"answer_cache_{k}": v for k, v in answer_cache.stats().items()}}))
+
+    threading.Thread(target=read_inbox, name=f"worker-{index}-inbox", daemon=True).start()
+    outbox.send(("ready", os.getpid()))
+    while not stopping.is_set():
+        try:
+            await asyncio.wait_for(stopping.wait(), stats_interval)
+        except asyncio.TimeoutError:
+            pass
+        send_stats()
+    await dispatcher.drain()
+    state_manager.flush_states()
+    send_stats()
+    await application.shutdown()
+
+class _Worker:
+    """Un proceso worker visto desde el proceso principal."""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process = None
+        self.inbox = None
+        self.outbox = None
+        self.pid = None
+        self.in_flight = 0
+        self.retiring = False
+        self.stopping = False
+        self.restarts = 0
+        # Caídas seguidas, cuándo arrancó el proceso actual y cuándo toca arrancar el siguiente
+        self.crashes = 0
+        self.started_at = 0.0
+        self.restart_at = None
+        # Updates que tenía a medias al caer (los enviados después no cuentan como intento)
+        self.orphaned = set()
+        # Se dejó de reiniciar tras MAX_CONSECUTIVE_RESTARTS caídas seguidas
+        self.failed = False
+        self.stats = {}
+        # Estadísticas de los procesos anteriores de este worker (antes de reiniciarse)
+        self.carried = {}
+
+class _Entry:
+    __slots__ = ("update_id", "update", "data", "chat", "worker", "on_done", "attempts")
+
+    def __init__(self, update, chat, worker, on_done):
+        self.update_id = update.update_id
+        self.update = update
+        self.data = update.to_dict()
+        self.chat = chat
+        self.worker = worker
+        self.on_done = on_done
+        self.attempts = 0
+
+class ShardedDispatcher:
+    """
+    Reparte los updates entre 'workers' procesos, cada uno con su propia 'application' y su
+    UpdateDispatcher, para usar más de un núcleo. Misma interfaz que UpdateDispatcher ('submit',
+    'drain', 'stats'), así api/server.py y api/polling.py pueden usar uno u otro.
+
+    - Cada chat va siempre al mismo worker (anillo de hash consistente sobre su id): el estado en
+      memoria del usuario y las cachés de ese proceso siguen calientes.
+    - Cada worker tiene su planificador de llamadas a Gemini: se le envía su parte de los límites globales
+      (LLM_MAX_CONCURRENT_CALLS entre el número de workers) al arrancar y en cada 'resize'.
+    - Mientras un chat tiene updates en curso, los siguientes van al mismo worker aunque el anillo
+      haya cambiado, así se conserva el orden dentro del chat.
+    - Si un worker cae, se arranca otro en su lugar y se le reenvían (una vez) los updates que quedaron
+      a medias. Si cae una y otra vez, cada reinicio espera el doble que el anterior, y tras
+      MAX_CONSECUTIVE_RESTARTS caídas seguidas deja de reiniciarse y sus chats pasan a los demás
+      workers (hasta el siguiente 'resize'). 'resize' cambia el número de workers: los que sobran terminan lo que tienen y se apagan.
+    """
+
+    def __init__(self, workers: int = WORKERS, max_pending: int = MAX_PENDING_UPDATES, initializer=None,
+                 stats_interval: float = STATS_INTERVAL):
+        self.max_pending = max_pending
+        self.initializer = initializer
+        self.stats_interval = stats_interval
+        self._context = multiprocessing.get_context("spawn")
+        self._size = workers
+        self._workers = {}
+        self.ring = HashRing(range(workers))
+        self._entries = {}
+        # chat -> [worker, updates en curso]
+        self._chats = {}
+        self._accepting = True
+        self._closed = False
+        self._loop = None
+        self._reader = None
+        self._monitor = None
+        # Estadísticas acumuladas de los workers ya retirados
+        self._retired = {}
+        self.restarts = 0
+        self.lost = 0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._entries)
+
+    async def start(self):
+        """Arranca los workers y espera a que estén listos."""
+        self._loop = asyncio.get_running_loop()
+        for index in range(self._size):
+            self._start_worker(self._workers.setdefault(index, _Worker(index)))
+        self._reader = threading.Thread(target=self._read_outboxes, name="shard-results", daemon=True)
+        self._reader.start()
+        deadline = time.monotonic() + START_TIMEOUT
+        while any(worker.pid is None for worker in self._workers.values()):
+            # Un worker que cae al arrancar (configuración, importaciones) caería otra vez: no se reintenta
+            failed = [worker for worker in self._workers.values() if worker.process.exitcode is not None]
+            if failed or time.monotonic() > deadline:
+                self._closed = True
+                for worker in self._workers.values(): worker.process.kill()
+                raise RuntimeError(f"Los workers no arrancaron (worker {failed[0].index}: código {failed[0].process.exitcode})."
+                                   if failed else "Los workers no arrancaron a tiempo.")
+            await asyncio.sleep(0.05)
+        self._monitor = asyncio.create_task(self._watch())
+        metrics.register_collector(self._metric_samples)
+        logger.info(f"✅ {self._size} workers listos.")
+
+    def _start_worker(self, worker: _Worker):
+        receiver, sender = self._context.Pipe(duplex=False)
+        worker.inbox = self._context.Queue()
+        worker.outbox = receiver
+        worker.pid = None
+        worker.started_at = time.monotonic()
+        worker.process = self._context.Process(target=_worker_main, name=f"bot-worker-{worker.index}",
+                                               args=(worker.index, worker.inbox, sender, self.initializer, self.stats_interval,
+                                                     logging.getLogger().level), daemon=True)
+        worker.process.start()
+        # El extremo de escritura solo lo usa el hijo: cerrarlo aquí hace que su caída se vea como EOF
+        sender.close()
+        worker.inbox.put(("share", self._size))
+
+    def submit(self, update, on_done=None) -> bool:
+        if not self._accepting or len(self._entries) >= self.max_pending:
+            return False
+        if update.update_id in self._entries:
+            # Reentrega de uno que sigue en curso: ya se confirmará con el original
+            return True
+        chat = chat_key(update)
+        owner = self._chats.get(chat) if chat is not None else None
+        if owner:
+            index = owner[0]
+        else:
+            try:
+                index = self.ring.node_for(chat if chat is not None else update.update_id)
+            except LookupError:
+                # Todos los workers dejaron de reiniciarse
+                return False
+        entry = self._entries[update.update_id] = _Entry(update, chat, index, on_done)
+        if chat is not None:
+            if owner: owner[1] += 1
+            else: self._chats[chat] = [index, 1]
+        self._workers[index].in_flight += 1
+        self._send(entry)
+        return True
+
+    def _send(self, entry: _Entry):
+        self._workers[entry.worker].inbox.put(("update", entry.data))
+
+    def _finish(self, update_id):
+        """El update terminó (o se descarta): deja de contar como en curso y se avisa a 'on_done'."""
+        entry = self._entries.pop(update_id, None)
+        if entry is None: return
+        self._workers[entry.worker].in_flight -= 1
+        if entry.chat is not None:
+            owner = self._chats[entry.chat]
+            owner[1] -= 1
+            if not owner[1]: del self._chats[entry.chat]
+        if entry.on_done is not None: entry.on_done(entry.update)
+
+    def _read_outboxes(self):
+        """Hilo que lee los mensajes de todos los workers y los pasa al event loop."""
+        dead = set()
+        while not self._closed:
+            connections = {worker.outbox: worker for worker in list(self._workers.values()) if worker.outbox is not None and worker.outbox not in dead}
+            if not connections:
+                time.sleep(0.1)
+                continue
+            for connection in wait_connections(list(connections), timeout=0.5):
+                worker = connections[connection]
+                try:
+                    message = connection.recv()
+                except (EOFError, OSError):
+                    # El worker terminó; '_watch' decide si hay que arrancar otro
+                    dead.add(connection)
+                    continue
+                self._loop.call_soon_threadsafe(self._on_message, worker, connection, message)
+
+    def _on_message(self, worker: _Worker, connection, message):
+        if connection is not worker.outbox: return
+        kind = message[0]
+        if kind == "done":
+            self._finish(message[1])
+        elif kind == "stats":
+            worker.stats = message[1]
+        elif kind == "ready":
+            worker.pid = message[1]
+
+    async def _watch(self):
+        """Arranca de nuevo los workers que caen y apaga los que sobran tras un 'resize' cuando quedan libres."""
+        while not self._closed:
+            for worker in list(self._workers.values()):
+                if worker.retiring and not worker.stopping and worker.in_flight == 0:
+                    worker.stopping = True
+                    worker.inbox.put(("stop",))
+                if worker.process.exitcode is None: continue
+                if worker.stopping and not worker.retiring: continue
+                if worker.retiring and (worker.stopping or worker.failed) and worker.index >= self._size:
+                    del self._workers[worker.index]
+                    for name in _SUMMED_STATS:
+                        self._retired[name] = self._retired.get(name, 0) + worker.carried.get(name, 0) + worker.stats.get(name, 0)
+                    logger.info(f"Worker {worker.index} retirado.")
+                elif worker.retiring and worker.stopping:
+                    # Un 'resize' lo volvió a pedir mientras se apagaba: se arranca de nuevo
+                    worker.retiring = worker.stopping = False
+                    self._restart(worker, crashed=False)
+                elif worker.failed:
+                    continue
+                elif worker.restart_at is None:
+                    self._on_crash(worker)
+                elif time.monotonic() >= worker.restart_at:
+                    self._restart(worker)
+            await asyncio.sleep(0.1)
+
+    def _on_crash(self, worker: _Worker):
+        """Un worker cayó: programa su reinicio con espera exponencial o, si no deja de caer, lo da por perdido."""
+        if time.monotonic() - worker.started_at >= RESTART_RESET_AFTER: worker.crashes = 0
+        worker.crashes += 1
+        worker.orphaned = {entry.update_id for entry in self._entries.values() if entry.worker == worker.index}
+        self.restarts += 1
+        worker.restarts += 1
+        metrics.WORKER_RESTARTS.inc(worker=str(worker.index))
+        if worker.crashes > MAX_CONSECUTIVE_RESTARTS:
+            worker.failed = True
+            logger.critical(f"El worker {worker.index} cayó {worker.crashes} veces seguidas (código {worker.process.exitcode}): "
+                            f"no se vuelve a arrancar y sus chats pasan a los demás workers.")
+            for entry in [entry for entry in self._entries.values() if entry.worker == worker.index]:
+                self.lost += 1
+                self._finish(entry.update_id)
+            self._rebuild_ring()
+            return
+        delay = min(RESTART_BACKOFF_MAX, RESTART_BACKOFF * 2 ** (worker.crashes - 1))
+        worker.restart_at = time.monotonic() + delay
+        logger.error(f"El worker {worker.index} (pid {worker.process.pid}) terminó con código {worker.process.exitcode}. "
+                     f"Se arranca otro en {delay:.1f} s y se le reenvían {len(worker.orphaned)} updates.")
+
+    def _rebuild_ring(self):
+        self.ring = HashRing(index for index in range(self._size) if not self._workers[index].failed)
+
+    def _restart(self, worker: _Worker, crashed: bool = True):
+        """
+        Arranca otro proceso para 'worker' y le reenvía los updates que el anterior dejó a medias, y también
+        los que se le asignaron mientras esperaba para arrancar (esos no cuentan como intento fallido).
+        """
+        for name in _SUMMED_STATS:
+            worker.carried[name] = worker.carried.get(name, 0) + worker.stats.get(name, 0)
+        worker.stats = {}
+        worker.restart_at = None
+        orphaned = [entry for entry in self._entries.values() if entry.worker == worker.index]
+        self._start_worker(worker)
+        for entry in orphaned:
+            if not crashed or entry.update_id not in worker.orphaned:
+                self._send(entry)
+                continue
+            if entry.attempts >= MAX_REDELIVERIES:
+                # Probablemente es el update que tumba al worker: no se vuelve a intentar
+                self.lost += 1
+                logger.error(f"Se descarta el update {entry.update_id} tras {entry.attempts + 1} caídas del worker.")
+                self._finish(entry.update_id)
+                continue
+            entry.attempts += 1
+            self._send(entry)
+        worker.orphaned = set()
+
+    def resize(self, workers: int):
+        """Cambia el número de workers. Solo cambian de worker los chats de los tramos afectados del anillo."""
+        if workers < 1: raise ValueError("Hace falta al menos un worker.")
+        previous, self._size = self._size, workers
+        for index in range(workers):
+            worker = self._workers.get(index)
+            if worker is None:
+                self._start_worker(self._workers.setdefault(index, _Worker(index)))
+                continue
+            if worker.process.exitcode is None: worker.inbox.put(("share", workers))
+            if worker.failed:
+                # Un 'resize' le da otra oportunidad al worker que se dejó de reiniciar
+                worker.failed = False
+                worker.crashes = 0
+                self._restart(worker, crashed=False)
+            elif worker.retiring and not worker.stopping:
+                worker.retiring = False
+        for index, worker in self._workers.items():
+            if index >= workers: worker.retiring = True
+        self._rebuild_ring()
+        logger.info(f"Workers: {previous} -> {workers}.")
+
+    def stats(self) -> dict:
+        workers = [worker for index, worker in sorted(self._workers.items())]
+        totals = {name: self._retired.get(name, 0) + sum(worker.carried.get(name, 0) + worker.stats.get(name, 0) for worker in workers)
+                  for name in _SUMMED_STATS}
+        return {**totals, "pending": len(self._entries), "chats": len(self._chats), "workers": self._size,
+                "restarts": self.restarts, "lost": self.lost,
+                "per_worker": [{"worker": worker.index, "pid": worker.pid, "alive": worker.process.exitcode is None,
+                                "in_flight": worker.in_flight, "restarts": worker.restarts, "retiring": worker.retiring,
+                                "failed": worker.failed,
+                                **{k: v for k, v in worker.stats.items() if k != "pid"}} for worker in workers]}
+
+    def _metric_samples(self) -> list:
+        workers = [worker for index, worker in sorted(self._workers.items())]
+        return [
+            ("bot_worker_updates_in_flight", "gauge", "Updates enviados a cada worker y aún sin terminar.",
+             [({"worker": str(worker.index)}, worker.in_flight) for worker in workers]),
+            ("bot_worker_updates_processed", "counter", "Updates procesados por cada worker.",
+             [({"worker": str(worker.index)}, worker.carried.get("processed", 0) + worker.stats.get("processed", 0)) for worker in workers]),
+        ]
+
+    async def drain(self, timeout: float = DRAIN_TIMEOUT):
+        """Deja de aceptar updates, espera a los que están en curso y apaga los workers."""
+        self._accepting = False
+        deadline = time.monotonic() + timeout
+        if self._entries: logger.info(f"Esperando a {len(self._entries)} updates en curso antes de apagar...")
+        while self._entries and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for worker in self._workers.values():
+            worker.stopping = True
+            worker.inbox.put(("stop",))
+        # Tras los 'stop' llegan las últimas estadísticas; '_watch' ya no reinicia a nadie
+        for worker in list(self._workers.values()):
+            await asyncio.to_thread(worker.process.join, max(1.0, deadline - time.monotonic()))
+            if worker.process.exitcode is None:
+                logger.warning(f"El worker {worker.index} no terminó a tiempo y se detiene a la fuerza.")
+                worker.process.terminate()
+        await asyncio.sleep(0.1)
+        self._closed = True
+        if self._monitor: self._monitor.cancel()
+        if self._entries: logger.warning(f"{len(self._entries)} updates no terminaron a tiempo.")
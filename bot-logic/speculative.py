@@ -0,0 +1,116 @@
+# bot_logic/speculative.py
+
+import asyncio
+import logging
+import os
+import time
+
+from bot_logic import metrics
+from bot_logic.scheduler import TokenBucket, SchedulerRejected, MAX_TRACKED_USERS
+
+# Obtenemos una instancia del logger para este módulo
+logger = logging.getLogger(__name__)
+
+# Con SPECULATIVE_ANSWERS=1, tras cada respuesta se preparan en segundo plano las de sus preguntas sugeridas.
+SPECULATIVE_ENABLED = os.getenv("SPECULATIVE_ANSWERS", "0") == "1"
+# Preguntas sugeridas que se preparan por respuesta.
+MAX_PER_ANSWER = int(os.getenv("SPECULATIVE_MAX_PER_ANSWER", 3))
+# Gasto por usuario: cubo de respuestas especulativas (capacidad y cuántas se recuperan por minuto).
+USER_BURST = float(os.getenv("SPECULATIVE_USER_BURST", 3))
+USER_RATE_PER_MINUTE = float(os.getenv("SPECULATIVE_USER_RATE_PER_MINUTE", 1))
+
+class SpeculativePrefetcher:
+    """
+    Prepara respuestas que el usuario probablemente va a pedir (las de las preguntas sugeridas) en
+    tareas de fondo. 'schedule' recibe [(clave, trabajo)], donde la clave identifica la respuesta (la de
+    answer_cache) y 'trabajo(started)' es una corrutina que la genera y la guarda, y que marca el evento
+    'started' cuando empieza la llamada a Gemini (después de esperar su turno de fondo).
+
+    - Cada usuario tiene un cubo de tokens: cada trabajo gasta uno y, sin tokens, no se prepara nada más.
+    - 'cancel_user' cancela lo pendiente del usuario (cambia de libro o pregunta otra cosa).
+    - 'join' espera a la respuesta que ya se está generando para la clave pedida, o cancela el trabajo si
+      aún esperaba turno (la pregunta normal, con más prioridad, lo hará antes).
+    """
+
+    def __init__(self, max_per_answer: int = MAX_PER_ANSWER, burst: float = USER_BURST, rate_per_minute: float = USER_RATE_PER_MINUTE):
+        self.max_per_answer = max_per_answer
+        self.burst = burst
+        self.rate = rate_per_minute / 60.0
+        self._buckets = {}
+        # user_id -> {clave: (tarea, evento 'started')}
+        self._jobs = {}
+        self.scheduled = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.failed = 0
+        self.over_budget = 0
+        self.joined = 0
+
+    def schedule(self, user_id, jobs):
+        """Lanza hasta 'max_per_answer' trabajos de 'jobs' que no estén ya en marcha, mientras el usuario tenga presupuesto."""
+        now = time.monotonic()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) >= MAX_TRACKED_USERS:
+                for idle in [u for u, b in self._buckets.items() if b.is_full(now)]: del self._buckets[idle]
+            bucket = self._buckets[user_id] = TokenBucket(self.burst, self.rate, now)
+        user_jobs = self._jobs.setdefault(user_id, {})
+        for key, job in list(jobs)[:self.max_per_answer]:
+            if key in user_jobs: continue
+            if bucket.take(1, now):
+                self.over_budget += 1
+                metrics.SPECULATIVE_ANSWERS.inc(outcome="over_budget")
+                break
+            started = asyncio.Event()
+            task = asyncio.create_task(self._run(user_id, key, job, started))
+            user_jobs[key] = (task, started)
+            self.scheduled += 1
+        if not user_jobs: del self._jobs[user_id]
+
+    async def _run(self, user_id, key, job, started: asyncio.Event):
+        try:
+            await job(started)
+            self.completed += 1
+            metrics.SPECULATIVE_ANSWERS.inc(outcome="completed")
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            metrics.SPECULATIVE_ANSWERS.inc(outcome="cancelled")
+            raise
+        except SchedulerRejected:
+            self.cancelled += 1
+            metrics.SPECULATIVE_ANSWERS.inc(outcome="rejected")
+        except Exception as e:
+            self.failed += 1
+            metrics.SPECULATIVE_ANSWERS.inc(outcome="failed")
+            logger.warning(f"Falló una respuesta especulativa para {user_id}: {e!r}")
+        finally:
+            user_jobs = self._jobs.get(user_id)
+            if user_jobs is not None and user_jobs.get(key, (None,))[0] is asyncio.current_task():
+                del user_jobs[key]
+                if not user_jobs: del self._jobs[user_id]
+
+    def cancel_user(self, user_id, keep=None):
+        """Cancela los trabajos pendientes del usuario salvo aquellos cuya clave cumpla 'keep(clave)'."""
+        for key, (task, _) in list(self._jobs.get(user_id, {}).items()):
+            if keep is not None and keep(key): continue
+            task.cancel()
+
+    async def join(self, user_id, key) -> bool:
+        """
+        Si ya se está generando la respuesta de 'key', la espera y devuelve True (queda en answer_cache).
+        Si el trabajo aún esperaba su turno, lo cancela y devuelve False.
+        """
+        task, started = self._jobs.get(user_id, {}).get(key, (None, None))
+        if task is None: return False
+        if not started.is_set():
+            task.cancel()
+            return False
+        self.joined += 1
+        metrics.SPECULATIVE_ANSWERS.inc(outcome="joined")
+        # asyncio.wait no cancela la tarea si se cancela quien espera: la respuesta acaba en la caché igualmente
+        await asyncio.wait({task})
+        return True
+
+    def stats(self) -> dict:
+        return {"pending": sum(len(jobs) for jobs in self._jobs.values()), "scheduled": self.scheduled, "completed": self.completed,
+                "cancelled": self.cancelled, "failed": self.failed, "over_budget": self.over_budget, "joined": self.joined}
@@ -1,8 +1,19 @@
 # bot_logic/state_manager.py
 
+import asyncio
+import atexit
 import json
 import os
 import logging
+import sqlite3
+import threading
+import time
+import weakref
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from bot_logic import metrics
 
 # Obtenemos una instancia del logger para este módulo
 logger = logging.getLogger(__name__)
@@ -12,6 +23,16 @@ logger = logging.getLogger(__name__)
 # para almacenar los archivos de sesión de cada usuario.
 STATE_DIR = '/tmp/bot_states'
 
+# Backend de almacenamiento: 'json' (un archivo por usuario) o 'sqlite' (una base de datos en modo WAL).
+STATE_BACKEND = os.getenv("STATE_BACKEND", "json")
+SQLITE_PATH = os.getenv("STATE_SQLITE_PATH", os.path.join(STATE_DIR, 'states.sqlite3'))
+# Con STATE_WRITE_BEHIND=1 los estados se guardan primero en memoria y se vuelcan al backend por lotes.
+STATE_WRITE_BEHIND = os.getenv("STATE_WRITE_BEHIND", "0") == "1"
+FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", 2.0))
+FLUSH_BATCH_SIZE = int(os.getenv("STATE_FLUSH_BATCH_SIZE", 64))
+# Estados que se conservan en memoria con write-behind; los que ya están guardados se expulsan primero los menos usados.
+CACHE_MAX_ENTRIES = int(os.getenv("STATE_CACHE_MAX_ENTRIES", 4096))
+
 # Nos aseguramos de que el directorio de estados exista al iniciar el bot.
 # Si ya existe, exist_ok=True previene un error.
 try:
@@ -26,34 +47,251 @@ def get_state_filepath(user_id: int) -> str:
     """
     return os.path.join(STATE_DIR, f'state_{user_id}.json')
 
-def load_state(user_id: int) -> dict:
-    """
-    Carga el estado de un usuario desde su archivo JSON.
-    Devuelve un diccionario vacío si el archivo no existe o está corrupto.
-    """
-    filepath = get_state_filepath(user_id)
-    if os.path.exists(filepath):
+# ===================== BACKENDS =====================
+class StateBackend(ABC):
+    """Interfaz común de los almacenes de estado. Todas las escrituras deben ser atómicas."""
+
+    @abstractmethod
+    def load(self, user_id: int) -> dict:
+        ...
+
+    @abstractmethod
+    def save(self, user_id: int, state: dict):
+        ...
+
+    def save_many(self, states: dict):
+        """Guarda varios estados {user_id: estado} de una vez."""
+        for user_id, state in states.items():
+            self.save(user_id, state)
+
+    def flush(self):
+        """Vuelca al almacenamiento cualquier escritura pendiente."""
+
+    def close(self):
+        self.flush()
+
+class JsonFileBackend(StateBackend):
+    """Un archivo JSON por usuario en STATE_DIR (el formato original del bot)."""
+
+    def load(self, user_id: int) -> dict:
+        filepath = get_state_filepath(user_id)
+        if os.path.exists(filepath):
+            try:
+                with open(filepath, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except json.JSONDecodeError:
+                # Si el archivo está vacío o malformado, lo tratamos como un estado nuevo.
+                logger.warning(f"El archivo de estado para el usuario {user_id} estaba corrupto o vacío. Se reiniciará el estado.")
+                return {}
+            except Exception as e:
+                logger.error(f"Error inesperado al cargar el estado para el usuario {user_id}: {e}")
+                return {}
+        # Si el archivo no existe, es la primera interacción del usuario en esta sesión.
+        return {}
+
+    def save(self, user_id: int, state: dict):
+        # Escribimos en un archivo temporal y lo renombramos: un lector nunca ve un JSON a medias.
+        filepath = get_state_filepath(user_id)
+        tmp_path = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            # Si el archivo está vacío o malformado, lo tratamos como un estado nuevo.
-            logger.warning(f"El archivo de estado para el usuario {user_id} estaba corrupto o vacío. Se reiniciará el estado.")
-            return {}
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(state, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, filepath)
         except Exception as e:
+            logger.error(f"CRÍTICO: No se pudo guardar el estado para el usuario {user_id} en {filepath}: {e}")
+            try: os.remove(tmp_path)
+            except OSError: pass
+
+class SQLiteBackend(StateBackend):
+    """Todos los estados en una tabla SQLite en modo WAL. Cada guardado es una transacción."""
+
+    def __init__(self, path: str = SQLITE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS states (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)")
+
+    def load(self, user_id: int) -> dict:
+        try:
+            with self._lock:
+                row = self._conn.execute("SELECT data FROM states WHERE user_id = ?", (user_id,)).fetchone()
+            return json.loads(row[0]) if row else {}
+        except (sqlite3.Error, json.JSONDecodeError) as e:
             logger.error(f"Error inesperado al cargar el estado para el usuario {user_id}: {e}")
             return {}
-    # Si el archivo no existe, es la primera interacción del usuario en esta sesión.
-    return {}
+
+    def save(self, user_id: int, state: dict):
+        self.save_many({user_id: state})
+
+    def save_many(self, states: dict):
+        now = time.time()
+        rows = [(user_id, json.dumps(state, ensure_ascii=False, separators=(',', ':')), now) for user_id, state in states.items()]
+        try:
+            with self._lock:
+                self._conn.execute("BEGIN")
+                try:
+                    self._conn.executemany("INSERT INTO states (user_id, data, updated_at) VALUES (?, ?, ?) ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at", rows)
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+        except sqlite3.Error as e:
+            logger.error(f"CRÍTICO: No se pudieron guardar {len(rows)} estados en {self.path}: {e}")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class WriteBehindBackend(StateBackend):
+    """
+    Caché en memoria delante de otro backend. Las lecturas salen de memoria y las escrituras
+    se acumulan y se vuelcan en lote: al llegar a FLUSH_BATCH_SIZE usuarios pendientes,
+    cada FLUSH_INTERVAL segundos desde un hilo de fondo, o al cerrar el proceso.
+
+    Los volcados no se solapan ('_flush_lock'): si el hilo de fondo y 'flush_states()' coincidieran, un
+    lote antiguo podría llegar al backend después de uno nuevo y pisarlo. En memoria se guardan como mucho
+    'max_entries' estados; solo se expulsan los que ya están guardados en el backend.
+    """
+
+    def __init__(self, inner: StateBackend, flush_interval: float = FLUSH_INTERVAL, batch_size: int = FLUSH_BATCH_SIZE,
+                 max_entries: int = CACHE_MAX_ENTRIES):
+        self.inner = inner
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # user_id -> estado serializado, del menos al más usado
+        self._cache = OrderedDict()
+        self._dirty = set()
+        # Usuarios del lote que se está escribiendo: aún no se pueden expulsar
+        self._writing = set()
+        self._flusher = None
+        self._stopped = threading.Event()
+
+    def load(self, user_id: int) -> dict:
+        with self._lock:
+            if user_id in self._cache:
+                self._cache.move_to_end(user_id)
+                return json.loads(self._cache[user_id])
+        state = self.inner.load(user_id)
+        with self._lock:
+            self._cache.setdefault(user_id, json.dumps(state, ensure_ascii=False))
+            self._evict()
+        return state
+
+    def save(self, user_id: int, state: dict):
+        # Guardamos una copia serializada para que cambios posteriores al dict no se cuelen sin save().
+        with self._lock:
+            self._cache[user_id] = json.dumps(state, ensure_ascii=False)
+            self._cache.move_to_end(user_id)
+            self._dirty.add(user_id)
+            should_flush = len(self._dirty) >= self.batch_size
+        self._ensure_flusher()
+        if should_flush: self.flush()
+
+    def flush(self):
+        # La foto del lote y su escritura van juntas: así los lotes llegan al backend en orden
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty: return
+                batch = {user_id: json.loads(self._cache[user_id]) for user_id in self._dirty}
+                self._dirty.clear()
+                self._writing = set(batch)
+            try:
+                self.inner.save_many(batch)
+            finally:
+                with self._lock:
+                    self._writing = set()
+                    self._evict()
+
+    def _evict(self):
+        """Con '_lock' tomado: expulsa los estados menos usados ya guardados hasta quedar en 'max_entries'."""
+        excess = len(self._cache) - self.max_entries
+        if excess <= 0: return
+        clean = [user_id for user_id in self._cache if user_id not in self._dirty and user_id not in self._writing]
+        for user_id in clean[:excess]:
+            del self._cache[user_id]
+
+    def _ensure_flusher(self):
+        with self._lock:
+            if self._flusher is not None: return
+            self._flusher = threading.Thread(target=self._flush_loop, name="state-flusher", daemon=True)
+        self._flusher.start()
+
+    def _flush_loop(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error al volcar los estados pendientes: {e}")
+
+    def close(self):
+        self._stopped.set()
+        self.flush()
+        self.inner.close()
+
+def create_backend(name: str = STATE_BACKEND, write_behind: bool = STATE_WRITE_BEHIND) -> StateBackend:
+    """Crea el backend configurado. Un nombre desconocido vuelve al backend JSON."""
+    if name == "sqlite":
+        inner = SQLiteBackend()
+    else:
+        if name != "json": logger.warning(f"Backend de estado '{name}' desconocido. Se usará 'json'.")
+        inner = JsonFileBackend()
+    return WriteBehindBackend(inner) if write_behind else inner
+
+backend = create_backend()
+atexit.register(backend.close)
+
+# ===================== API DEL MÓDULO =====================
+def load_state(user_id: int) -> dict:
+    """
+    Carga el estado de un usuario desde el backend configurado.
+    Devuelve un diccionario vacío si no existe o está corrupto.
+    """
+    with metrics.span("state_load"):
+        return backend.load(user_id)
 
 def save_state(user_id: int, state: dict):
     """
-    Guarda el estado de un usuario (un diccionario de Python) en su archivo JSON.
-    Sobrescribe el archivo si ya existe.
+    Guarda el estado de un usuario (un diccionario de Python) en el backend configurado.
+    Sobrescribe el estado anterior si ya existe.
+    """
+    with metrics.span("state_save"):
+        backend.save(user_id, state)
+
+def flush_states():
+    """Vuelca las escrituras pendientes (solo tiene efecto con write-behind)."""
+    with metrics.span("state_flush"):
+        backend.flush()
+
+# Un asyncio.Lock por usuario. Con WeakValueDictionary el lock desaparece cuando nadie lo usa.
+_user_locks = weakref.WeakValueDictionary()
+
+def user_lock(user_id: int) -> asyncio.Lock:
+    lock = _user_locks.get(user_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _user_locks[user_id] = lock
+    return lock
+
+@asynccontextmanager
+async def edit_state(user_id: int):
+    """
+    Carga el estado del usuario, lo entrega para modificarlo y lo guarda al salir del bloque,
+    todo bajo el lock del usuario para que dos callbacks simultáneos no se pisen:
+
+        async with state_manager.edit_state(user_id) as state:
+            state['last_question'] = question
     """
-    filepath = get_state_filepath(user_id)
+    lock = user_lock(user_id)
+    with metrics.span("state_lock_wait"):
+        await lock.acquire()
     try:
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(state, f, ensure_ascii=False, indent=4)
-    except Exception as e:
-        logger.error(f"CRÍTICO: No se pudo guardar el estado para el usuario {user_id} en {filepath}: {e}")
\ No newline at end of file
+        state = load_state(user_id)
+        yield state
+        save_state(user_id, state)
+    finally:
+        lock.release()
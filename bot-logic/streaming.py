@@ -0,0 +1,107 @@
+# bot_logic/streaming.py
+
+import asyncio
+import logging
+import os
+import time
+
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter
+
+from bot_logic import renderer
+from bot_logic.renderer import split_point, utf16_fit, utf16_len
+
+# Obtenemos una instancia del logger para este módulo
+logger = logging.getLogger(__name__)
+
+# Telegram tolera aproximadamente una edición por segundo en un mismo chat; dejamos margen.
+EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.5))
+# No merece la pena editar por unos pocos caracteres nuevos.
+MIN_NEW_CHARS = 40
+TYPING_CURSOR = " ▌"
+
+def _retry_seconds(error: RetryAfter) -> float:
+    delay = error.retry_after
+    return delay.total_seconds() if hasattr(delay, "total_seconds") else float(delay)
+
+class ProgressiveReply:
+    """
+    Muestra una respuesta mientras se genera editando el mensaje 'Analizando...' a un ritmo limitado.
+    Cuando el texto supera 'limit' (en unidades UTF-16, como cuenta Telegram: un emoji suele ocupar 2),
+    el mensaje actual se congela y se continúa en uno nuevo.
+    Durante el streaming se usa texto plano (el Markdown a medias suele ser inválido); 'finish'
+    deja el formato definitivo (MarkdownV2 generado por renderer.py) y añade el teclado solo al último mensaje.
+    """
+
+    def __init__(self, bot, chat_id: int, first_message, limit: int, edit_interval: float = EDIT_INTERVAL):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.limit = limit
+        self.edit_interval = edit_interval
+        self.messages = [first_message]
+        # Texto mostrado en cada mensaje y parte del texto total que ya quedó congelada en mensajes anteriores.
+        self._shown = [None]
+        self._frozen_chars = 0
+        self._last_edit = 0.0
+
+    async def _edit(self, message, text: str, parse_mode=None, reply_markup=None, final: bool = False) -> bool:
+        try:
+            await message.edit_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
+            return True
+        except RetryAfter as e:
+            if final:
+                # La versión final no se puede saltar: esperamos lo que pide Telegram y reintentamos.
+                await asyncio.sleep(_retry_seconds(e))
+                return await self._edit(message, text, parse_mode, reply_markup, final)
+            # Nos pasamos del límite de ediciones: esperamos a la siguiente oportunidad.
+            self._last_edit = time.monotonic() + _retry_seconds(e)
+            logger.warning(f"Telegram pidió esperar {_retry_seconds(e)}s entre ediciones.")
+            return False
+        except BadRequest as e:
+            if "not modified" in str(e).lower(): return True
+            raise
+
+    async def update(self, text: str):
+        """Recibe el texto visible acumulado hasta ahora y, si toca, actualiza los mensajes."""
+        now = time.monotonic()
+        if now - self._last_edit < self.edit_interval: return
+        pending = text[self._frozen_chars:]
+        shown = self._shown[-1] or ""
+        if len(pending) - len(shown) < MIN_NEW_CHARS and utf16_len(pending) <= self.limit: return
+
+        budget = self.limit - utf16_len(TYPING_CURSOR)
+        while utf16_len(pending) > budget:
+            # El mensaje actual se llena: lo congelamos con su último trozo y seguimos en uno nuevo.
+            cut = split_point(pending, budget)
+            await self._edit(self.messages[-1], pending[:cut])
+            self._shown[-1] = pending[:cut]
+            self._frozen_chars += cut
+            pending = pending[cut:]
+            head = pending[:utf16_fit(pending, budget)]
+            self.messages.append(await self.bot.send_message(chat_id=self.chat_id, text=head + TYPING_CURSOR))
+            self._shown.append(head)
+        if pending and pending != self._shown[-1] and await self._edit(self.messages[-1], pending + TYPING_CURSOR):
+            self._shown[-1] = pending
+        self._last_edit = max(self._last_edit, time.monotonic())
+
+    async def finish(self, text: str, reply_markup=None):
+        """Deja la respuesta final con formato, reutilizando los mensajes ya enviados."""
+        segments = renderer.render_messages(text, self.limit)
+        for i, segment in enumerate(segments):
+            markup = reply_markup if i == len(segments) - 1 else None
+            if i < len(self.messages):
+                try:
+                    await self._edit(self.messages[i], segment.markdown, parse_mode=ParseMode.MARKDOWN_V2, reply_markup=markup, final=True)
+                except BadRequest as e:
+                    # No debería pasar: el renderizado genera MarkdownV2 válido
+                    if "can't parse entities" not in str(e).lower(): raise
+                    logger.error(f"Telegram rechazó el MarkdownV2 renderizado ({e}). Se deja sin formato.")
+                    await self._edit(self.messages[i], segment.plain, reply_markup=markup, final=True)
+            else:
+                self.messages.append(await renderer.send_message(self.bot, self.chat_id, segment, markup))
+        # Si la versión final ocupa menos mensajes que el streaming, borramos los que sobran.
+        for message in self.messages[len(segments):]:
+            try:
+                await message.delete()
+            except BadRequest:
+                pass
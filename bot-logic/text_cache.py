@@ -0,0 +1,229 @@
+# bot_logic/text_cache.py
+
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from bot_logic import metrics
+from bot_logic import extractors
+
+# Obtenemos una instancia del logger para este módulo
+logger = logging.getLogger(__name__)
+
+# Igual que los estados de usuario, el texto extraído vive en /tmp, el único
+# directorio con permisos de escritura garantizados en Vercel.
+CACHE_DIR = '/tmp/text_cache'
+
+# Si cambia la forma en que se extrae el texto (otra librería, otro separador...)
+# basta con subir este número para invalidar todas las entradas antiguas.
+EXTRACTOR_VERSION = 1
+
+# Presupuestos en bytes (texto codificado en UTF-8) para la LRU en memoria y para el disco.
+MEMORY_BUDGET_BYTES = int(os.getenv("TEXT_CACHE_MEMORY_BYTES", 64 * 1024 * 1024))
+DISK_BUDGET_BYTES = int(os.getenv("TEXT_CACHE_DISK_BYTES", 512 * 1024 * 1024))
+
+_HASH_BLOCK_SIZE = 1024 * 1024
+# Hashes de archivo memorizados como mucho (los menos usados se olvidan primero).
+HASH_MEMO_MAX_ENTRIES = int(os.getenv("TEXT_CACHE_HASH_MEMO_ENTRIES", 4096))
+
+try:
+    os.makedirs(CACHE_DIR, exist_ok=True)
+except OSError as e:
+    logger.error(f"CRÍTICO: No se pudo crear el directorio de caché en {CACHE_DIR}: {e}")
+
+_lock = threading.Lock()
+# clave -> (texto, tamaño en bytes). El orden refleja el uso más reciente al final.
+_memory = OrderedDict()
+_memory_bytes = 0
+# (ruta, tamaño, mtime) -> hash. Evita volver a leer el archivo entero si no ha cambiado.
+_hash_memo = OrderedDict()
+
+def file_content_hash(file_path: str) -> str:
+    """
+    Calcula el SHA-256 del contenido de un archivo.
+    El resultado se memoriza por (ruta, tamaño, mtime) para no releer el archivo en cada pregunta.
+    """
+    st = os.stat(file_path)
+    memo_key = (file_path, st.st_size, st.st_mtime_ns)
+    with _lock:
+        cached = _hash_memo.get(memo_key)
+        if cached: _hash_memo.move_to_end(memo_key)
+    if cached: return cached
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while (block := f.read(_HASH_BLOCK_SIZE)):
+            digest.update(block)
+    content_hash = digest.hexdigest()
+    with _lock:
+        _hash_memo[memo_key] = content_hash
+        while len(_hash_memo) > HASH_MEMO_MAX_ENTRIES:
+            _hash_memo.popitem(last=False)
+    return content_hash
+
+def cache_key(content_hash: str, extractor) -> str:
+    """Construye la clave de caché a partir del hash del contenido, el extractor y su versión."""
+    return f"{content_hash}_{extractor.__name__}_v{EXTRACTOR_VERSION}"
+
+def _disk_path(key: str) -> str:
+    return os.path.join(CACHE_DIR, f"{key}.txt")
+
+def _remember(key: str, text: str, size: int):
+    """Inserta una entrada en la LRU en memoria y expulsa las más antiguas si se supera el presupuesto."""
+    global _memory_bytes
+    if size > MEMORY_BUDGET_BYTES: return
+    with _lock:
+        previous = _memory.pop(key, None)
+        if previous: _memory_bytes -= previous[1]
+        _memory[key] = (text, size)
+        _memory_bytes += size
+        while _memory_bytes > MEMORY_BUDGET_BYTES and _memory:
+            _, (_, evicted_size) = _memory.popitem(last=False)
+            _memory_bytes -= evicted_size
+
+def _read_from_disk(key: str):
+    path = _disk_path(key)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        # Actualizamos la fecha de acceso para que la expulsión en disco sea LRU.
+        os.utime(path, None)
+        return data.decode('utf-8'), len(data)
+    except FileNotFoundError:
+        return None, 0
+    except Exception as e:
+        logger.warning(f"No se pudo leer la entrada de caché {path}: {e}")
+        return None, 0
+
+def _write_to_disk(key: str, data: bytes):
+    """Escribe la entrada de forma atómica (archivo temporal + rename) y aplica el presupuesto de disco."""
+    path = _disk_path(key)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logger.error(f"No se pudo guardar la entrada de caché {path}: {e}")
+        try: os.remove(tmp_path)
+        except OSError: pass
+        return
+    enforce_disk_budget()
+
+def _extract_to_disk(key: str, file_path: str, pieces, sink=None):
+    """
+    Escribe en disco los trozos de texto según los genera el extractor (y se los pasa a 'sink') y
+    devuelve (texto, tamaño en bytes). El texto solo se junta al final: nunca están a la vez todas las
+    páginas, el texto y su copia en UTF-8. Devuelve (None, 0) si la extracción falla.
+    """
+    path = _disk_path(key)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    parts = []
+    size = 0
+    try:
+        with open(tmp_path, 'wb') as f:
+            for piece in pieces:
+                if not piece: continue
+                data = piece.encode('utf-8')
+                f.write(data)
+                size += len(data)
+                parts.append(piece)
+                if sink: sink(piece)
+        if not parts:
+            os.remove(tmp_path)
+            return "", 0
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logger.error(f"Error extrayendo '{file_path}': {e}")
+        try: os.remove(tmp_path)
+        except OSError: pass
+        return None, 0
+    enforce_disk_budget()
+    return "".join(parts), size
+
+def enforce_disk_budget(budget_bytes: int = None):
+    """Borra las entradas usadas hace más tiempo hasta que el directorio de caché quepa en el presupuesto."""
+    budget_bytes = DISK_BUDGET_BYTES if budget_bytes is None else budget_bytes
+    entries = []
+    total = 0
+    try:
+        with os.scandir(CACHE_DIR) as it:
+            for entry in it:
+                if not entry.name.endswith('.txt'): continue
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+    except FileNotFoundError:
+        return
+    if total <= budget_bytes: return
+    for _, size, path in sorted(entries):
+        try:
+            os.remove(path)
+            total -= size
+            logger.info(f"Caché de texto: expulsada {os.path.basename(path)} ({size} bytes).")
+        except OSError:
+            pass
+        if total <= budget_bytes: break
+
+def get_text(file_path: str, extractor, sink=None):
+    """
+    Devuelve el texto de 'file_path' usando la caché: primero la LRU en memoria,
+    luego el disco y, solo si ambas fallan, ejecuta 'extractor' y guarda el resultado.
+    Devuelve None si el extractor no pudo leer el archivo (los fallos no se cachean).
+
+    Al extraer, si el extractor tiene versión por trozos (extractors.STREAMS) el texto se escribe en
+    disco según llega, y cada trozo se pasa también a 'sink' (p. ej. un retrieval.BM25Builder).
+    """
+    key = cache_key(file_content_hash(file_path), extractor)
+
+    with _lock:
+        hit = _memory.get(key)
+        if hit: _memory.move_to_end(key)
+    if hit:
+        return hit[0]
+
+    text, size = _read_from_disk(key)
+    if text is not None:
+        logger.info(f"Caché de texto (disco) para '{file_path}'.")
+        _remember(key, text, size)
+        return text
+
+    logger.info(f"Caché de texto: extrayendo '{file_path}' con {extractor.__name__}.")
+    stream = extractors.STREAMS.get(extractor)
+    if stream is not None:
+        with metrics.span("extract_text", extractor=extractor.__name__):
+            text, size = _extract_to_disk(key, file_path, stream(file_path), sink)
+        if text: _remember(key, text, size)
+        return text
+    with metrics.span("extract_text", extractor=extractor.__name__):
+        text = extractor(file_path)
+    if not text: return text
+    if sink: sink(text)
+    data = text.encode('utf-8')
+    _write_to_disk(key, data)
+    _remember(key, text, len(data))
+    return text
+
+def evict(content_hash: str):
+    """Elimina de memoria y de disco todo lo extraído de un contenido (por ejemplo, al borrar su archivo)."""
+    global _memory_bytes
+    prefix = f"{content_hash}_"
+    with _lock:
+        for key in [k for k in _memory if k.startswith(prefix)]:
+            _memory_bytes -= _memory.pop(key)[1]
+    try:
+        with os.scandir(CACHE_DIR) as it:
+            for entry in it:
+                if entry.name.startswith(prefix):
+                    try: os.remove(entry.path)
+                    except OSError: pass
+    except FileNotFoundError:
+        pass
+
+def clear_memory():
+    """Vacía la LRU en memoria (el disco se conserva)."""
+    global _memory_bytes
+    with _lock:
+        _memory.clear()
+        _memory_bytes = 0
@@ -0,0 +1,182 @@
+# tests/test_context_cache.py
+#
+# ContextCacheManager y GeminiClientPool contra la API de caché falsa de bench/fake_gemini.py.
+# Ejecutar con: PYTHONPATH=. python -m pytest tests
+
+import asyncio
+import time
+
+import pytest
+from google.api_core.exceptions import NotFound
+
+from bench.fake_gemini import FakeCachingAPI, model_factory
+from bot_logic import context_cache
+from bot_logic.context_cache import CacheablePrefix, ContextCacheManager
+from bot_logic.llm_pool import GeminiClientPool, KeyState
+
+MODEL = "gemini-test-001"
+DOCUMENT = "El delito es una conducta típica, antijurídica y culpable. " * 400
+
+def _prefix(key: str = "doc-a", text: str = DOCUMENT) -> CacheablePrefix:
+    return CacheablePrefix(key, text, "\n**Pregunta del usuario:** ¿Qué es el delito?")
+
+def _manager(api, **options) -> ContextCacheManager:
+    options = {"ttl": 3600, "refresh_margin": 300, "min_chars": 1000, **options}
+    return ContextCacheManager(api=api, **options)
+
+def test_creates_cache_on_first_use_and_reuses_it():
+    api = FakeCachingAPI()
+    manager = _manager(api)
+    key = KeyState("#1", "clave-1")
+
+    async def scenario():
+        first = await manager.resolve(key, MODEL, _prefix())
+        second = await manager.resolve(key, MODEL, _prefix())
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first is not None and first == second
+    assert api.stats["create"] == 1
+    assert api.chars(first) == len(DOCUMENT)
+    assert manager.stats()["created"] == 1 and manager.stats()["hits"] == 1
+
+def test_small_documents_are_not_cached():
+    api = FakeCachingAPI()
+    manager = _manager(api)
+    assert asyncio.run(manager.resolve(KeyState("#1", "clave-1"), MODEL, _prefix(text="corto"))) is None
+    assert api.stats["create"] == 0
+
+def test_refreshes_ttl_before_expiry():
+    api = FakeCachingAPI()
+    # Con un margen mayor que el TTL, a cada caché ya le "queda poco" en el siguiente uso
+    manager = _manager(api, ttl=100, refresh_margin=200)
+    key = KeyState("#1", "clave-1")
+
+    async def scenario():
+        name = await manager.resolve(key, MODEL, _prefix())
+        before = manager._handles[(key.label, "doc-a")].expires_at
+        await asyncio.sleep(0.01)
+        again = await manager.resolve(key, MODEL, _prefix())
+        return name, again, before, manager._handles[(key.label, "doc-a")].expires_at
+
+    name, again, before, after = asyncio.run(scenario())
+    assert again == name
+    assert after > before
+    assert api.stats["create"] == 1 and api.stats["update_ttl"] == 1
+    assert manager.stats()["refreshed"] == 1
+
+def test_recreates_cache_deleted_outside_on_refresh():
+    api = FakeCachingAPI()
+    manager = _manager(api, ttl=100, refresh_margin=200)
+    key = KeyState("#1", "clave-1")
+
+    async def scenario():
+        name = await manager.resolve(key, MODEL, _prefix())
+        # Caducó o se borró por fuera: update_ttl responde NotFound
+        await api.delete(key.api_key, name)
+        return name, await manager.resolve(key, MODEL, _prefix())
+
+    old, new = asyncio.run(scenario())
+    assert new is not None and new != old
+    assert api.stats["create"] == 2
+    assert manager.stats()["failures"] == 0
+
+def test_recreates_cache_after_local_expiry():
+    api = FakeCachingAPI()
+    manager = _manager(api, ttl=0.05, refresh_margin=0)
+    key = KeyState("#1", "clave-1")
+
+    async def scenario():
+        old = await manager.resolve(key, MODEL, _prefix())
+        await asyncio.sleep(0.1)
+        return old, await manager.resolve(key, MODEL, _prefix())
+
+    old, new = asyncio.run(scenario())
+    assert new != old
+    assert api.stats["create"] == 2 and api.stats["update_ttl"] == 0
+
+def test_evicts_least_recently_used_cache_at_capacity():
+    api = FakeCachingAPI()
+    manager = _manager(api, max_entries=2)
+    key = KeyState("#1", "clave-1")
+
+    async def scenario():
+        a = await manager.resolve(key, MODEL, _prefix("doc-a"))
+        b = await manager.resolve(key, MODEL, _prefix("doc-b"))
+        await manager.resolve(key, MODEL, _prefix("doc-a"))
+        c = await manager.resolve(key, MODEL, _prefix("doc-c"))
+        return a, b, c
+
+    a, b, c = asyncio.run(scenario())
+    assert manager.stats()["entries"] == 2
+    assert api.stats["delete"] == 1
+    # 'doc-b' era la menos usada: se borró en la API y 'doc-a' sigue viva
+    with pytest.raises(NotFound):
+        api.chars(b)
+    assert api.chars(a) and api.chars(c)
+    assert set(slot[1] for slot in manager._handles) == {"doc-a", "doc-c"}
+
+def test_slot_locks_are_dropped_once_unused():
+    api = FakeCachingAPI()
+    manager = _manager(api, max_entries=1)
+    key = KeyState("#1", "clave-1")
+
+    async def scenario():
+        # Varias preguntas simultáneas sobre el mismo documento comparten lock y crean una sola caché
+        await asyncio.gather(*(manager.resolve(key, MODEL, _prefix("doc-a")) for _ in range(3)))
+        await manager.resolve(key, MODEL, _prefix("doc-b"))
+
+    asyncio.run(scenario())
+    assert api.stats["create"] == 2 and api.stats["delete"] == 1
+    # Ni el hueco expulsado ni el vivo conservan su lock una vez terminadas las preguntas
+    assert len(manager._locks) == 0
+
+class _FailingCreateAPI(FakeCachingAPI):
+    async def create(self, *args, **kwargs):
+        self.stats["create"] += 1
+        raise RuntimeError("cuota de caché agotada")
+
+def test_failure_cooldown_stops_repeated_create_attempts():
+    api = _FailingCreateAPI()
+    manager = _manager(api)
+    key = KeyState("#1", "clave-1")
+
+    async def scenario():
+        return [await manager.resolve(key, MODEL, _prefix()) for _ in range(3)]
+
+    assert asyncio.run(scenario()) == [None, None, None]
+    assert api.stats["create"] == 1
+    assert manager.stats()["failures"] == 1
+
+    # Pasado el tiempo de espera se vuelve a intentar
+    slot = (key.label, "doc-a")
+    assert manager._failed_until[slot] - time.monotonic() > context_cache.FAILURE_COOLDOWN - 5
+    manager._failed_until[slot] = time.monotonic() - 1
+    assert asyncio.run(manager.resolve(key, MODEL, _prefix())) is None
+    assert api.stats["create"] == 2
+
+def test_pool_invalidates_missing_cache_and_retries_without_it():
+    api = FakeCachingAPI()
+    manager = _manager(api)
+    factory, models = model_factory(first_token_latency=0.0, chunk_interval=0.0, caching_api=api)
+    pool = GeminiClientPool(["clave-1"], model_name=MODEL, model_factory=factory, context_cache=manager)
+    prefix = _prefix()
+    full_prompt = prefix.text + prefix.suffix
+
+    async def scenario():
+        await pool.generate(full_prompt, cached_prefix=prefix)
+        # La caché desaparece en Gemini pero el gestor aún la cree viva
+        name = manager._handles[("#1", "doc-a")].name
+        await api.delete("clave-1", name)
+        text = await pool.generate(full_prompt, cached_prefix=prefix)
+        return name, text
+
+    name, text = asyncio.run(scenario())
+    assert text
+    stats = models[0].stats
+    # Llamadas: la primera con caché, la que falla con caché y el reintento con el prompt completo
+    assert stats["calls"] == 3 and stats["cached_calls"] == 2
+    assert stats["prompt_chars"] == 2 * len(prefix.suffix) + len(full_prompt)
+    assert ("#1", "doc-a") not in manager._handles
+    assert api.stats["create"] == 1
+    assert pool.keys[0].errors == 0 and pool.keys[0].open_until <= time.monotonic()
@@ -0,0 +1,104 @@
+# tests/test_dispatcher.py
+#
+# UpdateDispatcher: ventana de update_id repetidos y fusión de pulsaciones, con updates y aplicación falsos.
+# Ejecutar con: PYTHONPATH=. python -m pytest tests
+
+import asyncio
+
+from bot_logic.dispatcher import RecentUpdates, UpdateDispatcher
+
+class _Chat:
+    def __init__(self, chat_id: int):
+        self.id = chat_id
+
+class _Message:
+    def __init__(self, message_id: int):
+        self.message_id = message_id
+
+class _Query:
+    def __init__(self, data: str, message_id: int):
+        self.data = data
+        self.message = _Message(message_id)
+        self.answered = False
+
+    async def answer(self):
+        self.answered = True
+
+class _Update:
+    def __init__(self, update_id: int, data: str = None, message_id: int = 10, chat_id: int = 1):
+        self.update_id = update_id
+        self.effective_chat = _Chat(chat_id)
+        self.callback_query = _Query(data, message_id) if data else None
+
+class _Application:
+    """Procesa los updates cuando se abre 'gate' y apunta su update_id."""
+
+    def __init__(self):
+        self.gate = asyncio.Event()
+        self.processed = []
+
+    async def process_update(self, update):
+        await self.gate.wait()
+        self.processed.append(update.update_id)
+
+def test_recent_updates_forget_ids_outside_the_window():
+    recent = RecentUpdates(size=3)
+    assert not any(recent.seen(update_id) for update_id in (1, 2, 3))
+    assert recent.seen(3) and recent.duplicates == 1
+    # El 4 empuja fuera de la ventana al más antiguo: una reentrega del 1 ya no se reconoce
+    assert not recent.seen(4)
+    assert not recent.seen(1)
+    assert recent.seen(4)
+
+def test_recent_updates_forget_lets_a_failed_update_run_again():
+    recent = RecentUpdates(size=3)
+    recent.seen(1)
+    recent.forget(1)
+    assert not recent.seen(1)
+
+def test_repeated_update_id_is_processed_once():
+    done = []
+
+    async def scenario():
+        application = _Application()
+        application.gate.set()
+        dispatcher = UpdateDispatcher(application)
+        assert dispatcher.submit(_Update(1), on_done=done.append)
+        assert dispatcher.submit(_Update(1), on_done=done.append)
+        await dispatcher.drain()
+        return application, dispatcher
+
+    application, dispatcher = asyncio.run(scenario())
+    assert application.processed == [1]
+    assert dispatcher.duplicates == 1
+    # 'on_done' se llama también para el repetido: api/polling.py puede confirmarlo
+    assert [update.update_id for update in done] == [1, 1]
+
+def test_coalesces_only_the_same_button_on_the_same_message():
+    updates = [
+        _Update(1, "detail_simple", message_id=10),
+        _Update(2, "detail_simple", message_id=10),    # el mismo botón otra vez: se fusiona
+        _Update(3, "detail_detailed", message_id=10),  # otro botón del mismo mensaje
+        _Update(4, "detail_simple", message_id=11),    # el mismo botón en otro mensaje
+        _Update(5, "sugg_0", message_id=10),
+        _Update(6, "sugg_1", message_id=10),
+        _Update(7, "page_Derecho_1", message_id=10),   # no es de los que se fusionan
+        _Update(8, "page_Derecho_1", message_id=10),
+    ]
+
+    async def scenario():
+        application = _Application()
+        dispatcher = UpdateDispatcher(application)
+        for update in updates: assert dispatcher.submit(update)
+        application.gate.set()
+        while dispatcher.in_flight: await asyncio.sleep(0.01)
+        # Terminada la primera, volver a pulsar el mismo botón sí se procesa
+        assert dispatcher.submit(_Update(9, "detail_simple", message_id=10))
+        await dispatcher.drain()
+        return application, dispatcher
+
+    application, dispatcher = asyncio.run(scenario())
+    assert application.processed == [1, 3, 4, 5, 6, 7, 8, 9]
+    assert dispatcher.coalesced == 1
+    # A la pulsación fusionada se le responde para quitar el reloj del botón
+    assert updates[1].callback_query.answered and not updates[0].callback_query.answered
@@ -0,0 +1,144 @@
+# tests/test_llm_pool.py
+#
+# GeminiClientPool con modelos falsos (bench/fake_gemini.py): reparto entre claves, circuito, cuota,
+# reintentos y streams que se quedan parados.
+# Ejecutar con: PYTHONPATH=. python -m pytest tests
+
+import asyncio
+import itertools
+import time
+
+import pytest
+from google.api_core.exceptions import ResourceExhausted, ServiceUnavailable
+
+from bench.fake_gemini import FakeModel
+from bot_logic import llm_pool
+from bot_logic.llm_pool import GeminiClientPool, NoAvailableKeyError
+
+MODEL = "gemini-test-001"
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    # Sin esperas entre reintentos: las pruebas no miden el backoff
+    monkeypatch.setattr(llm_pool, "BACKOFF_BASE", 0.0)
+
+class _ScriptedModel(FakeModel):
+    """FakeModel que, antes de responder, falla con los errores de 'failures' (uno por llamada)."""
+
+    def __init__(self, failures=(), **options):
+        super().__init__(**{"first_token_latency": 0.0, "chunk_interval": 0.0, **options})
+        self.failures = iter(failures)
+
+    async def generate_content_async(self, prompt, stream: bool = False):
+        error = next(self.failures, None)
+        if error is not None:
+            self.stats["calls"] += 1
+            raise error
+        return await super().generate_content_async(prompt, stream)
+
+class _StallingModel(FakeModel):
+    """FakeModel cuyo stream se detiene para siempre tras 'stall_after' trozos."""
+
+    def __init__(self, stall_after: int, **options):
+        super().__init__(**{"first_token_latency": 0.0, "chunk_interval": 0.0, **options})
+        self.stall_after = stall_after
+
+    async def _stream(self, text: str, usage):
+        delivered = 0
+        async for chunk in super()._stream(text, usage):
+            if delivered == self.stall_after: await asyncio.Event().wait()
+            delivered += 1
+            yield chunk
+
+def _pool(models: dict, **options) -> GeminiClientPool:
+    """Pool con una clave por entrada de 'models' (clave API -> modelo)."""
+    return GeminiClientPool(list(models), model_name=MODEL, model_factory=lambda api_key, model_name: models[api_key], **options)
+
+def test_picks_least_loaded_key():
+    models = {"clave-1": _ScriptedModel(first_token_latency=0.05), "clave-2": _ScriptedModel(first_token_latency=0.05)}
+    pool = _pool(models)
+
+    async def scenario():
+        return await asyncio.gather(*(pool.generate("¿Qué es el delito?") for _ in range(4)))
+
+    assert all(asyncio.run(scenario()))
+    # Con dos llamadas en curso en una clave, la siguiente va a la otra
+    assert [model.stats["calls"] for model in models.values()] == [2, 2]
+
+    pool.keys[0].in_flight = 3
+    asyncio.run(pool.generate("¿Qué es el delito?"))
+    assert models["clave-2"].stats["calls"] == 3
+
+def test_quota_error_takes_key_out_of_rotation():
+    models = {"clave-1": _ScriptedModel([ResourceExhausted("cuota agotada")]), "clave-2": _ScriptedModel()}
+    # En un pool nuevo, con las dos claves libres, el primer intento va a la clave 1
+    pool = _pool(models)
+
+    async def scenario():
+        return [await pool.generate("¿Qué es el delito?") for _ in range(3)]
+
+    assert all(asyncio.run(scenario()))
+    first = pool.keys[0]
+    assert first.quota_errors == 1
+    assert first.open_until - time.monotonic() > llm_pool.QUOTA_COOLDOWN - 5
+    # Mientras dura el enfriamiento todo va a la otra clave
+    assert models["clave-1"].stats["calls"] == 1 and models["clave-2"].stats["calls"] == 3
+
+def test_consecutive_transient_errors_open_the_circuit():
+    model = _ScriptedModel(itertools.repeat(ServiceUnavailable("no disponible")))
+    pool = _pool({"clave-1": model}, max_attempts=llm_pool.FAILURE_THRESHOLD)
+
+    with pytest.raises(NoAvailableKeyError):
+        asyncio.run(pool.generate("¿Qué es el delito?"))
+    key = pool.keys[0]
+    assert key.consecutive_failures == llm_pool.FAILURE_THRESHOLD
+    assert not key.is_available(time.monotonic())
+
+    # Con el circuito abierto durante más de BACKOFF_MAX no se llega a llamar al modelo
+    with pytest.raises(NoAvailableKeyError):
+        asyncio.run(pool.generate("¿Qué es el delito?"))
+    assert model.stats["calls"] == llm_pool.FAILURE_THRESHOLD
+
+def test_success_resets_consecutive_failures():
+    model = _ScriptedModel([ServiceUnavailable("no disponible")] * (llm_pool.FAILURE_THRESHOLD - 1))
+    pool = _pool({"clave-1": model})
+    assert asyncio.run(pool.generate("¿Qué es el delito?"))
+    key = pool.keys[0]
+    assert key.consecutive_failures == 0 and key.is_available(time.monotonic())
+
+def test_retries_are_bounded_and_raise_no_available_key():
+    failing = lambda: _ScriptedModel(itertools.repeat(ServiceUnavailable("no disponible")))
+    models = {"clave-1": failing(), "clave-2": failing()}
+    pool = _pool(models, max_attempts=4)
+
+    with pytest.raises(NoAvailableKeyError) as raised:
+        asyncio.run(pool.generate("¿Qué es el delito?"))
+    assert isinstance(raised.value.args[1], ServiceUnavailable)
+    assert sum(model.stats["calls"] for model in models.values()) == 4
+    assert all(key.in_flight == 0 for key in pool.keys)
+
+def test_stream_stalled_before_first_chunk_retries_with_another_key():
+    models = {"clave-1": _StallingModel(stall_after=0), "clave-2": _ScriptedModel()}
+    pool = _pool(models, stream_chunk_timeout=0.05)
+
+    async def scenario():
+        return "".join([chunk async for chunk in pool.stream("¿Qué es el delito?")])
+
+    assert asyncio.run(scenario())
+    assert pool.keys[0].consecutive_failures == 1 and pool.keys[0].in_flight == 0
+    assert pool.keys[1].successes == 1
+
+def test_stream_stalled_mid_answer_releases_the_key():
+    pool = _pool({"clave-1": _StallingModel(stall_after=2)}, stream_chunk_timeout=0.05)
+    received = []
+
+    async def scenario():
+        async for chunk in pool.stream("¿Qué es el delito?"):
+            received.append(chunk)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(scenario())
+    # Ya se habían entregado trozos: no se reintenta, pero la clave queda libre y el fallo cuenta
+    key = pool.keys[0]
+    assert len(received) == 2
+    assert key.in_flight == 0 and key.errors == 1 and key.consecutive_failures == 1
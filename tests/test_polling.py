@@ -0,0 +1,131 @@
+# tests/test_polling.py
+#
+# PollingRunner (api/polling.py) contra el Bot API falso de bench/fake_telegram.py.
+# Ejecutar con: PYTHONPATH=. python -m pytest tests
+
+import asyncio
+import time
+
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+
+from bench.common import prepare_environment
+from bench.fake_telegram import FakeBotApi
+
+# api/polling.py importa bot_logic.handlers, que necesita credenciales (falsas) al importarse
+prepare_environment()
+from api.polling import PollingRunner  # noqa: E402
+
+def _message(chat_id: int, text: str = "hola") -> dict:
+    return {"message": {"message_id": 1, "date": 0, "chat": {"id": chat_id, "type": "private"}, "text": text}}
+
+def _application(api: FakeBotApi, handle) -> Application:
+    """Aplicación mínima contra el Bot API falso: 'handle(update, context)' procesa cada update."""
+    application = Application.builder().token("123456:TEST-TOKEN").base_url(f"{api.base_url}/bot").updater(None).build()
+    application.add_handler(TypeHandler(Update, handle))
+    return application
+
+def _runner(api: FakeBotApi, handle) -> PollingRunner:
+    return PollingRunner(_application(api, handle), poll_timeout=1, busy_interval=0.02)
+
+async def _wait_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "La condición no se cumplió a tiempo."
+        await asyncio.sleep(0.01)
+
+def test_offset_is_committed_only_after_handlers_finish():
+    api = FakeBotApi()
+    api.start_in_thread()
+    processed = []
+
+    async def scenario():
+        gate = asyncio.Event()
+
+        async def handle(update, context):
+            if update.update_id == 2: await gate.wait()
+            processed.append(update.update_id)
+
+        for chat in (1, 2, 3): api.push_update(_message(chat))
+        runner = _runner(api, handle)
+        task = asyncio.create_task(runner.run())
+        await _wait_for(lambda: sorted(processed) == [1, 3] and api.confirmed_offset == 2)
+        # Mientras el 2 sigue en curso, los siguientes getUpdates no confirman ni el 2 ni el 3
+        await asyncio.sleep(0.1)
+        assert api.confirmed_offset == 2 and runner.tracker.offset == 2
+        gate.set()
+        await _wait_for(lambda: api.confirmed_offset == 4)
+        runner.stop()
+        await task
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        api.stop_thread()
+    assert sorted(processed) == [1, 2, 3]
+
+def test_crash_mid_batch_replays_unprocessed_updates():
+    api = FakeBotApi()
+    api.start_in_thread()
+    first, second = [], []
+
+    async def hang(update, context):
+        first.append(update.update_id)
+        if update.update_id == 2: await asyncio.Event().wait()
+
+    async def record(update, context):
+        second.append(update.update_id)
+
+    async def restart():
+        runner = _runner(api, record)
+        task = asyncio.create_task(runner.run())
+        await _wait_for(lambda: len(second) == 2)
+        runner.stop()
+        await task
+
+    # El 3 es del mismo chat que el 2: espera en su cola detrás de él
+    for chat in (1, 2, 2): api.push_update(_message(chat))
+    crashed = asyncio.new_event_loop()
+    try:
+        crashed.create_task(_runner(api, hang).run())
+        crashed.run_until_complete(_wait_for(lambda: sorted(first) == [1, 2] and api.confirmed_offset == 2))
+        # El proceso "cae": su event loop deja de ejecutarse sin llegar a 'drain' ni al último commit
+        asyncio.run(restart())
+        confirmed = api.confirmed_offset
+    finally:
+        # Solo para no dejar tareas colgadas: se cancela lo que quedó en el loop "caído"
+        tasks = asyncio.all_tasks(crashed)
+        for task in tasks: task.cancel()
+        crashed.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        crashed.close()
+        api.stop_thread()
+    # Se vuelven a entregar el que estaba a medias y el que esperaba detrás; el 1 ya estaba confirmado
+    assert second == [2, 3]
+    assert confirmed == 4
+
+def test_stop_drains_in_flight_updates_before_committing():
+    api = FakeBotApi()
+    api.start_in_thread()
+    processed = []
+
+    async def slow(update, context):
+        await asyncio.sleep(0.2)
+        processed.append(update.update_id)
+
+    async def scenario():
+        for chat in (1, 2, 3): api.push_update(_message(chat))
+        runner = _runner(api, slow)
+        task = asyncio.create_task(runner.run())
+        await _wait_for(lambda: runner.received == 3)
+        assert not processed
+        runner.stop()
+        await task
+        return runner
+
+    try:
+        runner = asyncio.run(scenario())
+    finally:
+        api.stop_thread()
+    assert sorted(processed) == [1, 2, 3]
+    # Al salir se confirma todo lo procesado: Telegram no volverá a entregar ninguno
+    assert api.confirmed_offset == 4 and runner.tracker.pending == 0
@@ -0,0 +1,116 @@
+# tests/test_scheduler.py
+#
+# FairScheduler: orden de la cola justa, rechazos y cancelaciones.
+# Ejecutar con: PYTHONPATH=. python -m pytest tests
+
+import asyncio
+
+import pytest
+
+from bot_logic.scheduler import FairScheduler, QueueFullError, RateLimitedError
+
+COSTS = {"simple": 1.0, "detailed": 3.0}
+
+def _scheduler(**options) -> FairScheduler:
+    options = {"max_concurrency": 1, "max_queue": 10, "burst": 100, "rate_per_minute": 60, "costs": COSTS, **options}
+    return FairScheduler(**options)
+
+async def _queue_behind_holder(scheduler, requests) -> list:
+    """
+    Ocupa el único hueco, encola 'requests' [(usuario, nivel, etiqueta)] en ese orden y, al liberar el
+    hueco, devuelve el orden en el que fueron recibiendo el turno.
+    """
+    order = []
+
+    async def ask(user_id, level, label):
+        await scheduler.acquire(user_id, level)
+        order.append(label)
+        scheduler.release()
+
+    await scheduler.acquire("ocupa", "simple")
+    tasks = []
+    for request in requests:
+        tasks.append(asyncio.create_task(ask(*request)))
+        await asyncio.sleep(0)
+    assert scheduler.queued == len(requests)
+    scheduler.release()
+    await asyncio.gather(*tasks)
+    return order
+
+def test_fair_queue_interleaves_users_and_favours_cheap_questions():
+    scheduler = _scheduler()
+    order = asyncio.run(_queue_behind_holder(scheduler, [
+        ("ana", "detailed", "ana-1"),
+        ("ana", "detailed", "ana-2"),
+        ("ana", "detailed", "ana-3"),
+        ("beto", "detailed", "beto-1"),
+        ("beto", "simple", "beto-2"),
+    ]))
+    # Ana llegó primero con tres preguntas, pero Beto no espera a que terminen todas: cada pregunta
+    # se ordena por su fin virtual (ana 3, 6, 9; beto 3 y, con la simple de coste 1, 4)
+    assert order == ["ana-1", "beto-1", "beto-2", "ana-2", "ana-3"]
+
+def test_simple_question_overtakes_queued_detailed_ones():
+    scheduler = _scheduler()
+    order = asyncio.run(_queue_behind_holder(scheduler, [
+        ("ana", "detailed", "ana-detallada"),
+        ("beto", "detailed", "beto-detallada"),
+        ("carla", "simple", "carla-simple"),
+    ]))
+    assert order == ["carla-simple", "ana-detallada", "beto-detallada"]
+
+def test_full_queue_rejects_before_spending_tokens():
+    scheduler = _scheduler(max_queue=1, burst=2)
+
+    async def scenario():
+        await scheduler.acquire("ocupa", "simple")
+        waiting = asyncio.create_task(scheduler.acquire("ana", "simple"))
+        await asyncio.sleep(0)
+        for _ in range(3):
+            with pytest.raises(QueueFullError) as raised:
+                await scheduler.acquire("beto", "detailed")
+        assert raised.value.position == 2 and raised.value.retry_after > 0
+        scheduler.release()
+        await waiting
+        scheduler.release()
+        # Los rechazos por cola llena no gastaron nada: Beto conserva su cubo entero (2 tokens)
+        await scheduler.acquire("beto", "simple")
+        scheduler.release()
+        await scheduler.acquire("beto", "simple")
+        scheduler.release()
+
+    asyncio.run(scenario())
+    assert scheduler.queue_full == 3 and scheduler.rate_limited == 0
+
+def test_user_without_tokens_is_rate_limited():
+    scheduler = _scheduler(max_concurrency=10, burst=3, rate_per_minute=6)
+
+    async def scenario():
+        await scheduler.acquire("ana", "detailed")
+        with pytest.raises(RateLimitedError) as raised:
+            await scheduler.acquire("ana", "simple")
+        return raised.value
+
+    error = asyncio.run(scenario())
+    # Recupera 6 tokens por minuto: le falta 1 token, 10 segundos
+    assert error.retry_after == pytest.approx(10, rel=0.05)
+    assert scheduler.rate_limited == 1
+
+def test_cancelled_waiter_leaves_the_queue():
+    scheduler = _scheduler()
+
+    async def scenario():
+        await scheduler.acquire("ocupa", "simple")
+        cancelled = asyncio.create_task(scheduler.acquire("ana", "simple"))
+        waiting = asyncio.create_task(scheduler.acquire("beto", "simple"))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        assert scheduler.queued == 1
+        scheduler.release()
+        await waiting
+        assert scheduler.stats()["running"] == 1
+        scheduler.release()
+
+    asyncio.run(scenario())
+    assert scheduler.stats()["running"] == 0 and scheduler.queued == 0
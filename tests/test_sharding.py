@@ -0,0 +1,168 @@
+# tests/test_sharding.py
+#
+# HashRing y los reinicios de ShardedDispatcher, con procesos falsos (no se arranca ningún worker real).
+# Ejecutar con: PYTHONPATH=. python -m pytest tests
+
+import asyncio
+import queue
+import time
+
+import pytest
+
+from bot_logic import sharding
+from bot_logic.scheduler import FairScheduler
+from bot_logic.sharding import HashRing, ShardedDispatcher
+
+KEYS = range(5000)
+
+def test_ring_sends_each_key_to_the_same_node():
+    ring, rebuilt = HashRing(range(4)), HashRing(range(4))
+    nodes = [ring.node_for(key) for key in KEYS]
+    assert nodes == [rebuilt.node_for(key) for key in KEYS]
+    # Con 64 puntos por nodo, ningún nodo se queda con mucho más de su cuarta parte
+    assert max(nodes.count(node) for node in range(4)) < 1.5 * len(KEYS) / 4
+
+def test_adding_a_node_only_moves_keys_to_it():
+    before, after = HashRing(range(3)), HashRing(range(4))
+    moved = [key for key in KEYS if before.node_for(key) != after.node_for(key)]
+    assert all(after.node_for(key) == 3 for key in moved)
+    assert 0.15 < len(moved) / len(KEYS) < 0.35
+
+def test_removing_a_node_only_moves_its_keys():
+    before, after = HashRing(range(4)), HashRing([0, 1, 3])
+    for key in KEYS:
+        if before.node_for(key) != 2: assert after.node_for(key) == before.node_for(key)
+
+def test_empty_ring_raises_lookup_error():
+    with pytest.raises(LookupError):
+        HashRing([]).node_for(1)
+
+class _FakeProcess:
+    def __init__(self, exitcode):
+        self.exitcode = exitcode
+        self.pid = 4242
+
+class _Chat:
+    def __init__(self, chat_id: int):
+        self.id = chat_id
+
+class _FakeUpdate:
+    def __init__(self, update_id: int, chat_id: int):
+        self.update_id = update_id
+        self.effective_chat = _Chat(chat_id)
+
+    def to_dict(self) -> dict:
+        return {"update_id": self.update_id}
+
+class _CrashingDispatcher(ShardedDispatcher):
+    """Sin procesos reales: los workers de 'crashing' caen nada más arrancar; los demás siguen vivos."""
+
+    def __init__(self, workers: int, crashing=()):
+        super().__init__(workers)
+        self.crashing = set(crashing)
+        self.starts = []
+
+    def _start_worker(self, worker):
+        worker.inbox = queue.Queue()
+        worker.pid = None
+        worker.started_at = time.monotonic()
+        worker.process = _FakeProcess(1 if worker.index in self.crashing else None)
+        worker.inbox.put(("share", self._size))
+        self.starts.append((worker.index, worker.started_at))
+
+    def start_workers(self):
+        for index in range(self._size):
+            self._start_worker(self._workers.setdefault(index, sharding._Worker(index)))
+
+def _restart_gaps(dispatcher, index: int) -> list:
+    times = [started for worker, started in dispatcher.starts if worker == index]
+    return [b - a for a, b in zip(times, times[1:])]
+
+def test_crashing_worker_backs_off_and_gives_up(monkeypatch):
+    monkeypatch.setattr(sharding, "RESTART_BACKOFF", 0.02)
+    monkeypatch.setattr(sharding, "MAX_CONSECUTIVE_RESTARTS", 3)
+    dispatcher = _CrashingDispatcher(2)
+    dispatcher.start_workers()
+    finished = []
+    # Un chat que el anillo manda al worker 1, con un update en curso cuando cae
+    chat = next(key for key in KEYS if dispatcher.ring.node_for(key) == 1)
+    update = _FakeUpdate(7, chat)
+
+    async def scenario():
+        assert dispatcher.submit(update, on_done=finished.append)
+        dispatcher.crashing.add(1)
+        dispatcher._workers[1].process.exitcode = 1
+        watch = asyncio.create_task(dispatcher._watch())
+        deadline = time.monotonic() + 5
+        while not dispatcher._workers[1].failed and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        # Ya no se reinicia más
+        await asyncio.sleep(0.3)
+        dispatcher._closed = True
+        watch.cancel()
+
+    asyncio.run(scenario())
+    worker = dispatcher._workers[1]
+    assert worker.failed
+    # El arranque inicial y MAX_CONSECUTIVE_RESTARTS reinicios, cada uno esperando el doble que el anterior
+    gaps = _restart_gaps(dispatcher, 1)
+    assert len(gaps) == 3
+    assert all(gap >= 0.02 * 2 ** i for i, gap in enumerate(gaps))
+    assert dispatcher.restarts == 4 and worker.restarts == 4
+    # El update que tenía a medias se da por perdido y 'on_done' recibe el update original
+    assert finished == [update] and dispatcher.lost == 1 and not dispatcher._entries
+    # Sus chats pasan al otro worker
+    assert dispatcher.ring.nodes == [0] and dispatcher.ring.node_for(chat) == 0
+    assert dispatcher.stats()["per_worker"][1]["failed"]
+
+def test_resize_gives_a_failed_worker_another_chance(monkeypatch):
+    monkeypatch.setattr(sharding, "RESTART_BACKOFF", 0.02)
+    monkeypatch.setattr(sharding, "MAX_CONSECUTIVE_RESTARTS", 1)
+    dispatcher = _CrashingDispatcher(2, crashing=[1])
+    dispatcher.start_workers()
+
+    async def scenario():
+        watch = asyncio.create_task(dispatcher._watch())
+        while not dispatcher._workers[1].failed: await asyncio.sleep(0.01)
+        dispatcher.crashing.clear()
+        dispatcher.resize(2)
+        await asyncio.sleep(0.3)
+        dispatcher._closed = True
+        watch.cancel()
+
+    asyncio.run(scenario())
+    worker = dispatcher._workers[1]
+    assert not worker.failed and worker.crashes == 0 and worker.process.exitcode is None
+    assert dispatcher.ring.nodes == [0, 1]
+
+def test_updates_sent_while_waiting_to_restart_are_not_counted_as_attempts(monkeypatch):
+    monkeypatch.setattr(sharding, "RESTART_BACKOFF", 0.2)
+    dispatcher = _CrashingDispatcher(1)
+    dispatcher.start_workers()
+    chat = 1
+
+    async def scenario():
+        dispatcher.submit(_FakeUpdate(1, chat))
+        dispatcher._workers[0].process.exitcode = 1
+        watch = asyncio.create_task(dispatcher._watch())
+        while dispatcher._workers[0].restart_at is None: await asyncio.sleep(0.01)
+        # Llega mientras el worker espera para arrancar
+        dispatcher.submit(_FakeUpdate(2, chat))
+        while dispatcher._workers[0].restart_at is not None: await asyncio.sleep(0.01)
+        dispatcher._closed = True
+        watch.cancel()
+
+    asyncio.run(scenario())
+    assert dispatcher._entries[1].attempts == 1 and dispatcher._entries[2].attempts == 0
+    sent = []
+    inbox = dispatcher._workers[0].inbox
+    while not inbox.empty(): sent.append(inbox.get())
+    assert sent == [("share", 1), ("update", {"update_id": 1}), ("update", {"update_id": 2})]
+
+def test_workers_share_the_global_llm_cap():
+    scheduler = FairScheduler(max_concurrency=8, max_queue=32, max_background=2)
+    scheduler.split(3)
+    assert (scheduler.max_concurrency, scheduler.max_queue, scheduler.max_background) == (2, 10, 1)
+    # Volver a repartir parte siempre de los límites globales
+    scheduler.split(1)
+    assert (scheduler.max_concurrency, scheduler.max_queue, scheduler.max_background) == (8, 32, 2)
@@ -0,0 +1,90 @@
+# tests/test_speculative.py
+#
+# SpeculativePrefetcher: cancelación por usuario, 'join' y presupuesto, con trabajos falsos.
+# Ejecutar con: PYTHONPATH=. python -m pytest tests
+
+import asyncio
+
+from bot_logic.speculative import SpeculativePrefetcher
+
+def _job(gate: asyncio.Event, done: list, key: str, starts: bool = True):
+    """Trabajo falso: marca 'started' (si 'starts') como tras conseguir turno y termina al abrirse 'gate'."""
+    async def job(started: asyncio.Event):
+        if starts: started.set()
+        await gate.wait()
+        done.append(key)
+    return job
+
+def test_cancel_user_keeps_only_the_matching_jobs():
+    prefetcher = SpeculativePrefetcher(max_per_answer=3, burst=10)
+    done = []
+
+    async def scenario():
+        gate = asyncio.Event()
+        prefetcher.schedule("ana", [(key, _job(gate, done, key)) for key in ("a", "b", "c")])
+        prefetcher.schedule("beto", [("x", _job(gate, done, "x"))])
+        await asyncio.sleep(0)
+        prefetcher.cancel_user("ana", keep=lambda key: key == "b")
+        await asyncio.sleep(0)
+        assert set(prefetcher._jobs["ana"]) == {"b"}
+        gate.set()
+        while prefetcher.stats()["pending"]: await asyncio.sleep(0.01)
+
+    asyncio.run(scenario())
+    # Los demás trabajos de Ana se cancelan; el conservado y los de otro usuario terminan
+    assert sorted(done) == ["b", "x"]
+    assert prefetcher.cancelled == 2 and prefetcher.completed == 2
+    assert not prefetcher._jobs
+
+def test_cancel_user_without_keep_cancels_everything():
+    prefetcher = SpeculativePrefetcher(max_per_answer=3, burst=10)
+    done = []
+
+    async def scenario():
+        gate = asyncio.Event()
+        prefetcher.schedule("ana", [(key, _job(gate, done, key)) for key in ("a", "b")])
+        await asyncio.sleep(0)
+        prefetcher.cancel_user("ana")
+        gate.set()
+        await asyncio.sleep(0.01)
+
+    asyncio.run(scenario())
+    assert done == [] and prefetcher.cancelled == 2 and not prefetcher._jobs
+
+def test_join_waits_for_a_started_job_and_cancels_a_queued_one():
+    prefetcher = SpeculativePrefetcher(max_per_answer=3, burst=10)
+    done = []
+
+    async def scenario():
+        gate = asyncio.Event()
+        prefetcher.schedule("ana", [("en-curso", _job(gate, done, "en-curso")),
+                                    ("en-cola", _job(gate, done, "en-cola", starts=False))])
+        await asyncio.sleep(0)
+        # Aún esperaba su turno: la pregunta normal la hará antes, así que se cancela
+        assert not await prefetcher.join("ana", "en-cola")
+        joined = asyncio.create_task(prefetcher.join("ana", "en-curso"))
+        await asyncio.sleep(0)
+        assert not joined.done()
+        gate.set()
+        assert await joined
+        assert not await prefetcher.join("ana", "desconocida")
+
+    asyncio.run(scenario())
+    assert done == ["en-curso"]
+    assert prefetcher.joined == 1 and prefetcher.cancelled == 1
+
+def test_budget_limits_jobs_per_user():
+    prefetcher = SpeculativePrefetcher(max_per_answer=3, burst=2, rate_per_minute=0)
+    done = []
+
+    async def scenario():
+        gate = asyncio.Event()
+        gate.set()
+        prefetcher.schedule("ana", [(key, _job(gate, done, key)) for key in ("a", "b", "c")])
+        # Otro usuario tiene su propio cubo
+        prefetcher.schedule("beto", [("x", _job(gate, done, "x"))])
+        while prefetcher.stats()["pending"]: await asyncio.sleep(0.01)
+
+    asyncio.run(scenario())
+    assert sorted(done) == ["a", "b", "x"]
+    assert prefetcher.scheduled == 3 and prefetcher.over_budget == 1
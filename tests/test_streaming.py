@@ -0,0 +1,67 @@
+# tests/test_streaming.py
+#
+# ProgressiveReply y el corte de mensajes con textos que Telegram mide en unidades UTF-16.
+# Ejecutar con: PYTHONPATH=. python -m pytest tests
+
+import asyncio
+
+from telegram.error import BadRequest
+
+from bot_logic.renderer import split_point, utf16_fit, utf16_len
+from bot_logic.streaming import ProgressiveReply
+
+LIMIT = 100
+
+class _Message:
+    """Mensaje falso que, como Telegram, rechaza los textos de más de LIMIT unidades UTF-16."""
+
+    def __init__(self, text: str):
+        self.texts = []
+        self.edit_text_sync(text)
+
+    def edit_text_sync(self, text: str):
+        if utf16_len(text) > LIMIT: raise BadRequest("Message is too long")
+        self.texts.append(text)
+
+    async def edit_text(self, text: str, parse_mode=None, reply_markup=None):
+        self.edit_text_sync(text)
+
+class _Bot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        message = _Message(text)
+        self.sent.append(message)
+        return message
+
+def test_utf16_fit_never_splits_a_surrogate_pair():
+    text = "a😀b😀"
+    assert [utf16_fit(text, limit) for limit in range(7)] == [0, 1, 1, 2, 3, 3, 4]
+
+def test_split_point_measures_utf16_units():
+    text = "😀" * 30 + " " + "😀" * 30
+    cut = split_point(text, 80)
+    assert utf16_len(text[:cut]) <= 80
+    # Corta en el espacio (fin de palabra), no en mitad de los emojis
+    assert text[:cut].endswith(" ")
+    # Siempre avanza, aunque no quepa ni un carácter
+    assert split_point("😀😀", 1) == 1
+
+def test_progressive_reply_keeps_every_message_under_the_limit():
+    bot = _Bot()
+    first = _Message("Analizando...")
+    reply = ProgressiveReply(bot, chat_id=1, first_message=first, limit=LIMIT, edit_interval=0)
+    # Con emojis el texto ocupa casi el doble de unidades UTF-16 que de caracteres
+    answer = " ".join(f"🔎{i}📚" for i in range(120))
+
+    async def scenario():
+        for end in range(10, len(answer) + 10, 10):
+            await reply.update(answer[:end])
+
+    asyncio.run(scenario())
+    messages = [first] + bot.sent
+    assert len(messages) > 1
+    assert all(utf16_len(text) <= LIMIT for message in messages for text in message.texts)
+    # Los trozos congelados y el último mensaje siguen el texto sin saltarse ni repetir nada
+    assert answer.startswith("".join(reply._shown)) and reply._frozen_chars == sum(map(len, reply._shown[:-1]))